@@ -1,12 +1,19 @@
 from inspect import signature
-from typing import Any, Callable, List, TypeVar, Union
+from typing import Any, Callable, List, Optional, Tuple, TypeVar, Union
 
 import fhir.resources
 import httpx
-from fhir.resources import FHIRAbstractModel
+from fhir.resources import FHIRAbstractModel, construct_fhir_element
 from fhir.resources.bundle import Bundle
 from fhir.resources.fhirresourcemodel import FHIRResourceModel
 
+from fhir_kindling.fhir_query.partitioning import (
+    merge_partition_entries,
+    partition_bounds,
+    partition_field_value,
+    partition_missing_parameter,
+    partition_parameters,
+)
 from fhir_kindling.fhir_query.query_parameters import (
     FhirQueryParameters,
     FieldParameter,
@@ -16,6 +23,7 @@ from fhir_kindling.fhir_query.query_parameters import (
 )
 from fhir_kindling.fhir_query.query_response import (
     OutputFormats,
+    QueryResponse,
 )
 
 T = TypeVar("T", bound="FhirQueryBase")
@@ -318,6 +326,187 @@ class FhirQueryBase:
         """
         return self._make_query_string()
 
+    def _setup_stream(self, count: int = None, limit: int = None) -> str:
+        """
+        Prepare the query for streaming the result pages and return the url of the first page.
+
+        Args:
+            count: number of resources in a page
+            limit: maximum number of resources to stream
+
+        Returns:
+            url of the first page of results
+        """
+        if self.output_format != OutputFormats.JSON:
+            raise NotImplementedError("Streaming is only supported for json output")
+        self._limit = limit
+        self._count = count
+        return self.query_url
+
+    def _process_stream_page(
+        self, page: dict, n_streamed: int, parse: bool = False
+    ) -> Tuple[List[Union[dict, FHIRAbstractModel]], Optional[str]]:
+        """
+        Extract the resources from a single page of results and find the url of the next page.
+
+        Args:
+            page: search bundle containing a single page of results
+            n_streamed: number of resources already streamed, used to enforce the limit
+            parse: whether to parse the resources into fhir resource models
+
+        Returns:
+            Tuple of the resources in the page and the url of the next page or None if there are no more pages
+        """
+        entries = page.get("entry") or []
+        if self._limit:
+            entries = entries[: self._limit - n_streamed]
+
+        resources = []
+        for entry in entries:
+            resource = entry["resource"]
+            if parse:
+                resource = construct_fhir_element(resource["resourceType"], resource)
+            resources.append(resource)
+
+        if self._limit and n_streamed + len(resources) >= self._limit:
+            return resources, None
+        return resources, self._next_page_url(page)
+
+    def _copy_query(self: T) -> T:
+        """
+        Create an independent copy of the query that shares the client of this query.
+
+        Returns:
+            copy of the query
+        """
+        return self.__class__(
+            self.base_url,
+            query_parameters=self.query_parameters.copy(deep=True),
+            auth=self.auth,
+            headers=self.headers,
+            output_format=self.output_format.value,
+            client=self.client,
+            proxies=self.proxies,
+        )
+
+    def _partition_probe(self: T, field: str, descending: bool = False) -> T:
+        """
+        Create a copy of the query sorted by the partition field, to find the smallest or largest value of the field.
+        Resources without a value for the field are excluded, since servers may sort them first.
+
+        Args:
+            field: the search parameter to sort by
+            descending: whether to sort in descending order
+
+        Returns:
+            sorted copy of the query
+        """
+        if self.output_format != OutputFormats.JSON:
+            raise NotImplementedError("Partitioned queries only support json output")
+        sort_param = FieldParameter(
+            field="_sort",
+            operator=QueryOperators.eq,
+            value=f"-{field}" if descending else field,
+        )
+        probe = self._copy_query().where(field_param=sort_param)
+        has_value = partition_missing_parameter(field, missing=False)
+        if has_value:
+            probe.where(field_param=has_value)
+        return probe
+
+    def _partition_queries(
+        self: T,
+        field: str,
+        partitions: int,
+        first_response: QueryResponse,
+        last_response: QueryResponse,
+    ) -> List[T]:
+        """
+        Split the query into disjoint partitions of the value range of the given field. Resources without a value for
+        the field are queried in an additional partition.
+
+        Args:
+            field: the search parameter to partition on
+            partitions: the number of partitions
+            first_response: response of the probe query sorted ascending by the field
+            last_response: response of the probe query sorted descending by the field
+
+        Returns:
+            list of queries for the partitions
+        """
+        first_entries = first_response.response.get("entry")
+        last_entries = last_response.response.get("entry")
+        if not first_entries or not last_entries:
+            return [self._copy_query()]
+
+        min_value = partition_field_value(first_entries[0]["resource"], field)
+        max_value = partition_field_value(last_entries[0]["resource"], field)
+        bounds = partition_bounds(min_value, max_value, partitions)
+
+        queries = []
+        for field_params in partition_parameters(field, bounds):
+            query = self._copy_query()
+            for field_param in field_params:
+                query.where(field_param=field_param)
+            queries.append(query)
+        missing = partition_missing_parameter(field, missing=True)
+        if missing:
+            queries.append(self._copy_query().where(field_param=missing))
+        return queries
+
+    def _merge_partition_responses(
+        self, responses: List[QueryResponse], count: int = None
+    ) -> QueryResponse:
+        """
+        Merge the responses of partitioned queries into a single query response.
+
+        Args:
+            responses: responses of the partitions
+            count: page size used for the partitions
+
+        Returns:
+            query response containing the resources of all partitions
+        """
+        entries = merge_partition_entries(
+            [response.response.get("entry") or [] for response in responses]
+        )
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "total": sum(
+                1
+                for entry in entries
+                if (entry.get("search") or {}).get("mode") != "include"
+            ),
+            "entry": entries,
+        }
+        return QueryResponse(
+            response=bundle,
+            query_params=self.query_parameters,
+            count=count,
+            output_format=self.output_format,
+        )
+
+    @staticmethod
+    def _next_page_url(response_json: dict) -> Optional[str]:
+        """
+        Get the url of the next page from the links of a search bundle.
+
+        Args:
+            response_json: search bundle returned by the server
+
+        Returns:
+            url of the next page or None if it is the last page
+        """
+        return next(
+            (
+                link["url"]
+                for link in response_json.get("link") or []
+                if link.get("relation", None) == "next"
+            ),
+            None,
+        )
+
     @staticmethod
     def _execute_callback(
         entries: list,
@@ -0,0 +1,190 @@
+from datetime import date, datetime, timezone
+from typing import List, Optional, Union
+
+from fhir_kindling.fhir_query.query_parameters import FieldParameter, QueryOperators
+
+PartitionValue = Union[str, int, float]
+
+
+def partition_field_value(resource: dict, field: str) -> PartitionValue:
+    """
+    Get the value of the element a search parameter refers to from a resource dictionary.
+
+    Args:
+        resource: the resource as dictionary
+        field: the search parameter to partition on, `_lastUpdated` or the name of a top level element
+
+    Raises:
+        ValueError: if the resource has no date or numeric value for the field
+
+    Returns:
+        The value of the element
+    """
+    if field == "_lastUpdated":
+        value = (resource.get("meta") or {}).get("lastUpdated")
+    else:
+        # search parameters are lower case versions of the element names e.g. birthdate -> birthDate
+        key = next((k for k in resource if k.lower() == field.lower()), None)
+        value = resource.get(key) if key else None
+
+    if value is None or isinstance(value, (dict, list, bool)):
+        raise ValueError(
+            f"Can not partition on {field}, resource {resource.get('resourceType')}/{resource.get('id')} "
+            f"has no date or numeric value for it."
+        )
+    return value
+
+
+def partition_bounds(
+    min_value: PartitionValue, max_value: PartitionValue, partitions: int
+) -> List[PartitionValue]:
+    """
+    Split the range between min and max value into equally sized partitions and return the inner boundaries.
+
+    Args:
+        min_value: smallest value of the partitioned field
+        max_value: largest value of the partitioned field
+        partitions: number of partitions to create
+
+    Returns:
+        strictly increasing list of at most partitions - 1 boundaries between min and max value
+    """
+    if partitions < 1:
+        raise ValueError(f"Number of partitions must be at least 1, got {partitions}")
+
+    if isinstance(min_value, str) and isinstance(max_value, str):
+        date_only = len(min_value) <= 10 and len(max_value) <= 10
+        start = _parse_partition_datetime(min_value).timestamp()
+        end = _parse_partition_datetime(max_value).timestamp()
+        bounds = [
+            _format_partition_datetime(
+                start + (end - start) * i / partitions, date_only=date_only
+            )
+            for i in range(1, partitions)
+        ]
+        min_bound, max_bound = (
+            (
+                _parse_partition_datetime(min_value).date().isoformat(),
+                _parse_partition_datetime(max_value).date().isoformat(),
+            )
+            if date_only
+            else (None, None)
+        )
+    elif isinstance(min_value, (int, float)) and isinstance(max_value, (int, float)):
+        step = (max_value - min_value) / partitions
+        bounds = [min_value + step * i for i in range(1, partitions)]
+        if isinstance(min_value, int) and isinstance(max_value, int):
+            bounds = [int(round(b)) for b in bounds]
+        min_bound, max_bound = min_value, max_value
+    else:
+        raise ValueError(
+            f"Can not partition between values of type {type(min_value)} and {type(max_value)}"
+        )
+
+    # remove duplicates caused by rounding and boundaries that would create empty partitions
+    unique_bounds = []
+    for bound in bounds:
+        if unique_bounds and bound <= unique_bounds[-1]:
+            continue
+        if min_bound is not None and bound <= min_bound:
+            continue
+        if max_bound is not None and bound > max_bound:
+            continue
+        unique_bounds.append(bound)
+    return unique_bounds
+
+
+def partition_parameters(
+    field: str, bounds: List[PartitionValue]
+) -> List[List[FieldParameter]]:
+    """
+    Create the field parameters for disjoint partitions covering the complete value range. The first partition has no
+    lower and the last partition no upper bound.
+
+    Args:
+        field: the search parameter to partition on
+        bounds: the inner boundaries of the partitions
+
+    Returns:
+        list of the field parameters for each partition
+    """
+    parameters = []
+    for i in range(len(bounds) + 1):
+        partition = []
+        if i > 0:
+            partition.append(
+                FieldParameter(
+                    field=field, operator=QueryOperators.ge, value=bounds[i - 1]
+                )
+            )
+        if i < len(bounds):
+            partition.append(
+                FieldParameter(field=field, operator=QueryOperators.lt, value=bounds[i])
+            )
+        parameters.append(partition)
+    return parameters
+
+
+def partition_missing_parameter(field: str, missing: bool) -> Optional[FieldParameter]:
+    """
+    Create the `:missing` modifier parameter selecting the resources with or without a value for the partition field.
+    Resources without a value are not matched by any of the range partitions and have to be queried separately.
+
+    Args:
+        field: the search parameter to partition on
+        missing: whether to select the resources without a value for the field
+
+    Returns:
+        the field parameter or None for `_lastUpdated`, which every resource stored on a server has a value for
+    """
+    if field == "_lastUpdated":
+        return None
+    return FieldParameter(
+        field=f"{field}:missing", operator=QueryOperators.eq, value=missing
+    )
+
+
+def merge_partition_entries(partition_entries: List[List[dict]]) -> List[dict]:
+    """
+    Merge the bundle entries of multiple partitions. Resources returned by more than one partition are only added
+    once, e.g. resources included via _include/_revinclude or resources with a partial date (`2020`) overlapping the
+    ranges of two partitions.
+
+    Args:
+        partition_entries: list of bundle entries for each partition
+
+    Returns:
+        merged list of bundle entries
+    """
+    entries = []
+    added = set()
+    for partition in partition_entries:
+        for entry in partition:
+            resource = entry.get("resource") or {}
+            mode = (entry.get("search") or {}).get("mode")
+            key = (mode, resource.get("resourceType"), resource.get("id"))
+            if key in added:
+                continue
+            added.add(key)
+            entries.append(entry)
+    return entries
+
+
+def _parse_partition_datetime(value: str) -> datetime:
+    if len(value) <= 10:
+        # year (2020) and year-month (2020-05) precision start at the first day of the period
+        padded = value + "-01-01"[len(value) - 4 :] if len(value) < 10 else value
+        parsed = datetime.combine(date.fromisoformat(padded), datetime.min.time())
+    else:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def _format_partition_datetime(timestamp: float, date_only: bool = False) -> str:
+    value = datetime.fromtimestamp(timestamp, tz=timezone.utc)
+    if date_only:
+        return value.date().isoformat()
+    # use the Z suffix to avoid the + of the offset being decoded as a space in the query url
+    return value.strftime("%Y-%m-%dT%H:%M:%S.") + f"{value.microsecond // 1000:03d}Z"
@@ -1,4 +1,6 @@
-from typing import Any, Callable, List, Union
+import asyncio
+import contextlib
+from typing import Any, AsyncIterator, Callable, List, Union
 
 import fhir.resources
 import httpx
@@ -66,6 +68,7 @@ class FhirQueryAsync(FhirQueryBase):
             Callable[[List[FHIRAbstractModel]], Any], Callable[[], Any], None
         ] = None,
         count: int = None,
+        prefetch: int = None,
     ) -> QueryResponse:
         """
         Execute the query and return all results matching the query parameters.
@@ -73,6 +76,8 @@ class FhirQueryAsync(FhirQueryBase):
         Args:
             page_callback: if this argument is set the given callback function will be called for each page of results
             count: number of results in a page, default value of 50 is used when page_callback is set but no count is
+            prefetch: if set, the next pages are requested while the current page is being processed, with at most
+                this number of pages buffered ahead of the processing
         Returns:
             QueryResponse object containing all resources matching the query, as well os optional included
             resources.
@@ -80,7 +85,9 @@ class FhirQueryAsync(FhirQueryBase):
         """
         self._limit = None
         self._count = count
-        response = await self._execute_query(page_callback=page_callback, count=count)
+        response = await self._execute_query(
+            page_callback=page_callback, count=count, prefetch=prefetch
+        )
         return response
 
     async def limit(
@@ -90,6 +97,7 @@ class FhirQueryAsync(FhirQueryBase):
             Callable[[List[FHIRAbstractModel]], Any], Callable[[], Any], None
         ] = None,
         count: int = None,
+        prefetch: int = None,
     ) -> QueryResponse:
         """
         Execute the query and return the first n results matching the query parameters.
@@ -97,6 +105,8 @@ class FhirQueryAsync(FhirQueryBase):
             n: number of resources to return
             page_callback: if this argument is set the given callback function will be called for each page of results
             count: number of results in a page, default value of 50 is used when page_callback is set but no count is
+            prefetch: if set, the next pages are requested while the current page is being processed, with at most
+                this number of pages buffered ahead of the processing
 
         Returns:
             QueryResponse object containing the first n resources matching the query, as well os optional included
@@ -105,7 +115,9 @@ class FhirQueryAsync(FhirQueryBase):
         """
         self._limit = n
         self._count = count
-        response = await self._execute_query(page_callback=page_callback, count=count)
+        response = await self._execute_query(
+            page_callback=page_callback, count=count, prefetch=prefetch
+        )
         return response
 
     async def first(self) -> QueryResponse:
@@ -119,6 +131,186 @@ class FhirQueryAsync(FhirQueryBase):
         response = await self._execute_query(count=1)
         return response
 
+    async def iter_pages(
+        self,
+        count: int = None,
+        limit: int = None,
+        parse: bool = False,
+        prefetch: int = None,
+    ) -> AsyncIterator[List[Union[dict, FHIRAbstractModel]]]:
+        """
+        Execute the query and asynchronously yield the resources of each page of results as soon as it is received.
+        Only a single page is kept in memory at a time, independent of the total number of results.
+
+        Args:
+            count: number of results in a page
+            limit: maximum number of resources to return
+            parse: whether to parse the resources into fhir resource models, otherwise the resources are returned
+                as dictionaries
+            prefetch: if set, the next pages are requested while the current page is being consumed, with at most
+                this number of pages buffered ahead of the consumer
+
+        Returns:
+            Async iterator over the list of resources contained in each page
+        """
+        url = self._setup_stream(count=count, limit=limit)
+        n_streamed = 0
+        pages = self._iter_json_pages(url, prefetch)
+        try:
+            async for page in pages:
+                resources, next_url = self._process_stream_page(page, n_streamed, parse)
+                if resources:
+                    n_streamed += len(resources)
+                    yield resources
+                if not next_url:
+                    break
+        finally:
+            await pages.aclose()
+
+    async def iter_bundles(
+        self, count: int = None, prefetch: int = None
+    ) -> AsyncIterator[dict]:
+        """
+        Execute the query and asynchronously yield each page of results as the searchset bundle returned by the
+        server, including the entries of included resources and OperationOutcomes. Only a single page, plus at most
+        prefetch pages buffered ahead, is kept in memory at a time.
+
+        Args:
+            count: number of results in a page
+            prefetch: if set, the next pages are requested while the current page is being consumed, with at most
+                this number of pages buffered ahead of the consumer
+
+        Returns:
+            Async iterator over the bundles of the pages as dictionaries
+        """
+        pages = self._iter_json_pages(self._setup_stream(count=count), prefetch)
+        try:
+            async for page in pages:
+                yield page
+        finally:
+            await pages.aclose()
+
+    async def iter_resources(
+        self,
+        count: int = None,
+        limit: int = None,
+        parse: bool = False,
+        prefetch: int = None,
+    ) -> AsyncIterator[Union[dict, FHIRAbstractModel]]:
+        """
+        Execute the query and asynchronously yield the resources matching the query one at a time, fetching the
+        pages of results as needed.
+
+        Args:
+            count: number of results in a page
+            limit: maximum number of resources to return
+            parse: whether to parse the resources into fhir resource models, otherwise the resources are returned
+                as dictionaries
+            prefetch: if set, the next pages are requested while the current page is being consumed, with at most
+                this number of pages buffered ahead of the consumer
+
+        Returns:
+            Async iterator over the resources matching the query
+        """
+        async for page in self.iter_pages(
+            count=count, limit=limit, parse=parse, prefetch=prefetch
+        ):
+            for resource in page:
+                yield resource
+
+    async def partitioned(
+        self,
+        field: str = "_lastUpdated",
+        partitions: int = 4,
+        count: int = None,
+        page_callback: Union[
+            Callable[[List[FHIRAbstractModel]], Any], Callable[[], Any], None
+        ] = None,
+    ) -> QueryResponse:
+        """
+        Execute the query split into disjoint ranges of a date or numeric search parameter. The ranges are determined
+        by querying the smallest and largest value of the field and the partitions are queried concurrently.
+
+        Args:
+            field: the search parameter to partition on, defaults to `_lastUpdated`
+            partitions: the number of partitions to query concurrently
+            count: number of results in a page
+            page_callback: if this argument is set the given callback function will be called for each page of results
+        Returns:
+            QueryResponse object containing all resources matching the query, as well as optional included
+            resources.
+        """
+        queries = await self._make_partitions(field, partitions)
+        responses = await asyncio.gather(
+            *[query.all(page_callback=page_callback, count=count) for query in queries]
+        )
+        return self._merge_partition_responses(list(responses), count)
+
+    async def iter_partitioned(
+        self,
+        field: str = "_lastUpdated",
+        partitions: int = 4,
+        count: int = None,
+        parse: bool = False,
+    ) -> AsyncIterator[List[Union[dict, FHIRAbstractModel]]]:
+        """
+        Execute the query split into disjoint ranges of a date or numeric search parameter and yield the pages of all
+        partitions in the order they are received. Resources included via `_include`/`_revinclude` or resources with a
+        partial date overlapping two ranges can be yielded by more than one partition.
+
+        Args:
+            field: the search parameter to partition on, defaults to `_lastUpdated`
+            partitions: the number of partitions to query concurrently
+            count: number of results in a page
+            parse: whether to parse the resources into fhir resource models, otherwise the resources are returned
+                as dictionaries
+
+        Returns:
+            Async iterator over the list of resources contained in each page
+        """
+        queries = await self._make_partitions(field, partitions)
+        # at most one page per partition is buffered
+        queue = asyncio.Queue(maxsize=len(queries))
+
+        async def stream_partition(query: FhirQueryAsync):
+            try:
+                async for page in query.iter_pages(count=count, parse=parse):
+                    await queue.put(page)
+            except Exception as e:
+                await queue.put(e)
+                return
+            await queue.put(None)
+
+        tasks = [asyncio.create_task(stream_partition(query)) for query in queries]
+        try:
+            n_finished = 0
+            while n_finished < len(tasks):
+                page = await queue.get()
+                if page is None:
+                    n_finished += 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield page
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _make_partitions(
+        self, field: str, partitions: int
+    ) -> List["FhirQueryAsync"]:
+        probe = self._partition_probe(field)
+        total = await self._copy_query().count()
+        if partitions <= 1 or total <= 1:
+            return [self._copy_query()]
+        first_response, last_response = await asyncio.gather(
+            probe.first(), self._partition_probe(field, descending=True).first()
+        )
+        return self._partition_queries(
+            field, min(partitions, total), first_response, last_response
+        )
+
     async def count(self) -> int:
         """
         Return the number of resources matching the query parameters.
@@ -142,12 +334,121 @@ class FhirQueryAsync(FhirQueryBase):
             Callable[[List[FHIRAbstractModel]], Any], Callable[[], Any], None
         ] = None,
         count: int = None,
+        prefetch: int = None,
     ) -> QueryResponse:
+        if prefetch and self.output_format == OutputFormats.JSON:
+            response = await self._resolve_json_pagination_prefetch(
+                page_callback, prefetch
+            )
+            return QueryResponse(
+                response=response,
+                query_params=self.query_parameters,
+                count=count,
+                limit=self._limit,
+                output_format=self.output_format,
+            )
+
         r = await self.client.get(self.query_url)
         r.raise_for_status()
         response = await self._resolve_response_pagination(r, page_callback, count)
         return response
 
+    async def _resolve_json_pagination_prefetch(
+        self,
+        page_callback: Union[
+            Callable[[List[FHIRAbstractModel]], Any], Callable[[], Any], None
+        ] = None,
+        prefetch: int = 1,
+    ) -> dict:
+        """
+        Resolve the pagination of a json query while requesting the next pages in the background.
+
+        Args:
+            page_callback: callback function called with the entries of each page
+            prefetch: maximum number of pages to buffer ahead of the processing
+
+        Returns:
+            the first page of the response with the entries of all pages
+        """
+        response_json = None
+        entries = []
+        pages = self._iter_json_pages(self.query_url, prefetch)
+        try:
+            async for page in pages:
+                if response_json is None:
+                    response_json = page
+                page_entries = page.get("entry") or []
+                if self._limit:
+                    page_entries = page_entries[: self._limit - len(entries)]
+                if page_entries:
+                    entries.extend(page_entries)
+                    self._execute_callback(page_entries, page_callback)
+                if self._limit and len(entries) >= self._limit:
+                    break
+        finally:
+            # stop prefetching pages that are no longer needed
+            await pages.aclose()
+
+        if not entries:
+            self.status_code = ResponseStatusCodes.NOT_FOUND
+            return response_json
+        self.status_code = ResponseStatusCodes.OK
+        response_json["entry"] = entries
+        return response_json
+
+    async def _iter_json_pages(
+        self, url: str, prefetch: int = None
+    ) -> AsyncIterator[dict]:
+        """
+        Iterate over the json pages of a search starting at the given url. If prefetch is set, the pages are requested
+        by a background task that runs at most prefetch pages ahead of the consumer.
+
+        Args:
+            url: url of the first page
+            prefetch: maximum number of pages to buffer ahead of the consumer
+
+        Returns:
+            Async iterator over the decoded pages
+        """
+        if not prefetch:
+            while url:
+                r = await self.client.get(url)
+                r.raise_for_status()
+                page = orjson.loads(r.content)
+                url = self._next_page_url(page)
+                yield page
+            return
+
+        # the bounded queue provides the backpressure for the background requests
+        queue = asyncio.Queue(maxsize=prefetch)
+
+        async def fetch_pages(next_url: str):
+            try:
+                while next_url:
+                    r = await self.client.get(next_url)
+                    r.raise_for_status()
+                    page = orjson.loads(r.content)
+                    next_url = self._next_page_url(page)
+                    await queue.put(page)
+            except Exception as e:
+                await queue.put(e)
+                return
+            await queue.put(None)
+
+        fetch_task = asyncio.create_task(fetch_pages(url))
+        try:
+            while True:
+                page = await queue.get()
+                if page is None:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                yield page
+        finally:
+            fetch_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await fetch_task
+
     async def _resolve_response_pagination(
         self,
         initial_response: httpx.Response,
@@ -1,14 +1,16 @@
 import pathlib
+from collections.abc import Sequence
 from enum import Enum
-from typing import Dict, List, Optional, Union
+from typing import Dict, Iterator, List, Optional, Union
 
 import httpx
 import orjson
-from fhir.resources import FHIRAbstractModel
+from fhir.resources import FHIRAbstractModel, construct_fhir_element
 from fhir.resources.bundle import Bundle
 from pydantic import BaseModel
 
 from fhir_kindling.fhir_query.query_parameters import FhirQueryParameters
+from fhir_kindling.util.resources import construct_resource
 
 
 class OutputFormats(Enum):
@@ -34,6 +36,78 @@ class IncludedResources(BaseModel):
     resources: Optional[List[FHIRAbstractModel]] = None
 
 
+class LazyResourceList(Sequence):
+    """
+    Sequence of resources that are kept as dictionaries and only parsed into FHIR resource models when they are
+    accessed by index, slice or iteration. Parsed resources are cached.
+    """
+
+    def __init__(self, resources: List[dict], validate: bool = True):
+        """
+        Args:
+            resources: the resources as dictionaries
+            validate: whether to validate the resources when accessing them, otherwise unvalidated models are created
+                with `construct`
+        """
+        self._resources = resources
+        self._parsed: Dict[int, FHIRAbstractModel] = {}
+        self.validate = validate
+
+    def __len__(self) -> int:
+        return len(self._resources)
+
+    def __getitem__(
+        self, index: Union[int, slice]
+    ) -> Union[FHIRAbstractModel, List[FHIRAbstractModel]]:
+        if isinstance(index, slice):
+            return [self._parse(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("resource index out of range")
+        return self._parse(index)
+
+    def __iter__(self) -> Iterator[FHIRAbstractModel]:
+        for i in range(len(self)):
+            yield self._parse(i)
+
+    @property
+    def dicts(self) -> List[dict]:
+        """
+        The resources as dictionaries, without parsing them.
+        """
+        return self._resources
+
+    def construct(self, index: int) -> FHIRAbstractModel:
+        """
+        Create an unvalidated model for the resource at the given index, independent of the validate setting.
+
+        Args:
+            index: index of the resource
+
+        Returns:
+            resource model created with `construct`
+        """
+        return construct_resource(self._resources[index])
+
+    def _parse(self, index: int) -> FHIRAbstractModel:
+        resource = self._parsed.get(index)
+        if resource is None:
+            raw = self._resources[index]
+            if self.validate:
+                resource = construct_fhir_element(raw["resourceType"], raw)
+            else:
+                resource = construct_resource(raw)
+            self._parsed[index] = resource
+        return resource
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__}(n={len(self)}, parsed={len(self._parsed)}, "
+            f"validate={self.validate})>"
+        )
+
+
 class ResponseStatusCodes(str, Enum):
     OK = 200
     CREATED = 201
@@ -61,6 +135,7 @@ class QueryResponse:
         self.resource = query_params.resource
         self._resources = None
         self._included_resources = {}
+        self._lazy_resources = None
         self._bundle = None
         self.status_code: ResponseStatusCodes = None
         self.count = count
@@ -87,6 +162,52 @@ class QueryResponse:
                 self._extract_resources()
             return self._resources
 
+    @property
+    def lazy_resources(self) -> LazyResourceList:
+        """
+        Primary resources returned by the server, which are only validated and parsed into resource models when
+        they are accessed. Use this instead of `resources` to quickly access single resources of large responses.
+
+        Returns:
+            LazyResourceList of the primary resources
+        """
+        if self.format == OutputFormats.XML:
+            raise NotImplementedError("Resource parsing not supported for xml format")
+        if self._lazy_resources is None:
+            self._lazy_resources = LazyResourceList(self.resource_dicts)
+        return self._lazy_resources
+
+    @property
+    def resource_dicts(self) -> List[dict]:
+        """
+        Primary resources returned by the server as dictionaries, without parsing or validating them.
+
+        Returns:
+            List of resource dictionaries
+        """
+        if self.format == OutputFormats.XML:
+            raise NotImplementedError("Resource parsing not supported for xml format")
+        return [
+            entry["resource"]
+            for entry in self.response.get("entry") or []
+            if entry.get("resource", {}).get("resourceType") == self.resource
+        ]
+
+    def iter_resources(self, validate: bool = True) -> Iterator[FHIRAbstractModel]:
+        """
+        Iterate over the primary resources, parsing each resource only when it is reached.
+
+        Args:
+            validate: whether to validate the resources, otherwise unvalidated models are created with `construct`
+
+        Returns:
+            Iterator over the primary resources
+        """
+        if validate:
+            yield from self.lazy_resources
+        else:
+            yield from LazyResourceList(self.resource_dicts, validate=False)
+
     @property
     def included_resources(self) -> List[IncludedResources]:
         """
@@ -124,7 +245,7 @@ class QueryResponse:
             List of FHIRResourceModel objects returned by the server.
 
         """
-        resources = self.resources
+        resources = list(self.resources)
         for included in self.included_resources:
             resources.extend(included.resources)
         return resources
@@ -171,6 +292,56 @@ class QueryResponse:
                 # dump the response as json using orjson and indent 2
                 f.write(orjson.dumps(self.response, option=orjson.OPT_INDENT_2))
 
+    def to_arrow(self, max_depth: int = 3) -> "pyarrow.Table":  # noqa: F821
+        """
+        Convert the primary resources into an arrow table with a stable schema inferred from the resource model.
+        Requires pyarrow to be installed.
+
+        Args:
+            max_depth: the maximum depth of nested structs, deeper elements are stored as json strings
+
+        Returns:
+            Arrow table with a row for each resource
+        """
+        from fhir_kindling.serde.arrow import resources_to_arrow
+
+        return resources_to_arrow(
+            self.resource_dicts, resource_type=self.resource, max_depth=max_depth
+        )
+
+    def to_parquet(
+        self,
+        file_path: Union[str, pathlib.Path],
+        max_depth: int = 3,
+        batch_size: int = 10000,
+        compression: str = "snappy",
+    ) -> None:
+        """
+        Write the primary resources to a parquet file in record batches. Requires pyarrow to be installed.
+
+        Args:
+            file_path: path of the parquet file
+            max_depth: the maximum depth of nested structs, deeper elements are stored as json strings
+            batch_size: number of resources per record batch
+            compression: compression codec used for the file
+
+        Returns:
+            None
+        """
+        from fhir_kindling.serde.arrow import pages_to_parquet
+
+        resources = self.resource_dicts
+        pages_to_parquet(
+            (
+                resources[i : i + batch_size]
+                for i in range(0, len(resources), batch_size)
+            ),
+            file_path,
+            resource_type=self.resource,
+            max_depth=max_depth,
+            compression=compression,
+        )
+
     def _extract_resources(self):
         """
         Parse the resources from the server response bundle. Split into included resources and resources that match the
@@ -218,7 +389,7 @@ class QueryResponse:
         # otherwise, resolve json pagination and process further according to selected outcome
         else:
             if isinstance(response, httpx.Response):
-                response = response.json()
+                response = orjson.loads(response.content)
             elif isinstance(response, str):
                 response = Bundle.parse_raw(response).dict()
 
@@ -233,4 +404,6 @@ class QueryResponse:
                 f"<QueryResponse(resource={self.resource}, format=json, "
                 f"included_resources={resources})>"
             )
-        return f"<QueryResponse(resource={self.resource}, n={len(self.resources)})>"
+        return (
+            f"<QueryResponse(resource={self.resource}, n={len(self.resource_dicts)})>"
+        )
@@ -1,4 +1,5 @@
-from typing import Any, Callable, List, Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterator, List, Union
 
 import fhir.resources
 import httpx
@@ -116,6 +117,115 @@ class FhirQuerySync(FhirQueryBase):
         self._limit = 1
         return self._execute_query()
 
+    def iter_pages(
+        self, count: int = None, limit: int = None, parse: bool = False
+    ) -> Iterator[List[Union[dict, FHIRAbstractModel]]]:
+        """
+        Execute the query and yield the resources of each page of results as soon as it is received. Only a single
+        page is kept in memory at a time, independent of the total number of results.
+
+        Args:
+            count: number of results in a page
+            limit: maximum number of resources to return
+            parse: whether to parse the resources into fhir resource models, otherwise the resources are returned
+                as dictionaries
+
+        Returns:
+            Iterator over the list of resources contained in each page
+        """
+        url = self._setup_stream(count=count, limit=limit)
+        n_streamed = 0
+        while url:
+            r = self.client.get(url)
+            r.raise_for_status()
+            page = orjson.loads(r.content)
+            resources, url = self._process_stream_page(page, n_streamed, parse)
+            if resources:
+                n_streamed += len(resources)
+                yield resources
+
+    def iter_bundles(self, count: int = None) -> Iterator[dict]:
+        """
+        Execute the query and yield each page of results as the searchset bundle returned by the server, including
+        the entries of included resources and OperationOutcomes. Only a single page is kept in memory at a time.
+
+        Args:
+            count: number of results in a page
+
+        Returns:
+            Iterator over the bundles of the pages as dictionaries
+        """
+        url = self._setup_stream(count=count)
+        while url:
+            r = self.client.get(url)
+            r.raise_for_status()
+            page = orjson.loads(r.content)
+            url = self._next_page_url(page)
+            yield page
+
+    def iter_resources(
+        self, count: int = None, limit: int = None, parse: bool = False
+    ) -> Iterator[Union[dict, FHIRAbstractModel]]:
+        """
+        Execute the query and yield the resources matching the query one at a time, fetching the pages of results
+        as needed.
+
+        Args:
+            count: number of results in a page
+            limit: maximum number of resources to return
+            parse: whether to parse the resources into fhir resource models, otherwise the resources are returned
+                as dictionaries
+
+        Returns:
+            Iterator over the resources matching the query
+        """
+        for page in self.iter_pages(count=count, limit=limit, parse=parse):
+            yield from page
+
+    def partitioned(
+        self,
+        field: str = "_lastUpdated",
+        partitions: int = 4,
+        count: int = None,
+        page_callback: Union[
+            Callable[[List[FHIRAbstractModel]], Any], Callable[[], Any], None
+        ] = None,
+    ) -> QueryResponse:
+        """
+        Execute the query split into disjoint ranges of a date or numeric search parameter. The ranges are determined
+        by querying the smallest and largest value of the field and the partitions are queried in parallel.
+
+        Args:
+            field: the search parameter to partition on, defaults to `_lastUpdated`
+            partitions: the number of partitions to query in parallel
+            count: number of results in a page
+            page_callback: if this argument is set the given callback function will be called for each page of
+                results, the callback is called from the worker threads of the partitions
+        Returns:
+            QueryResponse object containing all resources matching the query, as well as optional included
+            resources.
+        """
+        queries = self._make_partitions(field, partitions)
+        with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+            responses = list(
+                executor.map(
+                    lambda query: query.all(page_callback=page_callback, count=count),
+                    queries,
+                )
+            )
+        return self._merge_partition_responses(responses, count)
+
+    def _make_partitions(self, field: str, partitions: int) -> List["FhirQuerySync"]:
+        probe = self._partition_probe(field)
+        total = self._copy_query().count()
+        if partitions <= 1 or total <= 1:
+            return [self._copy_query()]
+        first_response = probe.first()
+        last_response = self._partition_probe(field, descending=True).first()
+        return self._partition_queries(
+            field, min(partitions, total), first_response, last_response
+        )
+
     def count(self) -> int:
         self._count = 0
         response = self.client.get(self._make_query_string() + "&_summary=count")
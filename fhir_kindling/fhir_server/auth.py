@@ -1,9 +1,14 @@
+import asyncio
 import datetime
 import os
+import threading
+from concurrent.futures import Future
 from typing import Tuple, Union
 
 import httpx
 
+TOKEN_REQUEST_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+
 
 def load_environment_auth_vars() -> tuple:
     """Attempts to load authentication information from environment variables if none is given, looks for a username
@@ -20,7 +25,17 @@ def load_environment_auth_vars() -> tuple:
     return username, password, token
 
 
-class OIDCAuth:
+class OIDCAuth(httpx.Auth):
+    """
+    Authenticates requests with an access token of an OIDC provider obtained via the client credentials grant. The
+    token is cached and shared by all clients, threads and event loops using the auth object. It is refreshed
+    `refresh_margin` seconds before it expires and when the server rejects it with 401, using the refresh token if
+    the provider issued one.
+    """
+
+    # the request is sent again with a new token if the server responds with 401
+    requires_request_body = True
+
     expires_at: Union[datetime.datetime, None]
     access_token: Union[str, None]
     refresh_token: Union[str, None]
@@ -34,39 +49,188 @@ class OIDCAuth:
         client_id: str,
         client_secret: str,
         oidc_provider_url: str,
+        refresh_margin: float = 30,
     ):
+        """
+        Args:
+            client_id: client id for the OIDC provider
+            client_secret: client secret for the OIDC provider
+            oidc_provider_url: token endpoint of the OIDC provider
+            refresh_margin: time in seconds before the expiry of the token at which it is refreshed
+        """
         self.client_id = client_id
         self.client_secret = client_secret
         self.oidc_provider_url = oidc_provider_url
+        self.refresh_margin = refresh_margin
         self.expires_at = None
+        self.access_token = None
+        self.refresh_token = None
+        self.token_type = None
+        # number of tokens requested from the provider
+        self.n_refreshes = 0
+        # guards the token state, threads and tasks of any event loop wait for the refresh that is in progress
+        self._lock = threading.Lock()
+        self._refresh: Union[Future, None] = None
+
+    def sync_auth_flow(self, request: httpx.Request):
+        token = self.get_token()
+        request.headers["Authorization"] = f"Bearer {token}"
+        response = yield request
+        if response.status_code == httpx.codes.UNAUTHORIZED:
+            token = self.get_token(rejected_token=token)
+            request.headers["Authorization"] = f"Bearer {token}"
+            yield request
+
+    async def async_auth_flow(self, request: httpx.Request):
+        token = await self.get_token_async()
+        request.headers["Authorization"] = f"Bearer {token}"
+        response = yield request
+        if response.status_code == httpx.codes.UNAUTHORIZED:
+            token = await self.get_token_async(rejected_token=token)
+            request.headers["Authorization"] = f"Bearer {token}"
+            yield request
+
+    def get_token(self, rejected_token: str = None) -> str:
+        """
+        Get the cached access token, refreshing it if it is about to expire or was rejected by the server.
+
+        Args:
+            rejected_token: token the server responded to with 401, refreshed unless another thread already did
+
+        Returns:
+            the access token
+        """
+        with self._lock:
+            if not self._needs_refresh(rejected_token):
+                return self.access_token
+            refresh, started = self._join_refresh()
+        if started:
+            self._run_refresh(refresh)
+        return refresh.result()
+
+    async def get_token_async(self, rejected_token: str = None) -> str:
+        """
+        Asynchronously get the cached access token, see `get_token`.
+        """
+        with self._lock:
+            if not self._needs_refresh(rejected_token):
+                return self.access_token
+            refresh, started = self._join_refresh()
+        if started:
+            await self._run_refresh_async(refresh)
+        return await asyncio.wrap_future(refresh)
+
+    def refresh(self) -> str:
+        """
+        Request a new token, with the refresh token if available and otherwise with the client credentials. If
+        another thread or task is already refreshing the token, its result is used.
+        """
+        with self._lock:
+            refresh, started = self._join_refresh()
+        if started:
+            self._run_refresh(refresh)
+        return refresh.result()
+
+    async def refresh_async(self) -> str:
+        """
+        Asynchronously request a new token, see `refresh`.
+        """
+        with self._lock:
+            refresh, started = self._join_refresh()
+        if started:
+            await self._run_refresh_async(refresh)
+        return await asyncio.wrap_future(refresh)
+
+    def _join_refresh(self) -> Tuple[Future, bool]:
+        # called with the lock held, only one refresh is sent at a time so a rotated refresh token is used once
+        if self._refresh is not None:
+            return self._refresh, False
+        self._refresh = Future()
+        return self._refresh, True
+
+    def _run_refresh(self, refresh: Future):
+        # the token request is sent without holding the lock, other threads wait for the result of the refresh
+        try:
+            response = None
+            if self.refresh_token:
+                response = httpx.post(
+                    self.oidc_provider_url,
+                    data=self._token_request_data(use_refresh_token=True),
+                    headers=TOKEN_REQUEST_HEADERS,
+                )
+            if response is None or not response.is_success:
+                response = httpx.post(
+                    self.oidc_provider_url,
+                    data=self._token_request_data(),
+                    headers=TOKEN_REQUEST_HEADERS,
+                )
+                response.raise_for_status()
+        except BaseException as e:
+            self._finish_refresh(refresh, error=e)
+            raise
+        self._finish_refresh(refresh, response.json())
+
+    async def _run_refresh_async(self, refresh: Future):
+        try:
+            async with httpx.AsyncClient() as client:
+                response = None
+                if self.refresh_token:
+                    response = await client.post(
+                        self.oidc_provider_url,
+                        data=self._token_request_data(use_refresh_token=True),
+                        headers=TOKEN_REQUEST_HEADERS,
+                    )
+                if response is None or not response.is_success:
+                    response = await client.post(
+                        self.oidc_provider_url,
+                        data=self._token_request_data(),
+                        headers=TOKEN_REQUEST_HEADERS,
+                    )
+            response.raise_for_status()
+        except BaseException as e:
+            self._finish_refresh(refresh, error=e)
+            raise
+        self._finish_refresh(refresh, response.json())
+
+    def _finish_refresh(
+        self, refresh: Future, response_dict: dict = None, error: BaseException = None
+    ):
+        with self._lock:
+            self._refresh = None
+            if error is None:
+                self._parse_response_dict(response_dict)
+            token = self.access_token
+        if error is not None:
+            refresh.set_exception(error)
+        else:
+            refresh.set_result(token)
 
-    def get_token(self):
-        if self.is_expired() or not self.access_token:
-            self.refresh()
-        return self.access_token
-
-    def refresh(self):
-        response = httpx.post(
-            self.oidc_provider_url,
-            data={
-                "grant_type": "client_credentials",
-                "client_id": self.client_id,
-                "client_secret": self.client_secret,
-            },
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-        )
-
-        response.raise_for_status()
-        self._parse_response_dict(response.json())
+    def _token_request_data(self, use_refresh_token: bool = False) -> dict:
+        data = {"client_id": self.client_id, "client_secret": self.client_secret}
+        if use_refresh_token:
+            data.update(grant_type="refresh_token", refresh_token=self.refresh_token)
+        else:
+            data["grant_type"] = "client_credentials"
+        return data
 
     def _parse_response_dict(self, response_dict: dict):
+        self.n_refreshes += 1
         self.expires_at = datetime.datetime.now() + datetime.timedelta(
             seconds=response_dict["expires_in"]
         )
         self.access_token = response_dict["access_token"]
-        self.refresh_token = response_dict.get("refresh_token", None)
+        # providers may omit the refresh token when refreshing, the previous one stays valid
+        self.refresh_token = response_dict.get("refresh_token", self.refresh_token)
         self.token_type = response_dict["token_type"]
 
+    def _needs_refresh(self, rejected_token: str = None) -> bool:
+        if not self.access_token or not self.expires_at:
+            return True
+        if rejected_token is not None and rejected_token == self.access_token:
+            return True
+        margin = datetime.timedelta(seconds=self.refresh_margin)
+        return datetime.datetime.now() + margin >= self.expires_at
+
     def is_expired(self) -> bool:
         if not self.expires_at:
             return True
@@ -0,0 +1,148 @@
+from typing import List, Union
+
+# status codes indicating that a bundle was too large to be processed by the server
+SPLIT_STATUS_CODES = frozenset([413])
+# status codes indicating that the server took too long to process a bundle
+TIMEOUT_STATUS_CODES = frozenset([408, 504])
+
+
+class BatchSizer:
+    """
+    Chooses the number of resources uploaded in one bundle. With a fixed size, bundles are only split when the server
+    rejects them as too large (413). Adaptive sizing uses additive increase / multiplicative decrease (AIMD): the size
+    grows by a constant step after every bundle that was processed faster than the target latency and is cut by the
+    decrease factor after slow bundles, timeouts or bundles rejected as too large.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = 1000,
+        adaptive: bool = False,
+        min_size: int = 1,
+        max_size: int = 10000,
+        target_latency: float = 10.0,
+        increase_step: int = None,
+        decrease_factor: float = 0.5,
+    ):
+        """
+        Args:
+            batch_size: the initial number of resources per bundle
+            adaptive: whether to adapt the size to the observed latency of the server
+            min_size: the smallest size a bundle can be reduced to
+            max_size: the largest size a bundle can be increased to
+            target_latency: bundles that take longer than this many seconds decrease the size
+            increase_step: number of resources added after a fast bundle, defaults to 10% of the initial size
+            decrease_factor: factor the size is multiplied with after a slow or failed bundle
+        """
+        if batch_size < 1 or min_size < 1:
+            raise ValueError("Batch size must be at least 1")
+        if not 0 < decrease_factor < 1:
+            raise ValueError(
+                f"Decrease factor must be between 0 and 1, got {decrease_factor}"
+            )
+
+        self.adaptive = adaptive
+        self.min_size = min_size
+        self.max_size = max(max_size, batch_size)
+        self.target_latency = target_latency
+        self.increase_step = increase_step or max(1, batch_size // 10)
+        self.decrease_factor = decrease_factor
+        self.max_payload_bytes: Union[int, None] = None
+        self.sizes: List[int] = []
+
+        self._size = batch_size
+        self._bytes_per_resource: Union[float, None] = None
+
+    @property
+    def size(self) -> int:
+        """
+        The number of resources to put into the next bundle.
+        """
+        size = self._size
+        # stay below the payload size the server rejected as too large
+        if self.max_payload_bytes and self._bytes_per_resource:
+            size = min(
+                size, int(0.9 * self.max_payload_bytes / self._bytes_per_resource)
+            )
+        return max(self.min_size, size)
+
+    def record_success(
+        self, n_resources: int, latency: float, payload_bytes: int = None
+    ):
+        """
+        Record a successfully uploaded bundle.
+
+        Args:
+            n_resources: number of resources in the bundle
+            latency: time in seconds it took the server to process the bundle
+            payload_bytes: size of the request body
+        """
+        self.sizes.append(n_resources)
+        if payload_bytes:
+            self._update_bytes_per_resource(n_resources, payload_bytes)
+        if not self.adaptive:
+            return
+
+        if latency > self.target_latency:
+            self._decrease(n_resources)
+        # only grow if the current size was actually used, the last bundle of an upload can be smaller
+        elif n_resources >= self._size:
+            self._size = min(self.max_size, self._size + self.increase_step)
+
+    def should_split(self, status_code: int, n_resources: int) -> bool:
+        """
+        Check whether a failed bundle should be split and uploaded again in smaller parts.
+
+        Args:
+            status_code: status code of the failed request
+            n_resources: number of resources in the failed bundle
+
+        Returns:
+            True if the bundle should be split
+        """
+        if n_resources <= 1:
+            return False
+        if status_code in SPLIT_STATUS_CODES:
+            return True
+        return self.adaptive and status_code in TIMEOUT_STATUS_CODES
+
+    def record_failure(
+        self, status_code: int, n_resources: int, payload_bytes: int = None
+    ):
+        """
+        Record a bundle that was rejected as too large or timed out and will be split.
+
+        Args:
+            status_code: status code of the failed request
+            n_resources: number of resources in the failed bundle
+            payload_bytes: size of the request body
+        """
+        if payload_bytes:
+            self._update_bytes_per_resource(n_resources, payload_bytes)
+            if status_code in SPLIT_STATUS_CODES:
+                self.max_payload_bytes = min(
+                    payload_bytes - 1, self.max_payload_bytes or payload_bytes
+                )
+        self._decrease(n_resources)
+
+    def _decrease(self, n_resources: int):
+        self._size = max(
+            self.min_size,
+            int(min(self._size, n_resources) * self.decrease_factor),
+        )
+
+    def _update_bytes_per_resource(self, n_resources: int, payload_bytes: int):
+        bytes_per_resource = payload_bytes / max(n_resources, 1)
+        if self._bytes_per_resource is None:
+            self._bytes_per_resource = bytes_per_resource
+        else:
+            # exponential moving average to smooth out differences between resources
+            self._bytes_per_resource = (
+                0.8 * self._bytes_per_resource + 0.2 * bytes_per_resource
+            )
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__}(size={self.size}, adaptive={self.adaptive}, "
+            f"n_batches={len(self.sizes)})>"
+        )
@@ -0,0 +1,583 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import datetime
+import pathlib
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, AsyncIterator, Iterable, Iterator, List, Tuple, Union
+
+import httpx
+import orjson
+from fhir.resources import FHIRAbstractModel, construct_fhir_element
+from tqdm import tqdm
+
+from fhir_kindling.fhir_server.server_responses import (
+    BulkExportFile,
+    BulkExportResponse,
+    NdjsonUploadResponse,
+)
+from fhir_kindling.util.retry_transport import calculate_sleep
+
+if TYPE_CHECKING:
+    from fhir_kindling.fhir_server import FhirServer
+
+KICK_OFF_HEADERS = {"Accept": "application/fhir+json", "Prefer": "respond-async"}
+NDJSON_HEADERS = {"Accept": "application/fhir+ndjson"}
+
+NdjsonSource = Union[str, pathlib.Path, Iterable[Union[str, pathlib.Path, dict]]]
+
+
+def bulk_export(
+    server: "FhirServer",
+    resource_types: List[str] = None,
+    since: Union[str, datetime.datetime] = None,
+    type_filter: List[str] = None,
+    output_dir: Union[str, pathlib.Path] = None,
+    max_concurrency: int = 4,
+    timeout: float = None,
+) -> BulkExportResponse:
+    """
+    Start a bulk data export on the server, wait for it to complete and optionally download the exported files.
+
+    Args:
+        server: the server to export from
+        resource_types: resource types to export, defaults to all resource types
+        since: only export resources updated after this point in time
+        type_filter: FHIR search queries to filter the exported resources e.g. `Observation?status=final`
+        output_dir: if given, the exported ndjson files are downloaded into this directory
+        max_concurrency: maximum number of files downloaded at the same time
+        timeout: maximum time in seconds to wait for the export to complete
+
+    Returns:
+        BulkExportResponse containing the list of exported files
+    """
+    client = server._sync_client()
+    r = client.get(
+        _export_url(server),
+        params=_export_params(resource_types, since, type_filter),
+        headers=KICK_OFF_HEADERS,
+    )
+    status_url = _status_url_from_kick_off(r, "export")
+    manifest = _wait_for_manifest(server, status_url, timeout)
+
+    export = BulkExportResponse(manifest, status_url=status_url)
+    if output_dir:
+        output_dir = _setup_output_dir(output_dir)
+        downloads = _download_targets(export, output_dir)
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            list(
+                executor.map(
+                    lambda target: _download_file(server, export, *target), downloads
+                )
+            )
+    return export
+
+
+async def bulk_export_async(
+    server: "FhirServer",
+    resource_types: List[str] = None,
+    since: Union[str, datetime.datetime] = None,
+    type_filter: List[str] = None,
+    output_dir: Union[str, pathlib.Path] = None,
+    max_concurrency: int = 4,
+    timeout: float = None,
+) -> BulkExportResponse:
+    """
+    Asynchronously start a bulk data export on the server, wait for it to complete and optionally download the
+    exported files.
+
+    Args:
+        server: the server to export from
+        resource_types: resource types to export, defaults to all resource types
+        since: only export resources updated after this point in time
+        type_filter: FHIR search queries to filter the exported resources e.g. `Observation?status=final`
+        output_dir: if given, the exported ndjson files are downloaded into this directory
+        max_concurrency: maximum number of files downloaded at the same time
+        timeout: maximum time in seconds to wait for the export to complete
+
+    Returns:
+        BulkExportResponse containing the list of exported files
+    """
+    client = server._async_client()
+    r = await client.get(
+        _export_url(server),
+        params=_export_params(resource_types, since, type_filter),
+        headers=KICK_OFF_HEADERS,
+    )
+    status_url = _status_url_from_kick_off(r, "export")
+    manifest = await _wait_for_manifest_async(server, status_url, timeout)
+
+    export = BulkExportResponse(manifest, status_url=status_url)
+    if output_dir:
+        output_dir = _setup_output_dir(output_dir)
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def download(output: BulkExportFile, path: pathlib.Path):
+            async with semaphore:
+                await _download_file_async(server, export, output, path)
+
+        await asyncio.gather(
+            *[download(*target) for target in _download_targets(export, output_dir)]
+        )
+    return export
+
+
+def iter_export_resources(
+    server: "FhirServer", export: BulkExportResponse, parse: bool = False
+) -> Iterator[Union[dict, FHIRAbstractModel]]:
+    """
+    Stream the resources of a completed bulk export one at a time. Files that were downloaded are read from disk,
+    otherwise they are streamed from the server line by line.
+
+    Args:
+        server: the server the export was created on
+        export: the completed export
+        parse: whether to parse the resources into fhir resource models
+
+    Returns:
+        Iterator over the exported resources
+    """
+    for output in export.output:
+        if output.path:
+            with open(output.path, "rb") as f:
+                for line in f:
+                    resource = _parse_ndjson_line(line, parse)
+                    if resource is not None:
+                        yield resource
+        else:
+            with server._sync_client().stream(
+                "GET", output.url, **_file_request_kwargs(export)
+            ) as r:
+                r.raise_for_status()
+                for line in r.iter_lines():
+                    resource = _parse_ndjson_line(line, parse)
+                    if resource is not None:
+                        yield resource
+
+
+async def iter_export_resources_async(
+    server: "FhirServer",
+    export: BulkExportResponse,
+    parse: bool = False,
+    max_concurrency: int = 4,
+) -> AsyncIterator[Union[dict, FHIRAbstractModel]]:
+    """
+    Asynchronously stream the resources of a completed bulk export. Up to max_concurrency files are streamed from
+    the server at the same time and the resources are yielded in the order they are received.
+
+    Args:
+        server: the server the export was created on
+        export: the completed export
+        parse: whether to parse the resources into fhir resource models
+        max_concurrency: maximum number of files streamed at the same time
+
+    Returns:
+        Async iterator over the exported resources
+    """
+    client = server._async_client()
+    queue = asyncio.Queue(maxsize=1000)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def stream_file(output: BulkExportFile):
+        try:
+            async with semaphore:
+                await _queue_export_file_lines(client, export, output, queue)
+        except Exception as e:
+            await queue.put(e)
+            return
+        await queue.put(None)
+
+    tasks = [asyncio.create_task(stream_file(output)) for output in export.output]
+    try:
+        n_finished = 0
+        while n_finished < len(tasks):
+            line = await queue.get()
+            if line is None:
+                n_finished += 1
+            elif isinstance(line, Exception):
+                raise line
+            else:
+                resource = _parse_ndjson_line(line, parse)
+                if resource is not None:
+                    yield resource
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def add_ndjson(
+    server: "FhirServer",
+    source: NdjsonSource,
+    batch_size: int = 1000,
+    max_concurrency: int = 4,
+    use_import: bool = None,
+    timeout: float = None,
+    display: bool = True,
+    keep_references: bool = False,
+) -> NdjsonUploadResponse:
+    """
+    Upload resources from ndjson files to the server. If the files are given as urls and the server supports the bulk
+    data `$import` operation, the server loads the files itself. Otherwise, the resources are streamed from the files
+    and uploaded in batch bundles of batch_size resources, with up to max_concurrency bundles uploaded at the same time.
+    Like `$import`, the batch upload keeps the ids of the resources (`PUT {ResourceType}/{id}`), so references between
+    the resources in the files stay valid.
+
+    Args:
+        server: the server to upload to
+        source: path or url of an ndjson file, a list of paths/urls or an iterable of resource dictionaries
+        batch_size: number of resources per batch bundle
+        max_concurrency: maximum number of bundles uploaded at the same time
+        use_import: whether to use the `$import` operation, by default it is used if the source consists of urls
+            and the server supports it
+        timeout: maximum time in seconds to wait for an `$import` to complete
+        display: whether to display a progress bar for batch uploads
+        keep_references: whether to collect the references of all uploaded resources in the response, which grows
+            with the number of resources
+
+    Returns:
+        NdjsonUploadResponse with the number of uploaded resources or the `$import` manifest
+    """
+    urls = _ndjson_urls(source)
+    if use_import is None:
+        if urls:
+            if server._meta_data is None:
+                server._get_meta_data()
+            use_import = _supports_operation(server._meta_data, "import")
+        else:
+            use_import = False
+
+    if use_import:
+        if not urls:
+            raise ValueError(
+                "The $import operation requires the ndjson files to be given as urls accessible by the server"
+            )
+        r = server._sync_client().post(
+            _import_url(server),
+            content=orjson.dumps(_import_parameters(urls)),
+            headers=KICK_OFF_HEADERS,
+        )
+        status_url = _status_url_from_kick_off(r, "import")
+        manifest = _wait_for_manifest(server, status_url, timeout)
+        return NdjsonUploadResponse(import_manifest=manifest)
+
+    response = NdjsonUploadResponse(keep_references=keep_references)
+    p_bar = tqdm(desc="Uploading ndjson", unit=" resources", disable=not display)
+    # only keep a bounded number of batches in memory, the responses are processed in order of submission
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        for batch in _ndjson_batches(_iter_ndjson_source(server, source), batch_size):
+            pending.append(executor.submit(_upload_ndjson_batch, server, batch))
+            if len(pending) >= 2 * max_concurrency:
+                _process_ndjson_batch(response, pending.popleft().result(), p_bar)
+        while pending:
+            _process_ndjson_batch(response, pending.popleft().result(), p_bar)
+    p_bar.close()
+    return response
+
+
+async def _queue_export_file_lines(
+    client: httpx.AsyncClient,
+    export: BulkExportResponse,
+    output: BulkExportFile,
+    queue: asyncio.Queue,
+):
+    if output.path:
+        with open(output.path, "rb") as f:
+            for line in f:
+                await queue.put(line)
+    else:
+        async with client.stream(
+            "GET", output.url, **_file_request_kwargs(export)
+        ) as r:
+            r.raise_for_status()
+            async for line in r.aiter_lines():
+                await queue.put(line)
+
+
+def _export_url(server: "FhirServer") -> str:
+    return f"{server.api_address}/$export"
+
+
+def _import_url(server: "FhirServer") -> str:
+    return f"{server.api_address}/$import"
+
+
+def _supports_operation(metadata: dict, operation: str) -> bool:
+    for rest in metadata.get("rest", []):
+        for server_operation in rest.get("operation", []):
+            if server_operation.get("name", "").lstrip("$").lower() == operation:
+                return True
+    return False
+
+
+def _is_url(value) -> bool:
+    return isinstance(value, str) and value.startswith(("http://", "https://"))
+
+
+def _ndjson_urls(source: NdjsonSource) -> Union[List[str], None]:
+    if _is_url(source):
+        return [source]
+    # only inspect lists, other iterables could be consumable generators of resources
+    if isinstance(source, (list, tuple)) and source and all(map(_is_url, source)):
+        return list(source)
+    return None
+
+
+def _resource_type_from_url(url: str) -> str:
+    # bulk data files are named after the resource type they contain e.g. Patient_1.ndjson or Patient.ndjson
+    file_name = url.split("?")[0].rstrip("/").split("/")[-1]
+    resource_type = re.split(r"[_.\-]", file_name)[0]
+    if not re.match(r"^[A-Z][A-Za-z]+$", resource_type):
+        raise ValueError(
+            f"Could not determine the resource type of {url}, name the files {{ResourceType}}_{{n}}.ndjson"
+        )
+    return resource_type
+
+
+def _import_parameters(urls: List[str]) -> dict:
+    source = httpx.URL(urls[0])
+    parameters = [
+        {"name": "inputFormat", "valueString": "application/fhir+ndjson"},
+        {
+            "name": "inputSource",
+            "valueUri": f"{source.scheme}://{source.netloc.decode()}",
+        },
+        {"name": "storageDetail", "valueString": "https"},
+    ]
+    for url in urls:
+        parameters.append(
+            {
+                "name": "input",
+                "part": [
+                    {"name": "type", "valueString": _resource_type_from_url(url)},
+                    {"name": "url", "valueUrl": url},
+                ],
+            }
+        )
+    return {"resourceType": "Parameters", "parameter": parameters}
+
+
+def _iter_ndjson_source(server: "FhirServer", source: NdjsonSource) -> Iterator[dict]:
+    if isinstance(source, (str, pathlib.Path)):
+        source = [source]
+    for item in source:
+        if isinstance(item, dict):
+            yield item
+        elif _is_url(item):
+            with server._sync_client().stream("GET", item, headers=NDJSON_HEADERS) as r:
+                r.raise_for_status()
+                for line in r.iter_lines():
+                    resource = _parse_ndjson_line(line)
+                    if resource is not None:
+                        yield resource
+        else:
+            with open(item, "rb") as f:
+                for line in f:
+                    resource = _parse_ndjson_line(line)
+                    if resource is not None:
+                        yield resource
+
+
+def _ndjson_batches(resources: Iterator[dict], batch_size: int) -> Iterator[List[dict]]:
+    batch = []
+    for resource in resources:
+        batch.append(resource)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _ndjson_batch_bundle(resources: List[dict]) -> dict:
+    entries = []
+    for resource in resources:
+        # keep the ids like $import does, the references between the resources of the files point to them
+        if resource.get("id"):
+            request = {
+                "method": "PUT",
+                "url": f"{resource['resourceType']}/{resource['id']}",
+            }
+        else:
+            request = {"method": "POST", "url": resource["resourceType"]}
+        entries.append({"resource": resource, "request": request})
+    return {"resourceType": "Bundle", "type": "batch", "entry": entries}
+
+
+def _upload_ndjson_batch(server: "FhirServer", resources: List[dict]) -> dict:
+    r = server._sync_client().post(
+        server.api_address, content=orjson.dumps(_ndjson_batch_bundle(resources))
+    )
+    r.raise_for_status()
+    return orjson.loads(r.content)
+
+
+def _process_ndjson_batch(
+    response: NdjsonUploadResponse, batch_response: dict, p_bar: tqdm
+):
+    n_before = response.n_uploaded + len(response.errors)
+    response.add_batch_response(batch_response)
+    p_bar.update(response.n_uploaded + len(response.errors) - n_before)
+
+
+def _export_params(
+    resource_types: List[str] = None,
+    since: Union[str, datetime.datetime] = None,
+    type_filter: List[str] = None,
+) -> dict:
+    params = {}
+    if resource_types:
+        params["_type"] = ",".join(resource_types)
+    if since:
+        params["_since"] = (
+            since.isoformat() if isinstance(since, datetime.datetime) else since
+        )
+    if type_filter:
+        params["_typeFilter"] = (
+            [type_filter] if isinstance(type_filter, str) else list(type_filter)
+        )
+    return params
+
+
+def _status_url_from_kick_off(response: httpx.Response, operation: str) -> str:
+    response.raise_for_status()
+    status_url = response.headers.get("Content-Location")
+    if response.status_code != 202 or not status_url:
+        raise ValueError(
+            f"Server did not accept the bulk {operation} request, status: {response.status_code} - {response.text}"
+        )
+    return status_url
+
+
+def _wait_for_manifest(
+    server: "FhirServer", status_url: str, timeout: float = None
+) -> dict:
+    client = server._sync_client()
+    deadline = time.monotonic() + timeout if timeout else None
+    attempts = 0
+    while True:
+        r = client.get(status_url, headers={"Accept": "application/json"})
+        manifest, wait = _process_status_response(server, r, attempts, deadline)
+        if manifest is not None:
+            return manifest
+        attempts += 1
+        time.sleep(wait)
+
+
+async def _wait_for_manifest_async(
+    server: "FhirServer", status_url: str, timeout: float = None
+) -> dict:
+    client = server._async_client()
+    deadline = time.monotonic() + timeout if timeout else None
+    attempts = 0
+    while True:
+        r = await client.get(status_url, headers={"Accept": "application/json"})
+        manifest, wait = _process_status_response(server, r, attempts, deadline)
+        if manifest is not None:
+            return manifest
+        attempts += 1
+        await asyncio.sleep(wait)
+
+
+def _process_status_response(
+    server: "FhirServer",
+    response: httpx.Response,
+    attempts: int,
+    deadline: float = None,
+) -> Tuple[Union[dict, None], float]:
+    """
+    Process the response of polling the export status endpoint.
+
+    Returns:
+        the export manifest if the export is complete, otherwise None and the time to wait before polling again
+    """
+    if response.status_code == 202:
+        wait = calculate_sleep(
+            attempts + 1,
+            response.headers,
+            backoff_factor=max(server.backoff_factor, 1),
+            jitter_ratio=server.jitter_ratio,
+            max_backoff_wait=server.max_backoff_wait,
+            respect_retry_after_header=server.respect_retry_after_header,
+        )
+        if deadline and time.monotonic() + wait > deadline:
+            raise TimeoutError(
+                f"Bulk operation did not complete in time, progress: {response.headers.get('X-Progress')}"
+            )
+        return None, wait
+
+    response.raise_for_status()
+    return orjson.loads(response.content), 0
+
+
+def _setup_output_dir(output_dir: Union[str, pathlib.Path]) -> pathlib.Path:
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    return output_dir
+
+
+def _download_targets(
+    export: BulkExportResponse, output_dir: pathlib.Path
+) -> List[Tuple[BulkExportFile, pathlib.Path]]:
+    targets = []
+    type_counts = {}
+    for output in export.output:
+        n = type_counts.get(output.resource_type, 0) + 1
+        type_counts[output.resource_type] = n
+        targets.append((output, output_dir / f"{output.resource_type}_{n}.ndjson"))
+    return targets
+
+
+def _file_request_kwargs(export: BulkExportResponse) -> dict:
+    kwargs = {"headers": NDJSON_HEADERS}
+    # files that do not require an access token can be hosted elsewhere, do not send the credentials
+    if not export.requires_access_token:
+        kwargs["auth"] = None
+    return kwargs
+
+
+def _download_file(
+    server: "FhirServer",
+    export: BulkExportResponse,
+    output: BulkExportFile,
+    path: pathlib.Path,
+):
+    with server._sync_client().stream(
+        "GET", output.url, **_file_request_kwargs(export)
+    ) as r:
+        r.raise_for_status()
+        with open(path, "wb") as f:
+            for chunk in r.iter_bytes():
+                f.write(chunk)
+    output.path = path
+
+
+async def _download_file_async(
+    server: "FhirServer",
+    export: BulkExportResponse,
+    output: BulkExportFile,
+    path: pathlib.Path,
+):
+    async with server._async_client().stream(
+        "GET", output.url, **_file_request_kwargs(export)
+    ) as r:
+        r.raise_for_status()
+        with open(path, "wb") as f:
+            async for chunk in r.aiter_bytes():
+                f.write(chunk)
+    output.path = path
+
+
+def _parse_ndjson_line(
+    line: Union[str, bytes], parse: bool = False
+) -> Union[dict, FHIRAbstractModel, None]:
+    if not line.strip():
+        return None
+    resource = orjson.loads(line)
+    if parse:
+        return construct_fhir_element(resource["resourceType"], resource)
+    return resource
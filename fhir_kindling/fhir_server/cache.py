@@ -0,0 +1,267 @@
+import pathlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple, Union
+
+import httpx
+import orjson
+
+DISK_SCHEMA = """
+CREATE TABLE IF NOT EXISTS resource_cache (
+    key TEXT PRIMARY KEY, etag TEXT, resource BLOB NOT NULL, stored_at REAL NOT NULL
+);
+"""
+
+
+class CacheMetrics:
+    """
+    Counters of the requests served by a resource cache.
+    """
+
+    def __init__(self):
+        # served from the cache without a request, disk hits are counted in hits as well
+        self.hits = 0
+        self.disk_hits = 0
+        # served from the cache after the server confirmed the cached version with 304 Not Modified
+        self.revalidations = 0
+        # fetched from the server
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def requests(self) -> int:
+        return self.hits + self.revalidations + self.misses
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        Fraction of the requests that were served without transferring the resource.
+        """
+        if not self.requests:
+            return 0.0
+        return (self.hits + self.revalidations) / self.requests
+
+    def as_dict(self) -> Dict[str, Union[int, float]]:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "revalidations": self.revalidations,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hit_rate,
+        }
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__}(hits={self.hits}, revalidations={self.revalidations}, "
+            f"misses={self.misses}, hit_rate={self.hit_rate:.2f})>"
+        )
+
+
+class CacheEntry:
+    __slots__ = ("resource", "etag", "stored_at")
+
+    def __init__(self, resource: dict, etag: Optional[str], stored_at: float):
+        self.resource = resource
+        self.etag = etag
+        self.stored_at = stored_at
+
+
+class ResourceCache:
+    """
+    Read-through cache for resources requested by reference, keyed by `{ResourceType}/{id}`. Holds the most recently
+    used resources in memory and optionally all cached resources in a sqlite database on disk. Resources older than
+    the ttl are revalidated with a conditional request (`If-None-Match`) using the ETag of the response or the
+    `meta.versionId` of the resource.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1000,
+        ttl: Optional[float] = 300,
+        path: Union[str, pathlib.Path] = None,
+    ):
+        """
+        Args:
+            max_size: maximum number of resources kept in memory, the least recently used resources are evicted
+            ttl: time in seconds a cached resource is used without revalidating it, None to never revalidate
+            path: optional path of a sqlite database used as second, persistent cache tier
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = pathlib.Path(path) if path else None
+        self.metrics = CacheMetrics()
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        # the cache is shared by the threads and tasks using the same server
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+        if self.path:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.executescript(DISK_SCHEMA)
+
+    def lookup(self, key: str) -> Tuple[Optional[dict], Optional[dict]]:
+        """
+        Look up a resource in the cache.
+
+        Args:
+            key: relative reference of the resource
+
+        Returns:
+            The cached resource if it is fresh, otherwise None and the headers for a conditional request if a stale
+            version of the resource is cached
+        """
+        with self._lock:
+            entry, from_disk = self._get_entry(key)
+            if entry is None:
+                return None, None
+            if self._is_fresh(entry):
+                self.metrics.hits += 1
+                self.metrics.disk_hits += from_disk
+                return entry.resource, None
+        if entry.etag:
+            return None, {"If-None-Match": entry.etag}
+        return None, None
+
+    def process_response(self, key: str, response: httpx.Response) -> Optional[dict]:
+        """
+        Update the cache with the response of a (conditional) request for a resource.
+
+        Args:
+            key: relative reference of the resource
+            response: the response of the server
+
+        Returns:
+            The resource, from the cache if the server responded with 304 Not Modified. None if the server responded
+            with 304 Not Modified but the resource was evicted or invalidated while the request was sent, the resource
+            has to be requested again without `If-None-Match`.
+        """
+        if response.status_code == httpx.codes.NOT_MODIFIED:
+            with self._lock:
+                entry, _ = self._get_entry(key)
+                if entry is None:
+                    return None
+                self.metrics.revalidations += 1
+                self._store(key, CacheEntry(entry.resource, entry.etag, time.time()))
+            return entry.resource
+        response.raise_for_status()
+        resource = orjson.loads(response.content)
+        entry = CacheEntry(
+            resource,
+            response.headers.get("ETag") or _version_etag(resource),
+            time.time(),
+        )
+        with self._lock:
+            self.metrics.misses += 1
+            self._store(key, entry)
+        return resource
+
+    def put(self, key: str, resource: dict, etag: str = None):
+        """
+        Store a resource in the cache.
+
+        Args:
+            key: relative reference of the resource
+            resource: the resource as dictionary
+            etag: ETag of the resource, defaults to the weak ETag of the version id of the resource
+        """
+        entry = CacheEntry(resource, etag or _version_etag(resource), time.time())
+        with self._lock:
+            self._store(key, entry)
+
+    def invalidate(self, keys: Iterable[str]):
+        """
+        Remove resources from the cache, e.g. after they were updated or deleted.
+
+        Args:
+            keys: relative references of the resources
+        """
+        keys = list(keys)
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.metrics.invalidations += 1
+            if self._connection is not None:
+                with self._connection:
+                    self._connection.executemany(
+                        "DELETE FROM resource_cache WHERE key = ?",
+                        [(key,) for key in keys],
+                    )
+
+    def clear(self):
+        """
+        Remove all resources from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+            if self._connection is not None:
+                with self._connection:
+                    self._connection.execute("DELETE FROM resource_cache")
+
+    def close(self):
+        """
+        Close the database of the disk tier.
+        """
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    @property
+    def size(self) -> int:
+        """
+        Number of resources cached in memory.
+        """
+        return len(self._entries)
+
+    def _get_entry(self, key: str) -> Tuple[Optional[CacheEntry], bool]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            return entry, False
+        if self._connection is None:
+            return None, False
+        row = self._connection.execute(
+            "SELECT etag, resource, stored_at FROM resource_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None, False
+        # promote the resource to the memory tier
+        entry = CacheEntry(orjson.loads(row[1]), row[0], row[2])
+        self._entries[key] = entry
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.metrics.evictions += 1
+        return entry, True
+
+    def _store(self, key: str, entry: CacheEntry):
+        # must be called while holding the lock
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.metrics.evictions += 1
+        if self._connection is not None:
+            with self._connection:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO resource_cache (key, etag, resource, stored_at) VALUES (?, ?, ?, ?)",
+                    (key, entry.etag, orjson.dumps(entry.resource), entry.stored_at),
+                )
+
+    def _is_fresh(self, entry: CacheEntry) -> bool:
+        return self.ttl is None or time.time() - entry.stored_at < self.ttl
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__}(size={self.size}, max_size={self.max_size}, ttl={self.ttl}, "
+            f"path={self.path}, metrics={self.metrics})>"
+        )
+
+
+def _version_etag(resource: dict) -> Optional[str]:
+    version_id = (resource.get("meta") or {}).get("versionId")
+    if version_id is None:
+        return None
+    return f'W/"{version_id}"'
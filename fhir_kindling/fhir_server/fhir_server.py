@@ -1,6 +1,11 @@
+import asyncio
+import datetime
 import os
+import pathlib
 import re
-from typing import Iterable, List, Union
+import time
+import warnings
+from typing import AsyncIterator, Iterable, Iterator, List, Tuple, Union
 
 import fhir.resources
 import httpx
@@ -15,8 +20,22 @@ from tqdm import tqdm
 from fhir_kindling.fhir_query import FhirQueryAsync, FhirQuerySync
 from fhir_kindling.fhir_query.query_parameters import FhirQueryParameters
 from fhir_kindling.fhir_server.auth import BearerAuth, OIDCAuth, auth_info_from_env
+from fhir_kindling.fhir_server.batching import BatchSizer
+from fhir_kindling.fhir_server.bulk_data import (
+    NdjsonSource,
+    add_ndjson,
+    bulk_export,
+    bulk_export_async,
+    iter_export_resources,
+    iter_export_resources_async,
+)
+from fhir_kindling.fhir_server.cache import ResourceCache
+from fhir_kindling.fhir_server.get_many import get_many, get_many_async
+from fhir_kindling.fhir_server.rate_limit import RateLimiter, RateLimitTransport
 from fhir_kindling.fhir_server.server_responses import (
+    BulkExportResponse,
     BundleCreateResponse,
+    NdjsonUploadResponse,
     ResourceCreateResponse,
     TransferResponse,
 )
@@ -24,15 +43,32 @@ from fhir_kindling.fhir_server.summary import (
     ServerSummary,
     create_server_summary,
     create_server_summary_async,
+    searchable_resources,
 )
 from fhir_kindling.fhir_server.transactions import (
     TransactionMethod,
-    TransactionType,
     make_transaction_bundle,
+    make_transaction_bundle_bytes,
 )
-from fhir_kindling.fhir_server.transfer import transfer
+from fhir_kindling.fhir_server.transfer import transfer, transfer_async
 from fhir_kindling.serde.json import json_dict
-from fhir_kindling.util.retry_transport import RetryTransport
+from fhir_kindling.util.resilient_transport import (
+    CircuitBreaker,
+    HedgingPolicy,
+    ResilientTransport,
+)
+from fhir_kindling.util.retry_transport import (
+    RetryBudget,
+    RetryMetrics,
+    RetryTransport,
+    calculate_sleep,
+)
+
+# bundle uploads are only sent again if the server did not process them: it throttled or refused the request with a
+# Retry-After header or the request did not reach the server. A gateway error (502/504) can arrive after the
+# transaction was committed, resending the bundle would create its resources twice.
+BUNDLE_RETRY_STATUS_CODES = frozenset([429, 503])
+BUNDLE_RETRY_EXCEPTIONS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
 
 
 class FhirServer:
@@ -57,6 +93,17 @@ class FhirServer:
         backoff_factor: float = 0.1,
         jitter_ratio: float = 0.1,
         respect_retry_after_header: bool = True,
+        retry_deadline: Union[float, None] = None,
+        retry_budget: Union[RetryBudget, None] = None,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 5.0,
+        http2: bool = False,
+        cache: Union[ResourceCache, bool, None] = None,
+        rate_limiter: Union[RateLimiter, None] = None,
+        circuit_breaker: Union[CircuitBreaker, bool, None] = None,
+        hedging: Union[HedgingPolicy, bool, None] = None,
+        transport: Union[httpx.BaseTransport, httpx.AsyncBaseTransport, None] = None,
     ):
         """
         Initialize a FHIR server connection
@@ -76,6 +123,21 @@ class FhirServer:
             retry_status_codes: optional list of status codes to retry on
             max_atttempts: optional number of times to retry
             retry_wait: optional number of seconds to wait between retries
+            retry_deadline: optional maximum time in seconds from the first attempt of a request until its last retry
+            retry_budget: optional budget limiting the retries of all requests of the server
+            max_connections: maximum number of concurrent connections in the connection pools
+            max_keepalive_connections: maximum number of idle connections kept alive in the connection pools
+            keepalive_expiry: time in seconds after which idle keep-alive connections are closed
+            http2: whether to enable HTTP/2 for the connection pools, requires the `h2` package
+            cache: optional cache for resources requested with `get`, True to use a ResourceCache with default
+                settings
+            rate_limiter: optional limit of the request rate and the requests in flight, shared by all requests of the
+                server
+            circuit_breaker: optional circuit breaker failing requests fast while the server is failing, True to use a
+                CircuitBreaker with default settings
+            hedging: optional policy for sending a duplicate of slow GET requests, True to hedge after the p95 latency
+            transport: optional transport sending the requests instead of the connection pools, e.g. an
+                `httpx.MockTransport`. It is wrapped by the rate limiting, resilience and retry transports.
         """
 
         # server definition values
@@ -104,11 +166,75 @@ class FhirServer:
         self.backoff_factor = backoff_factor
         self.jitter_ratio = jitter_ratio
         self.respect_retry_after_header = respect_retry_after_header
+        self.retry_deadline = retry_deadline
+        self.retry_budget = retry_budget
+        # shared by the sync and async transports
+        self.retry_metrics = RetryMetrics()
 
         self._auth = auth
         self._headers = headers
         self._proxies = proxies
         self._timeout = timeout
+        self._oidc_auth: Union[OIDCAuth, None] = None
+
+        # connection pool vars, the clients are created lazily and reused for all requests
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.http2 = http2
+        self.transport = transport
+        self.rate_limiter = rate_limiter
+        # shared by the sync and async transports, so both see the same failures and latencies
+        self.circuit_breaker: Union[CircuitBreaker, None] = (
+            CircuitBreaker() if circuit_breaker is True else circuit_breaker or None
+        )
+        self.hedging: Union[HedgingPolicy, None] = (
+            HedgingPolicy() if hedging is True else hedging or None
+        )
+        self._client: Union[httpx.Client, None] = None
+        self._async_client_instance: Union[httpx.AsyncClient, None] = None
+        self._async_client_loop: Union[asyncio.AbstractEventLoop, None] = None
+        self._closing_tasks = set()
+        # last server summary and the time it was created
+        self._summary: Union[Tuple[float, ServerSummary], None] = None
+
+        # opt-in read-through cache of resources requested by reference
+        self.cache: Union[ResourceCache, None] = (
+            ResourceCache() if cache is True else cache or None
+        )
+
+    def __enter__(self) -> "FhirServer":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    async def __aenter__(self) -> "FhirServer":
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
+
+    def close(self) -> None:
+        """
+        Close the connection pools of the server. A new connection pool is created when the server is used again.
+        """
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+        self._discard_async_client()
+
+    async def aclose(self) -> None:
+        """
+        Asynchronously close the connection pools of the server.
+        """
+        if self._async_client_instance is not None:
+            await self._async_client_instance.aclose()
+            self._async_client_instance = None
+            self._async_client_loop = None
+        self.close()
 
     @classmethod
     def from_env(cls, no_auth: bool = False) -> "FhirServer":
@@ -318,10 +444,21 @@ class FhirServer:
         """
         if isinstance(reference, Reference):
             reference = reference.reference
-        with self._sync_client() as client:
-            r = client.get(f"{self.api_address}/{reference}")
-        r.raise_for_status()
-        resource_dict = r.json()
+        if self.cache is None:
+            r = self._sync_client().get(f"{self.api_address}/{reference}")
+            r.raise_for_status()
+            resource_dict = r.json()
+        else:
+            resource_dict, headers = self.cache.lookup(reference)
+            if resource_dict is None:
+                r = self._sync_client().get(
+                    f"{self.api_address}/{reference}", headers=headers
+                )
+                resource_dict = self.cache.process_response(reference, r)
+            if resource_dict is None:
+                # the revalidated resource was removed from the cache in the meantime
+                r = self._sync_client().get(f"{self.api_address}/{reference}")
+                resource_dict = self.cache.process_response(reference, r)
         resource = construct_fhir_element(resource_dict["resourceType"], resource_dict)
         return resource
 
@@ -338,84 +475,74 @@ class FhirServer:
         """
         if isinstance(reference, Reference):
             reference = reference.reference
-        async with self._async_client() as client:
-            r = await client.get(f"{self.api_address}/{reference}")
+        if self.cache is None:
+            r = await self._async_client().get(f"{self.api_address}/{reference}")
             r.raise_for_status()
-        resource_dict = r.json()
+            resource_dict = r.json()
+        else:
+            resource_dict, headers = self.cache.lookup(reference)
+            if resource_dict is None:
+                r = await self._async_client().get(
+                    f"{self.api_address}/{reference}", headers=headers
+                )
+                resource_dict = self.cache.process_response(reference, r)
+            if resource_dict is None:
+                # the revalidated resource was removed from the cache in the meantime
+                r = await self._async_client().get(f"{self.api_address}/{reference}")
+                resource_dict = self.cache.process_response(reference, r)
         resource = construct_fhir_element(resource_dict["resourceType"], resource_dict)
         return resource
 
     def get_many(
-        self, references: List[Union[str, Reference]]
+        self,
+        references: List[Union[str, Reference]],
+        chunk_size: int = 100,
+        max_concurrency: int = 4,
     ) -> List[FHIRAbstractModel]:
         """
-        Get a list of resources from the server specified by the given references
+        Get a list of resources from the server specified by the given references. The references are requested in
+        concurrent batch bundles of chunk_size references, entries failing with a temporary error are requested again
+        individually.
 
         Args:
             references: list of references to the resources, either a Reference object or a string of the form
                 `{ResourceType}/{id}`
+            chunk_size: number of references requested in one batch bundle
+            max_concurrency: maximum number of bundles requested at the same time
 
         Returns:
-            list of resources corresponding to the references
+            list of resources corresponding to the references in the same order, with an OperationOutcome for each
+            reference that could not be retrieved
 
         """
-        str_references = [
-            reference if isinstance(reference, str) else reference.reference
-            for reference in references
-        ]
-
-        get_many_transaction = make_transaction_bundle(
-            method=TransactionMethod.GET,
-            transaction_type=TransactionType.BATCH,
-            references=str_references,
+        return get_many(
+            self, references, chunk_size=chunk_size, max_concurrency=max_concurrency
         )
-        with self._sync_client() as client:
-            r = client.post(self.api_address, json=json_dict(get_many_transaction))
-            r.raise_for_status()
-        entries = r.json()["entry"]
-        resources = [
-            construct_fhir_element(entry["resource"]["resourceType"], entry["resource"])
-            for entry in entries
-        ]
-
-        return resources
 
     async def get_many_async(
-        self, references: List[Union[str, Reference]]
+        self,
+        references: List[Union[str, Reference]],
+        chunk_size: int = 100,
+        max_concurrency: int = 4,
     ) -> List[FHIRAbstractModel]:
         """
-        Asynchronously get a list of resources from the server specified by the given references
+        Asynchronously get a list of resources from the server specified by the given references, see `get_many`.
 
         Args:
             references: list of references to the resources, either a Reference object or a string of the form
                 `{ResourceType}/{id}`
+            chunk_size: number of references requested in one batch bundle
+            max_concurrency: maximum number of bundles requested at the same time
 
         Returns:
-            list of resources corresponding to the references
+            list of resources corresponding to the references in the same order, with an OperationOutcome for each
+            reference that could not be retrieved
 
         """
-        str_references = [
-            reference if isinstance(reference, str) else reference.reference
-            for reference in references
-        ]
-        get_many_transaction = make_transaction_bundle(
-            method=TransactionMethod.GET,
-            transaction_type=TransactionType.BATCH,
-            references=str_references,
+        return await get_many_async(
+            self, references, chunk_size=chunk_size, max_concurrency=max_concurrency
         )
 
-        async with self._async_client() as client:
-            response = await client.post(
-                self.api_address, json=get_many_transaction.dict(exclude_none=True)
-            )
-
-        # construct the list of resources from the server response
-        resources = [
-            construct_fhir_element(entry["resource"]["resourceType"], entry["resource"])
-            for entry in response.json()["entry"]
-        ]
-        return resources
-
     def add(self, resource: Union[Resource, dict]) -> ResourceCreateResponse:
         """
         Upload a resource to the server
@@ -438,9 +565,11 @@ class FhirServer:
         response = self._upload_resource(resource)
         response.raise_for_status()
 
-        return ResourceCreateResponse(
+        create_response = ResourceCreateResponse(
             server_response_dict=dict(response.headers), resource=resource
         )
+        self._invalidate_cache(references=[create_response.reference])
+        return create_response
 
     async def add_async(
         self, resource: Union[Resource, dict]
@@ -464,53 +593,47 @@ class FhirServer:
         else:
             resource = resource.validate(resource)
         response = await self._upload_resource_async(resource)
-        return ResourceCreateResponse(
+        create_response = ResourceCreateResponse(
             server_response_dict=dict(response.headers), resource=resource
         )
+        self._invalidate_cache(references=[create_response.reference])
+        return create_response
 
     def add_all(
         self,
         resources: List[Union[Resource, FHIRAbstractModel, dict]],
         batch_size: int = 1000,
         display: bool = True,
+        adaptive_batching: bool = False,
+        validate: bool = False,
     ) -> BundleCreateResponse:
         """
-        Upload a list of resources to the server, after packaging them into a bundle
+        Upload a list of resources to the server, after packaging them into a bundle. Bundles rejected by the server
+        as too large (413) are split and uploaded again in smaller parts.
         Args:
             resources: list of resources to upload to the server, either dictionary or FHIR resource objects
-            batch_size: maximum number of resources to upload in one bundle
+            batch_size: maximum number of resources to upload in one bundle, initial size for adaptive batching
             display: whether to display a progress bar when the upload is batched
+            adaptive_batching: whether to adapt the batch size to the latency and limits of the server
+            validate: whether to validate the resources against their FHIR resource model before uploading them
 
         Returns:
-            Bundle create response from the fhir server
+            Bundle create response from the fhir server, containing the used batch sizes
 
         """
-        response = None
-        if len(resources) > batch_size:
-            # split the list of resources into batches of size batch_size
-            batches = [
-                resources[i : i + batch_size]
-                for i in range(0, len(resources), batch_size)
-            ]
-
-            p_bar = tqdm(batches, disable=not display)
-            for i, batch in enumerate(p_bar):
-                p_bar.set_description(
-                    f"Uploading Batch {i + 1}/{len(batches)}, n={len(batch)}"
-                )
-                bundle = make_transaction_bundle(
-                    method=TransactionMethod.POST, resources=batch
-                )
-                if not response:
-                    response = self._upload_bundle(bundle)
-                else:
-                    add_response = self._upload_bundle(bundle)
-                    response.create_responses.extend(add_response.create_responses)
-        else:
-            bundle = make_transaction_bundle(
-                method=TransactionMethod.POST, resources=resources
-            )
-            response = self._upload_bundle(bundle)
+        if not resources:
+            raise ValueError("No resources to upload")
+        sizer = BatchSizer(batch_size, adaptive=adaptive_batching)
+        p_bar = tqdm(
+            total=len(resources),
+            unit=" resources",
+            disable=not display or len(resources) <= batch_size,
+        )
+        response = self._upload_batches(resources, sizer, validate, p_bar)
+        p_bar.close()
+        self._invalidate_cache(references=response.references)
+        response.batch_sizes = sizer.sizes
+        response.batch_size = sizer.size
         return response
 
     async def add_all_async(
@@ -518,46 +641,116 @@ class FhirServer:
         resources: List[Union[Resource, FHIRAbstractModel, dict]],
         batch_size: int = 5000,
         display: bool = True,
+        max_concurrency: int = 4,
+        batch_retries: int = 2,
+        adaptive_batching: bool = False,
+        validate: bool = False,
     ) -> BundleCreateResponse:
         """
-        Asynchronously upload a list of resources to the server, after packaging them into a bundle
+        Asynchronously upload a list of resources to the server, after packaging them into a bundle. Batches are
+        uploaded concurrently, the create responses are returned in the order of the given resources. Bundles rejected
+        by the server as too large (413) are split and uploaded again in smaller parts.
 
         Args:
             resources: list of resources to upload to the server, either dictionary or FHIR resource objects
-            batch_size: maximum number of resources to upload in one bundle
+            batch_size: maximum number of resources to upload in one bundle, initial size for adaptive batching
             display: whether to display a progress bar when the upload is batched
+            max_concurrency: maximum number of batches uploaded at the same time
+            batch_retries: how often a failed batch is retried before the upload is aborted
+            adaptive_batching: whether to adapt the batch size to the latency and limits of the server
+            validate: whether to validate the resources against their FHIR resource model before uploading them
 
-        Returns: Bundle create response from the fhir server
+        Returns: Bundle create response from the fhir server, containing the used batch sizes
         """
-
-        response = None
-        if len(resources) > batch_size:
-            # split the list of resources into batches of size batch_size
-            batches = [
-                resources[i : i + batch_size]
-                for i in range(0, len(resources), batch_size)
-            ]
-            p_bar = tqdm(batches, disable=not display)
-            for i, batch in enumerate(p_bar):
-                p_bar.set_description(
-                    f"Uploading Batch {i + 1}/{len(batches)}, n={len(batch)}"
+        if not resources:
+            raise ValueError("No resources to upload")
+        sizer = BatchSizer(batch_size, adaptive=adaptive_batching)
+        p_bar = tqdm(
+            total=len(resources),
+            unit=" resources",
+            disable=not display or len(resources) <= batch_size,
+        )
+        # the workers take the next batch from the list of resources with the current batch size
+        batch_responses = {}
+        next_index = 0
+
+        async def upload_worker():
+            nonlocal next_index
+            while next_index < len(resources):
+                start = next_index
+                batch = resources[start : start + sizer.size]
+                next_index += len(batch)
+                batch_responses[start] = await self._upload_batch_async(
+                    batch, sizer, validate, batch_retries
                 )
+                p_bar.update(len(batch))
+
+        n_workers = min(max_concurrency, -(-len(resources) // batch_size))
+        tasks = [asyncio.create_task(upload_worker()) for _ in range(n_workers)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # stop uploading the remaining batches if one of them failed
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            p_bar.close()
+
+        ordered_responses = [
+            batch_responses[start] for start in sorted(batch_responses)
+        ]
+        response = ordered_responses[0]
+        for batch_response in ordered_responses[1:]:
+            response.create_responses.extend(batch_response.create_responses)
+        self._invalidate_cache(references=response.references)
+        response.batch_sizes = sizer.sizes
+        response.batch_size = sizer.size
+        return response
 
-                # create a bundle from the batch of resources
-                bundle = make_transaction_bundle(
-                    method=TransactionMethod.POST, resources=batch
-                )
-                if not response:
-                    response = await self._upload_bundle_async(bundle)
-                else:
-                    add_response = await self._upload_bundle_async(bundle)
-                    response.create_responses.extend(add_response.create_responses)
-        else:
-            # create a bundle from the list of resources
-            bundle = make_transaction_bundle(
-                method=TransactionMethod.POST, resources=resources
-            )
-            response = await self._upload_bundle_async(bundle)
+    def add_ndjson(
+        self,
+        source: NdjsonSource,
+        batch_size: int = 1000,
+        max_concurrency: int = 4,
+        use_import: bool = None,
+        timeout: float = None,
+        display: bool = True,
+        keep_references: bool = False,
+    ) -> NdjsonUploadResponse:
+        """
+        Upload resources from ndjson files to the server without loading the files into memory. Files given as urls
+        are loaded via the bulk data `$import` operation if the server supports it, otherwise the resources are
+        uploaded in concurrent batch bundles, keeping their ids.
+
+        Args:
+            source: path or url of an ndjson file, a list of paths/urls or an iterable of resource dictionaries
+            batch_size: number of resources per batch bundle
+            max_concurrency: maximum number of bundles uploaded at the same time
+            use_import: whether to use the `$import` operation, by default it is used if the source consists of
+                urls and the server supports it
+            timeout: maximum time in seconds to wait for an `$import` to complete
+            display: whether to display a progress bar for batch uploads
+            keep_references: whether to collect the references of all uploaded resources in the response
+
+        Returns:
+            NdjsonUploadResponse with the number of uploaded resources or the `$import` manifest
+        """
+        response = add_ndjson(
+            self,
+            source,
+            batch_size=batch_size,
+            max_concurrency=max_concurrency,
+            use_import=use_import,
+            timeout=timeout,
+            display=display,
+            keep_references=keep_references,
+        )
+        if response.references is None and self.cache is not None:
+            # the uploaded resources keep their ids and may replace cached resources that can not be looked up
+            self.cache.clear()
+        self._invalidate_cache(references=response.references)
         return response
 
     def add_bundle(
@@ -582,6 +775,7 @@ class FhirServer:
             self._validate_upload_bundle_entries(bundle.entry)
 
         create_response = self._upload_bundle(bundle)
+        self._invalidate_cache(references=create_response.references)
         return create_response
 
     async def add_bundle_async(
@@ -606,6 +800,7 @@ class FhirServer:
             self._validate_upload_bundle_entries(bundle.entry)
 
         transaction_response = await self._upload_bundle_async(bundle)
+        self._invalidate_cache(references=transaction_response.references)
         return transaction_response
 
     def update(self, resources: List[Union[FHIRResourceModel, dict]]) -> dict:
@@ -621,9 +816,9 @@ class FhirServer:
         update_bundle = make_transaction_bundle(
             method=TransactionMethod.PUT, resources=resources
         )
-        with self._sync_client() as client:
-            r = client.post(self.api_address, json=json_dict(update_bundle))
-            r.raise_for_status()
+        r = self._sync_client().post(self.api_address, json=json_dict(update_bundle))
+        r.raise_for_status()
+        self._invalidate_cache(resources=resources)
         return r.json()
 
     async def update_async(self, resources: List[Union[FHIRResourceModel, dict]]):
@@ -631,9 +826,11 @@ class FhirServer:
             method=TransactionMethod.PUT, resources=resources
         )
 
-        async with self._async_client() as client:
-            r = await client.post(self.api_address, json=json_dict(update_bundle))
-            r.raise_for_status()
+        r = await self._async_client().post(
+            self.api_address, json=json_dict(update_bundle)
+        )
+        r.raise_for_status()
+        self._invalidate_cache(resources=resources)
         return r.json()
 
     def delete(
@@ -665,9 +862,9 @@ class FhirServer:
             references=references,
         )
 
-        with self._sync_client() as client:
-            r = client.post(self.api_address, json=json_dict(delete_bundle))
-            r.raise_for_status()
+        r = self._sync_client().post(self.api_address, json=json_dict(delete_bundle))
+        r.raise_for_status()
+        self._invalidate_cache(resources=resources, references=references)
 
     async def delete_async(
         self,
@@ -698,9 +895,11 @@ class FhirServer:
             references=references,
         )
 
-        async with self._async_client() as client:
-            r = await client.post(self.api_address, json=json_dict(delete_bundle))
-            r.raise_for_status()
+        r = await self._async_client().post(
+            self.api_address, json=json_dict(delete_bundle)
+        )
+        r.raise_for_status()
+        self._invalidate_cache(resources=resources, references=references)
 
     def transfer(
         self,
@@ -710,6 +909,8 @@ class FhirServer:
         get_missing: bool = True,
         record_linkage: bool = True,
         display: bool = False,
+        break_cycles: bool = False,
+        checkpoint: Union[str, pathlib.Path] = None,
     ) -> TransferResponse:
         """
         Transfer resources from this server to another server while using server assigned ids and keeping referential
@@ -722,6 +923,10 @@ class FhirServer:
             get_missing: whether to get missing references from the source server
             record_linkage: whether to record the linkage between the source and target server
             display: whether to display the progress bar
+            break_cycles: whether to transfer resources referencing each other in a cycle by creating them without
+                the cyclic references and updating them afterwards, otherwise cycles raise a ValueError
+            checkpoint: path of a sqlite database storing the progress of the transfer, a failed transfer started again
+                with the same checkpoint does not create the already transferred resources again
 
         Returns:
             Transfer response for the transfer of the query result to the target server
@@ -736,33 +941,211 @@ class FhirServer:
             get_missing=get_missing,
             record_linkage=record_linkage,
             display=display,
+            break_cycles=break_cycles,
+            checkpoint=checkpoint,
         )
         return response
 
-    def summary(self, display: bool = True) -> ServerSummary:
+    async def transfer_async(
+        self,
+        target_server: "FhirServer",
+        query: FhirQueryAsync = None,
+        resources: List[Union[Resource, FHIRAbstractModel]] = None,
+        get_missing: bool = True,
+        record_linkage: bool = True,
+        display: bool = False,
+        break_cycles: bool = False,
+        max_concurrency: int = 4,
+        batch_size: int = 500,
+        checkpoint: Union[str, pathlib.Path] = None,
+    ) -> TransferResponse:
+        """
+        Asynchronously transfer resources from this server to another server while using server assigned ids and
+        keeping referential integrity. Resources are uploaded concurrently as soon as the resources they reference
+        have been created on the target server.
+
+        Args:
+            target_server: FhirServer to transfer to
+            query: FhirQueryAsync to use to find resources to transfer
+            resources: list of resources to transfer
+            get_missing: whether to get missing references from the source server
+            record_linkage: whether to record the linkage between the source and target server
+            display: whether to display the progress bar
+            break_cycles: whether to transfer resources referencing each other in a cycle by creating them without
+                the cyclic references and updating them afterwards, otherwise cycles raise a ValueError
+            max_concurrency: maximum number of requests sent to each server at the same time
+            batch_size: maximum number of resources uploaded in one bundle
+            checkpoint: path of a sqlite database storing the progress of the transfer, a failed transfer started again
+                with the same checkpoint does not create the already transferred resources again
+
+        Returns:
+            Transfer response for the transfer to the target server, including the duration and throughput
+        """
+        return await transfer_async(
+            source=self,
+            target=target_server,
+            query=query,
+            resources=resources,
+            get_missing=get_missing,
+            record_linkage=record_linkage,
+            display=display,
+            break_cycles=break_cycles,
+            max_concurrency=max_concurrency,
+            batch_size=batch_size,
+            checkpoint=checkpoint,
+        )
+
+    def bulk_export(
+        self,
+        resource_types: List[str] = None,
+        since: Union[str, datetime.datetime] = None,
+        type_filter: List[str] = None,
+        output_dir: Union[str, pathlib.Path] = None,
+        max_concurrency: int = 4,
+        timeout: float = None,
+    ) -> BulkExportResponse:
+        """
+        Export resources from the server using the FHIR bulk data `$export` operation. Waits for the export to complete
+        and optionally downloads the exported ndjson files.
+
+        Args:
+            resource_types: resource types to export, defaults to all resource types
+            since: only export resources updated after this point in time
+            type_filter: FHIR search queries to filter the exported resources e.g. `Observation?status=final`
+            output_dir: if given, the exported ndjson files are downloaded into this directory
+            max_concurrency: maximum number of files downloaded at the same time
+            timeout: maximum time in seconds to wait for the export to complete
+
+        Returns:
+            BulkExportResponse containing the list of exported files
+        """
+        return bulk_export(
+            self,
+            resource_types=resource_types,
+            since=since,
+            type_filter=type_filter,
+            output_dir=output_dir,
+            max_concurrency=max_concurrency,
+            timeout=timeout,
+        )
+
+    async def bulk_export_async(
+        self,
+        resource_types: List[str] = None,
+        since: Union[str, datetime.datetime] = None,
+        type_filter: List[str] = None,
+        output_dir: Union[str, pathlib.Path] = None,
+        max_concurrency: int = 4,
+        timeout: float = None,
+    ) -> BulkExportResponse:
+        """
+        Asynchronously export resources from the server using the FHIR bulk data `$export` operation.
+
+        Args:
+            resource_types: resource types to export, defaults to all resource types
+            since: only export resources updated after this point in time
+            type_filter: FHIR search queries to filter the exported resources e.g. `Observation?status=final`
+            output_dir: if given, the exported ndjson files are downloaded into this directory
+            max_concurrency: maximum number of files downloaded at the same time
+            timeout: maximum time in seconds to wait for the export to complete
+
+        Returns:
+            BulkExportResponse containing the list of exported files
+        """
+        return await bulk_export_async(
+            self,
+            resource_types=resource_types,
+            since=since,
+            type_filter=type_filter,
+            output_dir=output_dir,
+            max_concurrency=max_concurrency,
+            timeout=timeout,
+        )
+
+    def iter_bulk_export(
+        self, export: BulkExportResponse, parse: bool = False
+    ) -> Iterator[Union[dict, FHIRAbstractModel]]:
+        """
+        Stream the resources of a completed bulk export one at a time without loading the files into memory.
+
+        Args:
+            export: the completed export
+            parse: whether to parse the resources into fhir resource models
+
+        Returns:
+            Iterator over the exported resources
+        """
+        return iter_export_resources(self, export, parse=parse)
+
+    def iter_bulk_export_async(
+        self, export: BulkExportResponse, parse: bool = False, max_concurrency: int = 4
+    ) -> AsyncIterator[Union[dict, FHIRAbstractModel]]:
+        """
+        Asynchronously stream the resources of a completed bulk export, streaming multiple files concurrently.
+
+        Args:
+            export: the completed export
+            parse: whether to parse the resources into fhir resource models
+            max_concurrency: maximum number of files streamed at the same time
+
+        Returns:
+            Async iterator over the exported resources
+        """
+        return iter_export_resources_async(
+            self, export, parse=parse, max_concurrency=max_concurrency
+        )
+
+    def summary(
+        self, display: bool = True, max_concurrency: int = 8, max_age: float = 300
+    ) -> ServerSummary:
         """
-        Create a summary for the server. Contains resource counts for all resources available on the server.
+        Create a summary for the server. Contains resource counts for all searchable resources available on the
+        server, the counts are requested concurrently.
         Args:
             display: whether to display a progress bar
+            max_concurrency: maximum number of count requests sent at the same time
+            max_age: time in seconds a previously created summary is returned instead of creating a new one, 0 to
+                always create a new summary, writes through the server discard the cached summary
         Returns:
             ServerSummary containing resource counts for all resources available on the server
 
         """
-        summary = create_server_summary(self, self.rest_resources, display)
+        summary = self._cached_summary(max_age)
+        if summary is None:
+            summary = create_server_summary(
+                self,
+                searchable_resources(self.capabilities),
+                display,
+                max_concurrency=max_concurrency,
+            )
+            self._summary = (time.monotonic(), summary)
         return summary
 
-    async def summary_async(self, display: bool = True) -> ServerSummary:
+    async def summary_async(
+        self, display: bool = True, max_concurrency: int = 8, max_age: float = 300
+    ) -> ServerSummary:
         """
-        Asynchronously create a summary for the server. Contains resource counts for all resources available on the
-        server.
+        Asynchronously create a summary for the server. Contains resource counts for all searchable resources
+        available on the server, the counts are requested concurrently.
 
         Args:
             display: whether to display a progress bar
+            max_concurrency: maximum number of count requests sent at the same time
+            max_age: time in seconds a previously created summary is returned instead of creating a new one, 0 to
+                always create a new summary, writes through the server discard the cached summary
         Returns:
             ServerSummary containing resource counts for all resources available on the server
 
         """
-        summary = await create_server_summary_async(self, self.rest_resources, display)
+        summary = self._cached_summary(max_age)
+        if summary is None:
+            summary = await create_server_summary_async(
+                self,
+                searchable_resources(self.capabilities),
+                display,
+                max_concurrency=max_concurrency,
+            )
+            self._summary = (time.monotonic(), summary)
         return summary
 
     @property
@@ -797,11 +1180,12 @@ class FhirServer:
         elif self.token:
             return BearerAuth(self.token)
         elif self.client_id and self.client_secret and self.oidc_provider_url:
-            oidc_auth = OIDCAuth(
-                self.client_id, self.client_secret, self.oidc_provider_url
-            )
-            token = oidc_auth.get_token()
-            return BearerAuth(token)
+            # reuse the same oidc auth so the token is only requested again when it expires
+            if self._oidc_auth is None:
+                self._oidc_auth = OIDCAuth(
+                    self.client_id, self.client_secret, self.oidc_provider_url
+                )
+            return self._oidc_auth
 
     @staticmethod
     def _validate_api_address(api_address: str) -> str:
@@ -835,6 +1219,37 @@ class FhirServer:
         else:
             raise ValueError(f"Malformed API URL: {api_address}")
 
+    def _invalidate_cache(
+        self,
+        resources: List[Union[FHIRResourceModel, dict]] = None,
+        references: List[Union[str, Reference]] = None,
+    ):
+        """
+        Remove resources changed through this server from the resource cache and discard the cached summary, whose
+        counts are outdated after a write.
+        """
+        self._summary = None
+        if self.cache is None:
+            return
+        keys = [
+            reference.reference if isinstance(reference, Reference) else reference
+            for reference in references or []
+        ]
+        for resource in resources or []:
+            if isinstance(resource, dict):
+                keys.append(f"{resource.get('resourceType')}/{resource.get('id')}")
+            else:
+                keys.append(f"{resource.get_resource_type()}/{resource.id}")
+        self.cache.invalidate(keys)
+
+    def _cached_summary(self, max_age: float) -> Union[ServerSummary, None]:
+        if self._summary is None:
+            return None
+        created, summary = self._summary
+        if time.monotonic() - created >= max_age:
+            return None
+        return summary
+
     @staticmethod
     def _validate_delete_args(query, references, resources):
         if query and (resources or references):
@@ -848,44 +1263,217 @@ class FhirServer:
             if entry.request.method.lower() not in ["post", "put"]:
                 raise ValueError(f"Entry {i}:  method is not in [post, put]")
 
-    def _upload_bundle(self, bundle: Bundle) -> BundleCreateResponse:
+    def _upload_bundle(
+        self,
+        bundle: Union[Bundle, bytes],
+        resources: List[Union[Resource, FHIRAbstractModel, dict]] = None,
+    ) -> BundleCreateResponse:
         """
         Upload a bundle to the server
         Args:
-            bundle: transaction bundle to upload to the server
+            bundle: transaction bundle or json encoded transaction bundle to upload to the server
+            resources: the resources contained in the bundle, required if the bundle is given as json
 
         Returns:
             BundleCreateResponse with the server assigned ids
 
         """
-        with self._sync_client() as client:
-            r = client.post(url=self.api_address, json=json_dict(bundle))
-            try:
-                r.raise_for_status()
-            except Exception as e:
-                print(r.text)
-                raise e
+        r = self._sync_client().post(
+            url=self.api_address, content=self._bundle_content(bundle)
+        )
+        try:
+            r.raise_for_status()
+        except Exception as e:
+            print(r.text)
+            raise e
+        if isinstance(bundle, bytes):
+            return BundleCreateResponse(r, resources=resources)
         bundle_response = BundleCreateResponse(r, bundle)
         return bundle_response
 
-    async def _upload_bundle_async(self, bundle: Bundle) -> BundleCreateResponse:
+    def _upload_batches(
+        self,
+        resources: List[Union[Resource, FHIRAbstractModel, dict]],
+        sizer: BatchSizer,
+        validate: bool = False,
+        p_bar: tqdm = None,
+    ) -> BundleCreateResponse:
+        """
+        Upload a list of resources in consecutive bundles with the size chosen by the batch sizer.
+        """
+        response = None
+        start = 0
+        while start < len(resources):
+            batch = resources[start : start + sizer.size]
+            batch_response = self._upload_batch(batch, sizer, validate)
+            if not response:
+                response = batch_response
+            else:
+                response.create_responses.extend(batch_response.create_responses)
+            start += len(batch)
+            if p_bar is not None:
+                p_bar.update(len(batch))
+        return response
+
+    def _upload_batch(
+        self,
+        batch: List[Union[Resource, FHIRAbstractModel, dict]],
+        sizer: BatchSizer,
+        validate: bool = False,
+    ) -> BundleCreateResponse:
+        """
+        Upload a batch of resources in a transaction bundle, if the server rejects the bundle as too large it is split
+        and the parts are uploaded again.
+        """
+        bundle = make_transaction_bundle_bytes(
+            method=TransactionMethod.POST, resources=batch, validate=validate
+        )
+        start = time.monotonic()
+        try:
+            response = self._upload_bundle(bundle, resources=batch)
+        except httpx.HTTPStatusError as e:
+            status_code = e.response.status_code
+            if not sizer.should_split(status_code, len(batch)):
+                raise e
+            sizer.record_failure(status_code, len(batch), len(e.request.content))
+            return self._upload_batches(batch, sizer, validate)
+        except httpx.ReadTimeout:
+            # the client gave up waiting for the server, handled like a timeout response of the server
+            if not sizer.should_split(httpx.codes.REQUEST_TIMEOUT, len(batch)):
+                raise
+            sizer.record_failure(httpx.codes.REQUEST_TIMEOUT, len(batch), len(bundle))
+            return self._upload_batches(batch, sizer, validate)
+        sizer.record_success(
+            len(batch), time.monotonic() - start, payload_bytes=len(bundle)
+        )
+        return response
+
+    async def _upload_batches_async(
+        self,
+        resources: List[Union[Resource, FHIRAbstractModel, dict]],
+        sizer: BatchSizer,
+        validate: bool = False,
+        max_retries: int = 0,
+    ) -> BundleCreateResponse:
+        """
+        Asynchronously upload a list of resources in consecutive bundles with the size chosen by the batch sizer.
+        """
+        response = None
+        start = 0
+        while start < len(resources):
+            batch = resources[start : start + sizer.size]
+            batch_response = await self._upload_batch_async(
+                batch, sizer, validate, max_retries
+            )
+            if not response:
+                response = batch_response
+            else:
+                response.create_responses.extend(batch_response.create_responses)
+            start += len(batch)
+        return response
+
+    async def _upload_batch_async(
+        self,
+        batch: List[Union[Resource, FHIRAbstractModel, dict]],
+        sizer: BatchSizer,
+        validate: bool = False,
+        max_retries: int = 0,
+    ) -> BundleCreateResponse:
+        """
+        Asynchronously upload a batch of resources in a transaction bundle, if the server rejects the bundle as too
+        large it is split and the parts are uploaded again.
+        """
+        bundle = make_transaction_bundle_bytes(
+            method=TransactionMethod.POST, resources=batch, validate=validate
+        )
+        start = time.monotonic()
+        try:
+            response = await self._upload_bundle_async(
+                bundle, resources=batch, max_retries=max_retries
+            )
+        except httpx.HTTPStatusError as e:
+            status_code = e.response.status_code
+            if not sizer.should_split(status_code, len(batch)):
+                raise e
+            sizer.record_failure(status_code, len(batch), len(e.request.content))
+            return await self._upload_batches_async(batch, sizer, validate, max_retries)
+        except httpx.ReadTimeout:
+            # the client gave up waiting for the server, handled like a timeout response of the server
+            if not sizer.should_split(httpx.codes.REQUEST_TIMEOUT, len(batch)):
+                raise
+            sizer.record_failure(httpx.codes.REQUEST_TIMEOUT, len(batch), len(bundle))
+            return await self._upload_batches_async(batch, sizer, validate, max_retries)
+        sizer.record_success(
+            len(batch), time.monotonic() - start, payload_bytes=len(bundle)
+        )
+        return response
+
+    async def _upload_bundle_async(
+        self,
+        bundle: Union[Bundle, bytes],
+        resources: List[Union[Resource, FHIRAbstractModel, dict]] = None,
+        max_retries: int = 0,
+        retry_status_codes: Iterable[int] = BUNDLE_RETRY_STATUS_CODES,
+    ) -> BundleCreateResponse:
         """
         Asynchronously upload a bundle to the server
         Args:
-            bundle: Bundle to upload to the server
+            bundle: Bundle or json encoded bundle to upload to the server
+            resources: the resources contained in the bundle, required if the bundle is given as json
+            max_retries: how often to send the bundle again if the connection to the server failed or the server
+                refused it with one of the retry_status_codes and a Retry-After header. Other errors, e.g. gateway
+                timeouts, are raised since the server may have processed the bundle.
+            retry_status_codes: status codes of the server response for which the upload is retried
 
         Returns:
             BundleCreateResponse with the server assigned ids
         """
-        async with self._async_client() as client:
-            r = await client.post(url=self.api_address, json=json_dict(bundle))
+        content = self._bundle_content(bundle)
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                r = await self._async_client().post(
+                    url=self.api_address, content=content
+                )
+            except BUNDLE_RETRY_EXCEPTIONS:
+                if attempts > max_retries:
+                    raise
+                await asyncio.sleep(self._bundle_retry_sleep(attempts))
+                continue
+
+            if (
+                r.status_code in retry_status_codes
+                and "Retry-After" in r.headers
+                and attempts <= max_retries
+            ):
+                await asyncio.sleep(self._bundle_retry_sleep(attempts, r.headers))
+                continue
             try:
                 r.raise_for_status()
             except Exception as e:
                 print(r.text)
                 raise e
-        bundle_response = BundleCreateResponse(r, bundle)
-        return bundle_response
+            if isinstance(bundle, bytes):
+                return BundleCreateResponse(r, resources=resources)
+            bundle_response = BundleCreateResponse(r, bundle)
+            return bundle_response
+
+    @staticmethod
+    def _bundle_content(bundle: Union[Bundle, bytes]) -> bytes:
+        if isinstance(bundle, bytes):
+            return bundle
+        return bundle.json(return_bytes=True)
+
+    def _bundle_retry_sleep(self, attempts: int, headers: dict = None) -> float:
+        return calculate_sleep(
+            attempts,
+            headers or {},
+            backoff_factor=self.backoff_factor,
+            jitter_ratio=self.jitter_ratio,
+            max_backoff_wait=self.max_backoff_wait,
+            respect_retry_after_header=self.respect_retry_after_header,
+        )
 
     def _upload_resource(self, resource: Resource) -> httpx.Response:
         """
@@ -897,13 +1485,12 @@ class FhirServer:
             httpx.Response from the server
         """
         url = self.api_address + "/" + resource.get_resource_type()
-        with self._sync_client() as client:
-            r = client.post(url=url, json=json_dict(resource))
-            try:
-                r.raise_for_status()
-            except Exception as e:
-                print(r.text)
-                raise e
+        r = self._sync_client().post(url=url, json=json_dict(resource))
+        try:
+            r.raise_for_status()
+        except Exception as e:
+            print(r.text)
+            raise e
         return r
 
     async def _upload_resource_async(self, resource: Resource) -> httpx.Response:
@@ -916,58 +1503,122 @@ class FhirServer:
             httpx.Response from the server
         """
         url = self.api_address + "/" + resource.get_resource_type()
-        async with self._async_client() as client:
-            r = await client.post(url=url, json=json_dict(resource))
-            try:
-                r.raise_for_status()
-            except Exception as e:
-                print(r.text)
-                raise e
+        r = await self._async_client().post(url=url, json=json_dict(resource))
+        try:
+            r.raise_for_status()
+        except Exception as e:
+            print(r.text)
+            raise e
         return r
 
     def _get_meta_data(self):
         url = self.api_address + "/metadata"
-        with self._sync_client() as client:
-            r = client.get(url)
-            try:
-                r.raise_for_status()
-            except Exception as e:
-                print(r.text)
-                raise e
+        r = self._sync_client().get(url)
+        try:
+            r.raise_for_status()
+        except Exception as e:
+            print(r.text)
+            raise e
         response = r.json()
         self._meta_data = response
 
     def _sync_client(self) -> httpx.Client:
-        """Get a synchronous httpx client
+        """Get the persistent synchronous httpx client of the server, the client is created on first use and
+        its connection pool is shared by all requests and queries of the server.
 
         Returns:
             _httpx.Client: synchronous httpx client
         """
 
-        transport = self._setup_transport()
-        client = httpx.Client(
-            headers=self.headers,
-            auth=self.auth,
-            proxies=self._proxies,
-            timeout=self._timeout,
-            transport=transport,
-        )
-        return client
+        if self._client is None or self._client.is_closed:
+            transport = self._setup_transport()
+            self._client = httpx.Client(
+                headers=self.headers,
+                auth=self.auth,
+                proxies=self._proxies,
+                timeout=self._timeout,
+                transport=transport,
+                limits=self.limits,
+                http2=self.http2,
+            )
+        return self._client
 
     def _async_client(self) -> httpx.AsyncClient:
-        transport = self._setup_transport(async_transport=True)
-        client = httpx.AsyncClient(
-            headers=self.headers,
-            auth=self.auth,
-            proxies=self._proxies,
-            timeout=self._timeout,
-            transport=transport,
+        """Get the persistent asynchronous httpx client of the server. Connections of an async client are bound
+        to the event loop they were created in, so a new client is created when the server is used from a
+        different event loop.
+
+        Returns:
+            httpx.AsyncClient: asynchronous httpx client
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        client = self._async_client_instance
+        loop_changed = (
+            loop is not None
+            and self._async_client_loop is not None
+            and loop is not self._async_client_loop
         )
-        return client
+        if client is None or client.is_closed or loop_changed:
+            self._discard_async_client()
+            transport = self._setup_transport(async_transport=True)
+            self._async_client_instance = httpx.AsyncClient(
+                headers=self.headers,
+                auth=self.auth,
+                proxies=self._proxies,
+                timeout=self._timeout,
+                transport=transport,
+                limits=self.limits,
+                http2=self.http2,
+            )
+            self._async_client_loop = loop
+        elif self._async_client_loop is None:
+            self._async_client_loop = loop
+        return self._async_client_instance
+
+    def _discard_async_client(self):
+        """
+        Close the async client without awaiting it, e.g. from sync code or when the server is used from a new event
+        loop. The client is closed on the loop it was created in if that loop is still running in another thread,
+        otherwise in a task of the running loop or in a temporary loop. Connections that can not be closed anymore
+        because their loop is closed are reported with a ResourceWarning.
+        """
+        client, client_loop = self._async_client_instance, self._async_client_loop
+        self._async_client_instance = None
+        self._async_client_loop = None
+        if client is None or client.is_closed:
+            return
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        if (
+            client_loop is not None
+            and client_loop.is_running()
+            and client_loop is not running_loop
+        ):
+            asyncio.run_coroutine_threadsafe(_close_async_client(client), client_loop)
+        elif running_loop is None:
+            # a private loop, asyncio.run would replace the current event loop of the thread
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(_close_async_client(client))
+            finally:
+                loop.close()
+        else:
+            # can not block the running loop, the client is closed in a task
+            task = running_loop.create_task(_close_async_client(client))
+            # the loop only holds weak references to tasks
+            self._closing_tasks.add(task)
+            task.add_done_callback(self._closing_tasks.discard)
 
     def _setup_transport(
         self, async_transport: bool = False
-    ) -> Union[RetryTransport, httpx.AsyncHTTPTransport, httpx.HTTPTransport]:
+    ) -> Union[httpx.BaseTransport, httpx.AsyncBaseTransport]:
         """Setup the transport for the httpx client if retryable methods or status codes are set
         for the server the requests will be retried according to the configuration
 
@@ -975,22 +1626,38 @@ class FhirServer:
             async_transport: if True return an async transport
         """
 
+        if self.transport is not None:
+            transport = self.transport
+        elif async_transport:
+            transport = httpx.AsyncHTTPTransport(limits=self.limits, http2=self.http2)
+        else:
+            transport = httpx.HTTPTransport(limits=self.limits, http2=self.http2)
+        # the limiter is wrapped by the retry transport, so retries are rate limited as well
+        if self.rate_limiter is not None:
+            transport = RateLimitTransport(
+                transport, self.rate_limiter, self.api_address
+            )
+        if self.circuit_breaker is not None or self.hedging is not None:
+            transport = ResilientTransport(
+                transport, circuit_breaker=self.circuit_breaker, hedging=self.hedging
+            )
+
         if self.retry_status_codes or self.retryable_methods:
             return RetryTransport(
-                wrapped_transport=httpx.AsyncHTTPTransport()
-                if async_transport
-                else httpx.HTTPTransport(),
+                wrapped_transport=transport,
                 max_attempts=self.max_attempts,
                 backoff_factor=self.backoff_factor,
                 retry_status_codes=self.retry_status_codes,
                 retryable_methods=self.retryable_methods,
                 jitter_ratio=self.jitter_ratio,
                 max_backoff_wait=self.max_backoff_wait,
+                respect_retry_after_header=self.respect_retry_after_header,
+                retry_deadline=self.retry_deadline,
+                retry_budget=self.retry_budget,
+                metrics=self.retry_metrics,
             )
         else:
-            return (
-                httpx.AsyncHTTPTransport() if async_transport else httpx.HTTPTransport()
-            )
+            return transport
 
     @staticmethod
     def _validate_query_input(
@@ -1011,6 +1678,17 @@ class FhirServer:
         return f"FhirServer(api_address={self.api_address})"
 
 
+async def _close_async_client(client: httpx.AsyncClient):
+    try:
+        await client.aclose()
+    except Exception as e:
+        # connections bound to a closed event loop can not be shut down gracefully
+        warnings.warn(
+            f"Could not close the connection pool of a previous event loop: {e!r}",
+            ResourceWarning,
+        )
+
+
 def _api_address_from_env() -> str:
     # load FHIR_API_URL
     api_url = os.getenv("FHIR_API_URL")
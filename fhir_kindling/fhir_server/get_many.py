@@ -0,0 +1,243 @@
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, List, Optional, Tuple, Union
+
+import httpx
+import orjson
+from fhir.resources import FHIRAbstractModel, construct_fhir_element
+from fhir.resources.operationoutcome import OperationOutcome
+from fhir.resources.reference import Reference
+
+from fhir_kindling.fhir_server.transactions import (
+    TransactionMethod,
+    TransactionType,
+    make_transaction_bundle_bytes,
+)
+
+if TYPE_CHECKING:
+    from fhir_kindling.fhir_server import FhirServer
+
+# entries failing with these status codes in a batch are requested again individually
+ENTRY_RETRY_STATUS_CODES = frozenset([408, 429, 500, 502, 503, 504])
+# a batch failing with these status codes fails the whole call, retrying the entries would fail as well
+BATCH_FATAL_STATUS_CODES = frozenset([401, 403])
+
+References = List[Union[str, Reference]]
+ChunkResult = Tuple[List[Optional[FHIRAbstractModel]], List[int]]
+
+
+def get_many(
+    server: "FhirServer",
+    references: References,
+    chunk_size: int = 100,
+    max_concurrency: int = 4,
+) -> List[FHIRAbstractModel]:
+    """
+    Get the resources for a list of references in batch bundles of chunk_size references, with at most
+    max_concurrency bundles requested at the same time. Entries that fail with a temporary error are requested again
+    individually.
+
+    Args:
+        server: the server to get the resources from
+        references: references to the resources, Reference objects or strings of the form `{ResourceType}/{id}`
+        chunk_size: number of references requested in one batch bundle
+        max_concurrency: maximum number of bundles requested at the same time
+
+    Returns:
+        list of resources in the order of the references, with an OperationOutcome for each reference that could not
+        be retrieved
+    """
+    references = _reference_strings(references)
+    chunks = _chunks(references, chunk_size)
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(max_concurrency, len(chunks)))
+    ) as executor:
+        results = list(executor.map(lambda chunk: _get_chunk(server, chunk), chunks))
+    return [resource for chunk in results for resource in chunk]
+
+
+async def get_many_async(
+    server: "FhirServer",
+    references: References,
+    chunk_size: int = 100,
+    max_concurrency: int = 4,
+) -> List[FHIRAbstractModel]:
+    """
+    Asynchronously get the resources for a list of references, see `get_many`.
+
+    Args:
+        server: the server to get the resources from
+        references: references to the resources, Reference objects or strings of the form `{ResourceType}/{id}`
+        chunk_size: number of references requested in one batch bundle
+        max_concurrency: maximum number of bundles requested at the same time
+
+    Returns:
+        list of resources in the order of the references, with an OperationOutcome for each reference that could not
+        be retrieved
+    """
+    references = _reference_strings(references)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    results = await asyncio.gather(
+        *[
+            _get_chunk_async(server, chunk, semaphore)
+            for chunk in _chunks(references, chunk_size)
+        ]
+    )
+    return [resource for chunk in results for resource in chunk]
+
+
+def _get_chunk(server: "FhirServer", references: List[str]) -> List[FHIRAbstractModel]:
+    try:
+        response = server._sync_client().post(
+            server.api_address, content=_batch_bundle(references)
+        )
+        results, retry = _parse_batch_response(references, response)
+    except httpx.TransportError:
+        results, retry = [None] * len(references), list(range(len(references)))
+    for i in retry:
+        results[i] = _get_single(server, references[i])
+    return results
+
+
+async def _get_chunk_async(
+    server: "FhirServer", references: List[str], semaphore: asyncio.Semaphore
+) -> List[FHIRAbstractModel]:
+    # the batch request and each individual request take a slot of the semaphore, so a failed batch does not send
+    # a request for every reference at once
+    async with semaphore:
+        try:
+            response = await server._async_client().post(
+                server.api_address, content=_batch_bundle(references)
+            )
+            results, retry = _parse_batch_response(references, response)
+        except httpx.TransportError:
+            results, retry = [None] * len(references), list(range(len(references)))
+
+    async def get_single(reference: str) -> FHIRAbstractModel:
+        async with semaphore:
+            return await _get_single_async(server, reference)
+
+    if retry:
+        retried = await asyncio.gather(*[get_single(references[i]) for i in retry])
+        for i, resource in zip(retry, retried):
+            results[i] = resource
+    return results
+
+
+def _get_single(server: "FhirServer", reference: str) -> FHIRAbstractModel:
+    try:
+        response = server._sync_client().get(f"{server.api_address}/{reference}")
+    except httpx.TransportError as e:
+        return _operation_outcome(reference, diagnostics=str(e))
+    return _parse_single_response(reference, response)
+
+
+async def _get_single_async(server: "FhirServer", reference: str) -> FHIRAbstractModel:
+    try:
+        response = await server._async_client().get(f"{server.api_address}/{reference}")
+    except httpx.TransportError as e:
+        return _operation_outcome(reference, diagnostics=str(e))
+    return _parse_single_response(reference, response)
+
+
+def _parse_batch_response(
+    references: List[str], response: httpx.Response
+) -> ChunkResult:
+    """
+    Parse the resources from a batch response.
+
+    Returns:
+        The resources or OperationOutcomes by position and the positions of the entries to request again
+    """
+    if response.status_code in BATCH_FATAL_STATUS_CODES:
+        response.raise_for_status()
+    if response.is_error:
+        # e.g. a bundle rejected as too large, the references are requested individually
+        return [None] * len(references), list(range(len(references)))
+
+    entries = orjson.loads(response.content).get("entry") or []
+    results = [None] * len(references)
+    retry = []
+    for i, reference in enumerate(references):
+        entry = entries[i] if i < len(entries) else {}
+        status = _entry_status(entry)
+        resource = entry.get("resource")
+        if status is not None and status < 300 and resource:
+            results[i] = construct_fhir_element(resource["resourceType"], resource)
+        elif status is None or status in ENTRY_RETRY_STATUS_CODES:
+            retry.append(i)
+        else:
+            outcome = entry.get("response", {}).get("outcome") or resource
+            results[i] = _operation_outcome(reference, status, outcome)
+    return results, retry
+
+
+def _parse_single_response(
+    reference: str, response: httpx.Response
+) -> FHIRAbstractModel:
+    if response.status_code in BATCH_FATAL_STATUS_CODES:
+        response.raise_for_status()
+    try:
+        resource = orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        resource = None
+    if response.is_success and resource:
+        return construct_fhir_element(resource["resourceType"], resource)
+    return _operation_outcome(reference, response.status_code, resource)
+
+
+def _entry_status(entry: dict) -> Optional[int]:
+    status = entry.get("response", {}).get("status")
+    if status:
+        # the status is given as code with optional text e.g. "200 OK"
+        return int(status.split(" ")[0])
+    # servers may leave out the response of successful entries
+    return 200 if entry.get("resource") else None
+
+
+def _operation_outcome(
+    reference: str,
+    status: int = None,
+    outcome: dict = None,
+    diagnostics: str = None,
+) -> OperationOutcome:
+    """
+    Use the OperationOutcome returned by the server for a failed entry or create one describing the error.
+    """
+    if outcome and outcome.get("resourceType") == "OperationOutcome":
+        return OperationOutcome.parse_obj(outcome)
+    if not diagnostics:
+        diagnostics = f"Failed to get {reference}, status code: {status}"
+    return OperationOutcome(
+        issue=[
+            {
+                "severity": "error",
+                "code": "not-found" if status in (404, 410) else "exception",
+                "diagnostics": diagnostics,
+            }
+        ]
+    )
+
+
+def _batch_bundle(references: List[str]) -> bytes:
+    return make_transaction_bundle_bytes(
+        transaction_type=TransactionType.BATCH,
+        method=TransactionMethod.GET,
+        references=references,
+    )
+
+
+def _reference_strings(references: References) -> List[str]:
+    return [
+        reference.reference if isinstance(reference, Reference) else reference
+        for reference in references
+    ]
+
+
+def _chunks(references: List[str], chunk_size: int) -> List[List[str]]:
+    return [
+        references[i : i + chunk_size] for i in range(0, len(references), chunk_size)
+    ]
@@ -0,0 +1,362 @@
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, Iterator, Optional, Tuple, Union
+from urllib.parse import urlparse
+
+import httpx
+
+from fhir_kindling.util.retry_transport import calculate_sleep
+
+# operations distinguished by the rate limiter, each can be given its own weight
+OPERATIONS = ("read", "search", "transaction", "write")
+# fraction of the quota announced by the server that is used, to stay below the limit instead of hitting it
+QUOTA_HEADROOM = 0.9
+# after a 429 the rate is multiplied by this factor, successful responses increase it again in small steps
+RATE_DECREASE_FACTOR = 0.5
+RATE_INCREASE_RATIO = 0.02
+# reset values larger than this are unix timestamps instead of seconds
+EPOCH_THRESHOLD = 10**9
+
+
+class RateLimiter:
+    """
+    Proactive limit of the requests sent to a server: a token bucket refilled with `rate` tokens per second, where a
+    request takes the weight of its operation in tokens, and a cap on the number of requests in flight. One limiter
+    is shared by the sync and async clients of a server and by all threads and event loops using it.
+
+    The limiter adapts to the server: the rate is reduced to the quota announced in `RateLimit-Remaining` and
+    `RateLimit-Reset` (or `X-RateLimit-*`) headers, and after a 429 response no request is sent until the
+    `Retry-After` time has passed.
+    """
+
+    def __init__(
+        self,
+        rate: Optional[float] = None,
+        burst: Optional[float] = None,
+        max_in_flight: Optional[int] = None,
+        weights: Dict[str, float] = None,
+        adaptive: bool = True,
+    ):
+        """
+        Args:
+            rate: tokens added per second, None to only limit the requests in flight until the server announces a quota
+            burst: capacity of the bucket, defaults to one second of tokens
+            max_in_flight: maximum number of requests sent at the same time
+            weights: tokens taken by a request per operation (read, search, transaction, write), defaults to 1
+            adaptive: whether to adjust the rate to the RateLimit and Retry-After headers of the responses
+        """
+        if rate is not None and rate <= 0:
+            raise ValueError(f"rate must be positive, actual {rate}")
+        if max_in_flight is not None and max_in_flight < 1:
+            raise ValueError(
+                f"max_in_flight must be at least 1, actual {max_in_flight}"
+            )
+        unknown = set(weights or {}) - set(OPERATIONS)
+        if unknown:
+            raise ValueError(
+                f"Unknown operations {unknown}, expected one of {OPERATIONS}"
+            )
+        self.max_rate = rate if rate is not None else math.inf
+        self.rate = self.max_rate
+        self.burst = burst if burst is not None else max(rate or 1, 1)
+        self.max_in_flight = max_in_flight
+        self.weights = {operation: 1.0 for operation in OPERATIONS}
+        self.weights.update(weights or {})
+        self.adaptive = adaptive
+
+        self.tokens = float(self.burst)
+        self.in_flight = 0
+        # time spent waiting for tokens or a free slot and the number of throttled (429) responses
+        self.wait_time = 0.0
+        self.throttled = 0
+
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+        self._slot_released = threading.Condition(self._lock)
+        self._async_waiters: Deque[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = (
+            deque()
+        )
+
+    def acquire(self, operation: str = "read"):
+        """
+        Wait until a request of the given operation may be sent.
+        """
+        wait = self._reserve(self.weights[operation])
+        if wait > 0:
+            time.sleep(wait)
+        if self.max_in_flight is None:
+            return
+        with self._slot_released:
+            started = time.monotonic()
+            while self.in_flight >= self.max_in_flight:
+                self._slot_released.wait()
+            self.in_flight += 1
+            self.wait_time += time.monotonic() - started
+
+    async def acquire_async(self, operation: str = "read"):
+        """
+        Asynchronously wait until a request of the given operation may be sent, without blocking the event loop.
+        """
+        wait = self._reserve(self.weights[operation])
+        if wait > 0:
+            await asyncio.sleep(wait)
+        if self.max_in_flight is None:
+            return
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        while True:
+            with self._lock:
+                if self.in_flight < self.max_in_flight:
+                    self.in_flight += 1
+                    self.wait_time += time.monotonic() - started
+                    return
+                waiter = (loop, loop.create_future())
+                self._async_waiters.append(waiter)
+            try:
+                await waiter[1]
+            except asyncio.CancelledError:
+                with self._lock:
+                    if waiter in self._async_waiters:
+                        self._async_waiters.remove(waiter)
+                    else:
+                        # pass on the wake up this waiter received
+                        self._wake_waiter()
+                raise
+
+    def release(self):
+        """
+        Free the slot of a request that was sent.
+        """
+        if self.max_in_flight is None:
+            return
+        with self._lock:
+            self.in_flight -= 1
+            self._wake_waiter()
+
+    def update(self, response: httpx.Response):
+        """
+        Adjust the rate to the rate limit headers and throttling responses of the server.
+        """
+        if not self.adaptive:
+            return
+        with self._lock:
+            if response.status_code == httpx.codes.TOO_MANY_REQUESTS:
+                self._throttle(response.headers)
+                return
+            quota = _quota(response.headers)
+            if quota is not None:
+                remaining, reset = quota
+                self._refill(time.monotonic())
+                self.rate = max(
+                    min(self.max_rate, QUOTA_HEADROOM * remaining / reset),
+                    1 / reset,
+                )
+                self.tokens = min(self.tokens, remaining)
+            elif self.rate < self.max_rate:
+                self.rate = min(
+                    self.max_rate, self.rate + RATE_INCREASE_RATIO * self.max_rate
+                )
+
+    def as_dict(self) -> Dict[str, Union[int, float]]:
+        return {
+            "rate": self.rate,
+            "tokens": self.tokens,
+            "in_flight": self.in_flight,
+            "wait_time": self.wait_time,
+            "throttled": self.throttled,
+        }
+
+    def _reserve(self, weight: float) -> float:
+        """
+        Take the tokens of a request from the bucket, the balance may become negative.
+
+        Returns:
+            the time in seconds until the request may be sent
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self._blocked_until - now)
+            if math.isfinite(self.rate):
+                self._refill(now)
+                self.tokens -= weight
+                if self.tokens < 0:
+                    # tokens are added again from the last update, which is in the future while blocked
+                    wait = max(wait, self._updated - now - self.tokens / self.rate)
+            self.wait_time += wait
+            return wait
+
+    def _refill(self, now: float):
+        if now > self._updated:
+            if math.isfinite(self.rate):
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self._updated) * self.rate
+                )
+            self._updated = now
+
+    def _throttle(self, headers: httpx.Headers):
+        self.throttled += 1
+        retry_after = calculate_sleep(1, headers, backoff_factor=1, jitter_ratio=0)
+        now = time.monotonic()
+        self._blocked_until = max(self._blocked_until, now + retry_after)
+        if math.isfinite(self.rate):
+            self._refill(now)
+            self.rate = self.rate * RATE_DECREASE_FACTOR
+            # no tokens are added while the server is blocking requests
+            self.tokens = min(self.tokens, 0.0)
+            self._updated = self._blocked_until
+
+    def _wake_waiter(self):
+        # called with the lock held, a woken waiter checks again for a free slot
+        self._slot_released.notify()
+        while self._async_waiters:
+            loop, future = self._async_waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(_set_future_result, future)
+                return
+            except RuntimeError:
+                # the loop of the waiter was closed
+                continue
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__}(rate={self.rate}, burst={self.burst}, "
+            f"max_in_flight={self.max_in_flight}, in_flight={self.in_flight})>"
+        )
+
+
+class RateLimitTransport(httpx.AsyncBaseTransport, httpx.BaseTransport):
+    """
+    Transport sending the requests of a client through a RateLimiter. A request keeps its in-flight slot until its
+    response is closed, so responses that are still being streamed count against the limit.
+    """
+
+    def __init__(
+        self,
+        wrapped_transport: Union[httpx.BaseTransport, httpx.AsyncBaseTransport],
+        limiter: RateLimiter,
+        api_address: str,
+    ):
+        """
+        Args:
+            wrapped_transport: the transport sending the requests
+            limiter: the rate limiter shared by the transports of a server
+            api_address: base address of the server, transaction bundles are posted to it
+        """
+        self.wrapped_transport = wrapped_transport
+        self.limiter = limiter
+        self.base_path = urlparse(api_address).path.rstrip("/")
+
+    def operation(self, request: httpx.Request) -> str:
+        """
+        Classify a request as read, search, transaction or write operation.
+        """
+        path = request.url.path.rstrip("/")
+        if request.method == "POST" and path == self.base_path:
+            return "transaction"
+        if path.endswith("_search") or (request.method == "GET" and request.url.query):
+            return "search"
+        if request.method in ("GET", "HEAD"):
+            return "read"
+        return "write"
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        self.limiter.acquire(self.operation(request))
+        try:
+            response = self.wrapped_transport.handle_request(request)
+        except BaseException:
+            self.limiter.release()
+            raise
+        self.limiter.update(response)
+        self._release_on_close(response)
+        return response
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await self.limiter.acquire_async(self.operation(request))
+        try:
+            response = await self.wrapped_transport.handle_async_request(request)
+        except BaseException:
+            self.limiter.release()
+            raise
+        self.limiter.update(response)
+        self._release_on_close(response)
+        return response
+
+    def _release_on_close(self, response: httpx.Response):
+        if isinstance(response.stream, httpx.ByteStream):
+            # the body is already in memory, the request does not occupy the server any longer
+            self.limiter.release()
+        else:
+            response.stream = ReleasingStream(response.stream, self.limiter)
+
+    def close(self) -> None:
+        self.wrapped_transport.close()
+
+    async def aclose(self) -> None:
+        await self.wrapped_transport.aclose()
+
+
+class ReleasingStream(httpx.SyncByteStream, httpx.AsyncByteStream):
+    """
+    Response stream releasing the in-flight slot of its request when it is closed.
+    """
+
+    def __init__(
+        self,
+        stream: Union[httpx.SyncByteStream, httpx.AsyncByteStream],
+        limiter: RateLimiter,
+    ):
+        self.stream = stream
+        self.limiter = limiter
+        self._released = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield from self.stream
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.stream:
+            yield chunk
+
+    def close(self) -> None:
+        try:
+            self.stream.close()
+        finally:
+            self._release()
+
+    async def aclose(self) -> None:
+        try:
+            await self.stream.aclose()
+        finally:
+            self._release()
+
+    def _release(self):
+        if not self._released:
+            self._released = True
+            self.limiter.release()
+
+
+def _quota(headers: httpx.Headers) -> Optional[Tuple[float, float]]:
+    """
+    Parse the remaining requests and the seconds until the quota is reset from the rate limit headers.
+    """
+    for prefix in ("RateLimit", "X-RateLimit"):
+        remaining = headers.get(f"{prefix}-Remaining")
+        reset = headers.get(f"{prefix}-Reset")
+        if remaining is None or reset is None:
+            continue
+        try:
+            remaining, reset = float(remaining), float(reset)
+        except ValueError:
+            return None
+        if reset > EPOCH_THRESHOLD:
+            reset = reset - time.time()
+        return remaining, max(reset, 1.0)
+    return None
+
+
+def _set_future_result(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
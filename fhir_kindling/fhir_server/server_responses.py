@@ -1,11 +1,15 @@
 import json
-from typing import List
+import pathlib
+from typing import List, Union
 
+import orjson
 from fhir.resources.bundle import Bundle
 from fhir.resources.reference import Reference
 from fhir.resources.resource import Resource
 from httpx import Response
 
+from fhir_kindling.util.resources import construct_resource
+
 
 class CreateResponse:
     @staticmethod
@@ -29,7 +33,10 @@ class ResourceCreateResponse(CreateResponse):
     resource_id: str = None
     reference: Reference = None
 
-    def __init__(self, server_response_dict: dict, resource: Resource):
+    def __init__(self, server_response_dict: dict, resource: Union[Resource, dict]):
+        if isinstance(resource, dict):
+            # lightweight model without validation for resources uploaded as dictionaries
+            resource = construct_resource(resource)
         self.resource = resource
         resource_id, location, version = self._process_location_header(
             server_response_dict
@@ -50,12 +57,22 @@ class ResourceCreateResponse(CreateResponse):
 
 class BundleCreateResponse:
     create_responses: List[ResourceCreateResponse] = None
+    batch_sizes: List[int] = None
+    batch_size: int = None
 
-    def __init__(self, server_response: Response, bundle: Bundle):
+    def __init__(
+        self,
+        server_response: Response,
+        bundle: Bundle = None,
+        resources: List[Union[Resource, dict]] = None,
+    ):
+        if resources is None:
+            resources = [entry.resource for entry in bundle.entry]
         self.create_responses = []
-        for i, entry in enumerate(server_response.json()["entry"]):
-            resource = bundle.entry[i].resource
-            create_response = ResourceCreateResponse(entry["response"], resource)
+        self.batch_sizes = [len(resources)]
+        self.batch_size = len(resources)
+        for i, entry in enumerate(orjson.loads(server_response.content)["entry"]):
+            create_response = ResourceCreateResponse(entry["response"], resources[i])
             self.create_responses.append(create_response)
 
     @property
@@ -79,6 +96,7 @@ class TransferResponse:
     create_responses: List[ResourceCreateResponse]
     linkage: dict
     n_transferred: int
+    duration: Union[float, None]
 
     def __init__(
         self,
@@ -86,12 +104,23 @@ class TransferResponse:
         destination_server: str,
         create_responses: List[ResourceCreateResponse],
         linkage: dict = None,
+        duration: float = None,
     ):
         self.origin_server = origin_server
         self.destination_server = destination_server
         self.create_responses = create_responses
         self.linkage = linkage
         self.n_transferred = len(create_responses)
+        self.duration = duration
+
+    @property
+    def throughput(self) -> Union[float, None]:
+        """
+        Number of transferred resources per second.
+        """
+        if not self.duration:
+            return None
+        return self.n_transferred / self.duration
 
     def save_linkage(self, filename: str):
         with open(filename, "w") as f:
@@ -101,6 +130,11 @@ class TransferResponse:
         return (
             f"TransferResponse origin({self.origin_server}) -> destination ({self.destination_server})\n"
             f"n_transferred: {self.n_transferred}, linkage: {'stored' if self.linkage else 'not stored'}"
+            + (
+                f", duration: {self.duration:.2f}s ({self.throughput:.1f} resources/s)"
+                if self.duration
+                else ""
+            )
         )
 
     def __repr__(self):
@@ -110,6 +144,108 @@ class TransferResponse:
         )
 
 
+class BulkExportFile:
+    resource_type: str
+    url: str
+    count: Union[int, None]
+    path: Union[pathlib.Path, None]
+
+    def __init__(self, output_dict: dict):
+        self.resource_type = output_dict["type"]
+        self.url = output_dict["url"]
+        self.count = output_dict.get("count")
+        self.path = None
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__}(resource_type={self.resource_type}, url={self.url}, count={self.count}"
+            f"{f', path={self.path}' if self.path else ''})>"
+        )
+
+
+class BulkExportResponse:
+    transaction_time: str
+    request: str
+    requires_access_token: bool
+    output: List[BulkExportFile]
+    errors: List[BulkExportFile]
+    status_url: str
+
+    def __init__(self, manifest: dict, status_url: str = None):
+        self.transaction_time = manifest.get("transactionTime")
+        self.request = manifest.get("request")
+        self.requires_access_token = manifest.get("requiresAccessToken", False)
+        self.output = [BulkExportFile(output) for output in manifest.get("output", [])]
+        self.errors = [BulkExportFile(error) for error in manifest.get("error", [])]
+        self.status_url = status_url
+
+    @property
+    def resource_types(self) -> List[str]:
+        return sorted({output.resource_type for output in self.output})
+
+    @property
+    def files(self) -> List[pathlib.Path]:
+        return [output.path for output in self.output if output.path]
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__}(transaction_time={self.transaction_time}, "
+            f"resource_types={self.resource_types}, n_files={len(self.output)}, n_errors={len(self.errors)})>"
+        )
+
+
+class NdjsonUploadResponse:
+    # only the first errors are kept, so the memory usage does not grow with the number of failed entries
+    MAX_ERRORS = 100
+
+    n_uploaded: int
+    n_errors: int
+    references: Union[List[str], None]
+    errors: List[dict]
+    import_manifest: Union[dict, None]
+
+    def __init__(self, import_manifest: dict = None, keep_references: bool = False):
+        self.references = [] if keep_references else None
+        self.errors = []
+        self.import_manifest = import_manifest
+        self.n_uploaded = 0
+        self.n_errors = 0
+        if import_manifest:
+            self.n_uploaded = sum(
+                output.get("count", 0) for output in import_manifest.get("output", [])
+            )
+
+    def add_batch_response(self, batch_response: dict):
+        """
+        Add the results of an uploaded batch bundle to the response.
+
+        Args:
+            batch_response: the batch-response bundle returned by the server
+        """
+        for entry in batch_response.get("entry", []):
+            entry_response = entry.get("response", {})
+            location = entry_response.get("location")
+            if entry_response.get("status", "").startswith("2") and location:
+                # location has the form [base/]{resource_type}/{id}/_history/{version}
+                if self.references is not None:
+                    split_location = location.split("/")
+                    self.references.append("/".join(split_location[-4:-2]))
+                self.n_uploaded += 1
+            else:
+                self.n_errors += 1
+                if len(self.errors) < self.MAX_ERRORS:
+                    self.errors.append(
+                        entry_response.get("outcome")
+                        or {"status": entry_response.get("status")}
+                    )
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__}(n_uploaded={self.n_uploaded}, n_errors={self.n_errors}, "
+            f"import={self.import_manifest is not None})>"
+        )
+
+
 class UpdateResponse:
     # TODO: implement
     def __init__(self, server_response: Response):
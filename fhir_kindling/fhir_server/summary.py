@@ -1,9 +1,12 @@
 from __future__ import annotations
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from typing import TYPE_CHECKING, List, Optional
 
 # from fhir_kindling.fhir_server.fhir_server import FhirServer
 import tqdm
+from fhir.resources.capabilitystatement import CapabilityStatement
 from pydantic import BaseModel
 
 from fhir_kindling.util.resources import valid_resource_name
@@ -26,58 +29,118 @@ class ServerSummary(BaseModel):
         return [r for r in self.resources if r.count > 0]
 
 
+def searchable_resources(capabilities: CapabilityStatement) -> List[str]:
+    """
+    Get the resource types of the server that support the search-type interaction. Types for which the capability
+    statement lists no interactions are assumed to be searchable.
+
+    Args:
+        capabilities: capability statement of the server
+
+    Returns:
+        list of the searchable resource types
+    """
+    resources = []
+    for resource in capabilities.rest[0].resource or []:
+        interactions = {interaction.code for interaction in resource.interaction or []}
+        if interactions and "search-type" not in interactions:
+            continue
+        resources.append(resource.type)
+    return resources
+
+
 def create_server_summary(
-    server: "FhirServer", resources: List[str], display: bool = True
+    server: "FhirServer",
+    resources: List[str],
+    display: bool = True,
+    max_concurrency: int = 8,
 ) -> ServerSummary:
     """
-    Create a summary of the server's resources and counts.
+    Create a summary of the server's resources and counts. The counts are requested concurrently with
+    `_summary=count` searches over the connection pool of the server.
+
     Args:
         server: FhirServer object to summarize
         resources: list of resources to query/count
         display: whether to display a progress bar
+        max_concurrency: maximum number of count requests sent at the same time
 
     Returns:
         ServerSummary object containing a list of ResourceSummary objects
     """
-    resource_summaries = []
-    summary = {"name": server.api_address}
+    resources = _valid_resources(resources)
+    client = server._sync_client()
+    with tqdm.tqdm(total=len(resources), disable=not display) as pbar:
 
-    pbar = tqdm.tqdm(resources, disable=not display)
-    for resource in pbar:
-        pbar.set_description(f"Querying {resource}")
-        resource, valid = valid_resource_name(resource, strict=False)
-        if not valid:
-            continue
-        count = server.query(resource).count()
-        resource_summaries.append(ResourceSummary(resource=resource, count=count))
-    summary["resources"] = resource_summaries
-    return ServerSummary(**summary)
+        def count(resource: str) -> int:
+            response = client.get(_count_url(server, resource))
+            response.raise_for_status()
+            pbar.set_description(f"Counted {resource}")
+            pbar.update()
+            return response.json()["total"]
+
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(max_concurrency, len(resources)))
+        ) as executor:
+            counts = list(executor.map(count, resources))
+    return _server_summary(server, resources, counts)
 
 
 async def create_server_summary_async(
-    server: "FhirServer", resources: List[str], display: bool = True
+    server: "FhirServer",
+    resources: List[str],
+    display: bool = True,
+    max_concurrency: int = 8,
 ) -> ServerSummary:
     """
-    Asynchronously create a summary of the server's resources and counts.
+    Asynchronously create a summary of the server's resources and counts, see `create_server_summary`.
 
     Args:
         server: FhirServer object to summarize
         resources: list of resources to query/count
         display: whether to display a progress bar
+        max_concurrency: maximum number of count requests sent at the same time
 
     Returns:
         ServerSummary object containing a list of ResourceSummary objects
     """
-    resource_summaries = []
-    summary = {"name": server.api_address}
-
-    pbar = tqdm.tqdm(resources, disable=not display)
-    for resource in pbar:
-        pbar.set_description(f"Querying {resource}")
+    resources = _valid_resources(resources)
+    client = server._async_client()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    with tqdm.tqdm(total=len(resources), disable=not display) as pbar:
+
+        async def count(resource: str) -> int:
+            async with semaphore:
+                response = await client.get(_count_url(server, resource))
+            response.raise_for_status()
+            pbar.set_description(f"Counted {resource}")
+            pbar.update()
+            return response.json()["total"]
+
+        counts = await asyncio.gather(*[count(resource) for resource in resources])
+    return _server_summary(server, resources, counts)
+
+
+def _valid_resources(resources: List[str]) -> List[str]:
+    valid_resources = []
+    for resource in resources:
         resource, valid = valid_resource_name(resource, strict=False)
-        if not valid:
-            continue
-        count = await server.query_async(resource).count()
-        resource_summaries.append(ResourceSummary(resource=resource, count=count))
-    summary["resources"] = resource_summaries
-    return ServerSummary(**summary)
+        if valid:
+            valid_resources.append(resource)
+    return valid_resources
+
+
+def _count_url(server: "FhirServer", resource: str) -> str:
+    return f"{server.api_address}/{resource}?_summary=count"
+
+
+def _server_summary(
+    server: "FhirServer", resources: List[str], counts: List[int]
+) -> ServerSummary:
+    return ServerSummary(
+        name=server.api_address,
+        resources=[
+            ResourceSummary(resource=resource, count=count)
+            for resource, count in zip(resources, counts)
+        ],
+    )
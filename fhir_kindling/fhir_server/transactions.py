@@ -1,6 +1,7 @@
 from enum import Enum
 from typing import List, Union
 
+import orjson
 from fhir.resources import FHIRAbstractModel, construct_fhir_element
 from fhir.resources.bundle import Bundle, BundleEntry, BundleEntryRequest
 from fhir.resources.reference import Reference
@@ -66,6 +67,127 @@ def make_transaction_bundle(
     return Bundle(**bundle.dict(exclude_none=True))
 
 
+def make_transaction_bundle_bytes(
+    transaction_type: TransactionType = TransactionType.TRANSACTION,
+    method: Union[TransactionMethod, str] = TransactionMethod.POST,
+    resources: Union[List[Resource], List[dict]] = None,
+    references: Union[List[Reference], List[str]] = None,
+    validate: bool = False,
+) -> bytes:
+    """
+    Create a transaction bundle serialized to json. In contrast to make_transaction_bundle, the bundle is built from
+    plain dictionaries and serialized in a single pass without validating it, resources are only validated when
+    requested.
+
+    Args:
+        transaction_type: the type of the bundle, transaction or batch
+        method: the method to use for the entries of the bundle
+        resources: resources to create the entries for, either FHIR resource objects or dictionaries
+        references: references to create the entries for if no resources are given
+        validate: whether to validate the resources against their FHIR resource model
+
+    Returns:
+        The json encoded bundle
+    """
+    if isinstance(method, str):
+        method = TransactionMethod(method)
+    _validate_transaction_input(method, references, resources)
+
+    if resources:
+        entries = [
+            make_transaction_entry_dict(method, resource=resource, validate=validate)
+            for resource in resources
+        ]
+    else:
+        entries = [
+            make_transaction_entry_dict(
+                method,
+                url=(
+                    reference.reference
+                    if isinstance(reference, Reference)
+                    else reference
+                ),
+            )
+            for reference in references
+        ]
+
+    bundle = {
+        "resourceType": "Bundle",
+        "type": TransactionType(transaction_type).value,
+        "entry": entries,
+    }
+    # the encoder of the fhir models serializes values orjson does not support natively e.g. decimals
+    return orjson.dumps(bundle, default=FHIRAbstractModel.__json_encoder__)
+
+
+def make_transaction_entry_dict(
+    method: Union[TransactionMethod, str],
+    url: str = None,
+    resource: Union[Resource, dict] = None,
+    validate: bool = False,
+) -> dict:
+    """Create a transaction entry as dictionary, see make_transaction_entry.
+
+    Args:
+        method: the method to use for the transaction one of GET, POST, PUT, DELETE
+        url: optional relative url to use for the transaction
+        resource: optional FHIR resource or dictionary to use for the transaction
+        validate: whether to validate the resource against its FHIR resource model
+
+    Returns:
+        The transaction entry as dictionary
+    """
+    if isinstance(method, str):
+        method = TransactionMethod(method)
+
+    if not url and resource is None:
+        raise ValueError("Either url or resource must be provided.")
+
+    entry = {}
+    if resource is not None:
+        resource = _entry_resource_dict(method, resource, validate)
+        entry["resource"] = resource
+
+        if method == TransactionMethod.POST:
+            url = url or resource["resourceType"]
+        elif method == TransactionMethod.PUT or not url:
+            url = f"{resource['resourceType']}/{resource['id']}"
+
+    entry["request"] = {"method": method.value, "url": url}
+    return entry
+
+
+def _entry_resource_dict(
+    method: TransactionMethod, resource: Union[Resource, dict], validate: bool = False
+) -> dict:
+    if validate:
+        resource = _validate_resource(resource)
+    if isinstance(resource, FHIRAbstractModel):
+        resource = resource.dict()
+    elif isinstance(resource, dict):
+        # copy to not modify the given dictionary when removing the id
+        resource = dict(resource)
+    else:
+        raise ValueError("Resource must be a FHIR resource or a dict")
+
+    if not resource.get("resourceType"):
+        raise ValueError(f"No resource type defined in resource: {resource}")
+    if method == TransactionMethod.PUT and not resource.get("id"):
+        raise ValueError("PUT requires a resource with an id")
+    if method == TransactionMethod.POST:
+        resource.pop("id", None)
+    return resource
+
+
+def _validate_resource(resource: Union[FHIRAbstractModel, dict]) -> FHIRAbstractModel:
+    try:
+        if isinstance(resource, FHIRAbstractModel):
+            return construct_fhir_element(resource.resource_type, resource.dict())
+        return construct_fhir_element(resource.get("resourceType"), resource)
+    except Exception as e:
+        raise ValueError(f"Invalid resource: {resource} \n{e}")
+
+
 def _validate_transaction_input(
     method: Union[TransactionMethod, str],
     references: Union[List[Reference], List[str]],
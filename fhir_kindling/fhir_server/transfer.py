@@ -1,20 +1,39 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, List, OrderedDict, Tuple, Union
+import asyncio
+import pathlib
+import time
+from collections import deque
+from contextlib import nullcontext
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    ContextManager,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import networkx as nx
 import orjson
-from fhir.resources import FHIRAbstractModel, construct_fhir_element
+from fhir.resources import FHIRAbstractModel
+from fhir.resources.operationoutcome import OperationOutcome
 from fhir.resources.resource import Resource
-from pydantic import ValidationError
 from tqdm.autonotebook import tqdm
 
-from fhir_kindling.fhir_query import FhirQuerySync
+from fhir_kindling.fhir_query import FhirQueryAsync, FhirQuerySync
 from fhir_kindling.fhir_server.server_responses import (
+    BundleCreateResponse,
     ResourceCreateResponse,
     TransferResponse,
 )
-from fhir_kindling.util.references import check_missing_references, extract_references
+from fhir_kindling.fhir_server.transfer_checkpoint import (
+    TransferCheckpoint,
+    linkage_key,
+)
+from fhir_kindling.util.references import iter_reference_elements, reference_index
 
 if TYPE_CHECKING:
     from fhir_kindling.fhir_server import FhirServer
@@ -28,6 +47,8 @@ def transfer(
     get_missing: bool = True,
     record_linkage: bool = True,
     display: bool = True,
+    break_cycles: bool = False,
+    checkpoint: Union[str, pathlib.Path] = None,
 ) -> TransferResponse:
     """
     Transfer a list of resources from one server to another.
@@ -40,28 +61,133 @@ def transfer(
         get_missing: Whether to get missing resources from the source server.
         record_linkage: Whether to record the linkage between the source and target resources.
         display: Whether to display a progress bar.
+        break_cycles: Whether to transfer resources that reference each other in a cycle by creating them without the
+            cyclic references first and updating them with the references afterwards. Otherwise, cycles raise a
+            ValueError before any resource is created.
+        checkpoint: Path of a sqlite database storing the progress of the transfer. If a transfer with the same
+            checkpoint failed, the resources created in the previous attempt are not created again.
     """
 
+    start = time.monotonic()
     # get the resources to transfer, including missing references
-    transfer_resources = _get_transfer_resources(source, resources, query, get_missing)
-    transfer_graph = reference_graph(transfer_resources)
+    transfer_graph = _get_transfer_graph(source, resources, query, get_missing)
 
     # process the graph to create the resources on the target server
-    create_responses, linkage = resolve_reference_graph(
-        transfer_graph, target, record_linkage, display
+    with _open_checkpoint(checkpoint, source, target) as transfer_checkpoint:
+        create_responses, linkage = resolve_reference_graph(
+            transfer_graph,
+            target,
+            record_linkage,
+            display,
+            break_cycles=break_cycles,
+            checkpoint=transfer_checkpoint,
+        )
+
+    return TransferResponse(
+        origin_server=source.api_address,
+        destination_server=target.api_address,
+        create_responses=create_responses,
+        linkage=linkage,
+        duration=time.monotonic() - start,
     )
 
+
+async def transfer_async(
+    source: "FhirServer",
+    target: "FhirServer",
+    resources: List[Union[Resource, FHIRAbstractModel]] = None,
+    query: FhirQueryAsync = None,
+    get_missing: bool = True,
+    record_linkage: bool = True,
+    display: bool = True,
+    break_cycles: bool = False,
+    max_concurrency: int = 4,
+    batch_size: int = 500,
+    checkpoint: Union[str, pathlib.Path] = None,
+) -> TransferResponse:
+    """
+    Asynchronously transfer a list of resources from one server to another. The pages of the query are added to the
+    reference graph one at a time and missing references are fetched concurrently. Resources are uploaded as soon as
+    all the resources they reference have been created, so independent parts of the graph and chunks of the same
+    generation are uploaded at the same time and the references of the successors are updated as the create
+    responses arrive.
+
+    The upload only starts once the complete reference graph is built, so that reference cycles are detected before
+    any resource is created. The graph holds every resource of the query and its fetched references, memory usage
+    therefore grows with the number of transferred resources. Split very large transfers into multiple queries.
+
+    Args:
+        source: The server to transfer the resources from.
+        target: The server to transfer the resources to.
+        resources: A list of resources to transfer.
+        query: A FhirQueryAsync object to use to query the source server.
+        get_missing: Whether to get missing resources from the source server.
+        record_linkage: Whether to record the linkage between the source and target resources.
+        display: Whether to display a progress bar.
+        break_cycles: Whether to transfer resources that reference each other in a cycle by creating them without the
+            cyclic references first and updating them with the references afterwards.
+        max_concurrency: Maximum number of requests sent to the source or target server at the same time.
+        batch_size: Maximum number of resources uploaded in one bundle.
+        checkpoint: Path of a sqlite database storing the progress of the transfer. If a transfer with the same
+            checkpoint failed, the resources created in the previous attempt are not created again.
+
+    Returns:
+        Transfer response containing the create responses, the linkage and the duration of the transfer.
+    """
+    start = time.monotonic()
+    graph = await _get_transfer_graph_async(
+        source, resources, query, get_missing, max_concurrency
+    )
+    deferred = _defer_cycle_references(graph) if break_cycles else {}
+    # fail for cycles before any resource is created
+    topological_generations(graph)
+
+    with _open_checkpoint(checkpoint, source, target) as transfer_checkpoint, tqdm(
+        total=graph.number_of_nodes(), unit=" resources", disable=not display
+    ) as p_bar:
+        create_responses, target_references = await _upload_reference_graph_async(
+            graph, target, max_concurrency, batch_size, p_bar, transfer_checkpoint
+        )
+        if transfer_checkpoint is None or not transfer_checkpoint.completed:
+            if deferred:
+                await target.update_async(
+                    _deferred_reference_updates(graph, deferred, target_references)
+                )
+            if transfer_checkpoint is not None:
+                transfer_checkpoint.complete()
+
+    linkage = {}
+    if record_linkage:
+        linkage = {linkage_key(node): ref for node, ref in target_references.items()}
     return TransferResponse(
         origin_server=source.api_address,
         destination_server=target.api_address,
         create_responses=create_responses,
         linkage=linkage,
+        duration=time.monotonic() - start,
+    )
+
+
+def _open_checkpoint(
+    checkpoint: Union[str, pathlib.Path, None],
+    source: "FhirServer",
+    target: "FhirServer",
+) -> ContextManager[Optional[TransferCheckpoint]]:
+    if checkpoint is None:
+        return nullcontext()
+    return TransferCheckpoint(
+        checkpoint,
+        origin_server=source.api_address,
+        destination_server=target.api_address,
     )
 
 
-def reference_graph(resources: List[Union[Resource, FHIRAbstractModel]]) -> nx.DiGraph:
+def reference_graph(
+    resources: List[Union[Resource, FHIRAbstractModel, dict]],
+) -> nx.DiGraph:
     """
-    Creates a graph of the references in a list of resources.
+    Creates a graph of the references in a list of resources. The nodes hold the resources as dictionaries and each
+    edge holds the reference elements of the referencing resource that point to the referenced resource.
 
     Args:
         resources: List of resource to create the graph from.
@@ -70,20 +196,94 @@ def reference_graph(resources: List[Union[Resource, FHIRAbstractModel]]) -> nx.D
         A directed graph depicting the references in the resources.
     """
     dg = nx.DiGraph()
+    _add_to_reference_graph(dg, resources)
+    return dg
+
+
+def _add_to_reference_graph(
+    dg: nx.DiGraph, resources: List[Union[Resource, FHIRAbstractModel, dict]]
+):
     for resource in resources:
-        path = resource.relative_path()
+        resource = _resource_dict(resource)
+        path = f"{resource['resourceType']}/{resource['id']}"
         if path in dg:
             dg.nodes[path]["resource"] = resource
         else:
             dg.add_node(path, resource=resource)
-        for reference in extract_references(resource):
-            reference_path = f"{reference[1]}/{reference[2]}"
+        # the edges hold the reference elements of the resource, which are rewritten in place
+        for reference_path, elements in reference_index(resource).items():
             if reference_path not in dg:
                 dg.add_node(reference_path, resource=None)
-            dg.add_edge(
-                reference_path, path, field=reference[0], list_field=reference[3]
-            )
-    return dg
+            dg.add_edge(reference_path, path, references=elements)
+
+
+def _resource_dict(resource: Union[Resource, FHIRAbstractModel, dict]) -> dict:
+    if isinstance(resource, dict):
+        return resource
+    return orjson.loads(resource.json())
+
+
+def topological_generations(graph: nx.DiGraph) -> List[List[str]]:
+    """
+    Split the nodes of a reference graph into generations, so that all resources referenced by the resources of a
+    generation are contained in the previous generations. Each node and edge is only visited once, by counting the
+    unprocessed predecessors of every node.
+
+    Args:
+        graph: The reference graph, with edges pointing from referenced to referencing resources.
+
+    Returns:
+        List of generations, each containing the nodes that can be created at the same time.
+
+    Raises:
+        ValueError: if the graph contains a reference cycle
+    """
+    in_degree = dict(graph.in_degree())
+    generation = [node for node, degree in in_degree.items() if degree == 0]
+    generations = []
+    n_scheduled = 0
+    while generation:
+        generations.append(generation)
+        n_scheduled += len(generation)
+        next_generation = []
+        for node in generation:
+            for successor in graph.successors(node):
+                in_degree[successor] -= 1
+                if in_degree[successor] == 0:
+                    next_generation.append(successor)
+        generation = next_generation
+
+    if n_scheduled < len(in_degree):
+        remaining = [node for node, degree in in_degree.items() if degree > 0]
+        cycle = nx.find_cycle(graph.subgraph(remaining))
+        cycle_path = " -> ".join([edge[0] for edge in cycle] + [cycle[-1][1]])
+        raise ValueError(
+            f"The resources contain a reference cycle ({cycle_path}) and can not be created in order. "
+            f"To transfer them, set break_cycles=True."
+        )
+    return generations
+
+
+def reference_cycle_edges(graph: nx.DiGraph) -> List[Tuple[str, str]]:
+    """
+    Find the references that are part of a reference cycle, i.e. the edges between the nodes of a strongly connected
+    component of the graph, including resources that reference themselves.
+
+    Args:
+        graph: The reference graph.
+
+    Returns:
+        List of edges (referenced node, referencing node) that are part of a cycle.
+    """
+    edges = []
+    for component in nx.strongly_connected_components(graph):
+        if len(component) > 1:
+            edges.extend(graph.subgraph(component).edges)
+        else:
+            node = next(iter(component))
+            if graph.has_edge(node, node):
+                edges.append((node, node))
+    return edges
 
 
 def resolve_reference_graph(
@@ -91,52 +291,158 @@ def resolve_reference_graph(
     target: "FhirServer",
     record_linkage: bool,
     display: bool,
+    break_cycles: bool = False,
+    checkpoint: TransferCheckpoint = None,
+    batch_size: int = 1000,
 ) -> Tuple[List[ResourceCreateResponse], dict]:
-    nodes = list(graph.nodes)
+    deferred = _defer_cycle_references(graph) if break_cycles else {}
+    # compute the creation order up front, this also fails early for cycles
+    generations = topological_generations(graph)
 
-    linkage = {}
+    # resources created before a restart are not uploaded again
+    created = checkpoint.target_references if checkpoint is not None else {}
+    target_references = {}
     create_responses = []
-    # iterate over the graph and update the references off all successors node to match the newly created resources
-    # on the target server
-
-    with tqdm(total=len(nodes), disable=not display) as pbar:
-        while len(nodes) > 0:
-            top_nodes = [
-                node for node in nodes if len(list(graph.predecessors(node))) == 0
-            ]
-
-            # get the resources from the graph
-
-            resources = []
-
-            for node in top_nodes:
-                try:
-                    resources.append(_resource_from_graph_node(graph, node))
-                except Exception as e:
-                    print(e)
-                    print(node)
-                    raise e
-            # insert the resources into the target server
-            create_response = target.add_all(resources=resources)
-
-            # iterate through the top nodes and update the successors with the references from the target server
-            for node, reference in zip(top_nodes, create_response.references):
-                if record_linkage:
-                    hash_origin = hash(node)
-                    linkage[hash_origin] = reference.reference
-                _update_successors(graph, node, reference.reference)
-
-            # add the create response to the list of responses
-            create_responses.extend(create_response.create_responses)
-
-            # remove the processed top nodes from the graph
-            graph.remove_nodes_from(top_nodes)
-            nodes = list(graph.nodes)
-            pbar.update(len(top_nodes))
+    # create the resources generation by generation and update the references of all successor nodes to match the
+    # newly created resources on the target server
+    with tqdm(total=graph.number_of_nodes(), disable=not display) as pbar:
+        for generation in generations:
+            pending = []
+            for node in generation:
+                if node in created:
+                    target_references[node] = created[node]
+                    _update_successors(graph, node, created[node])
+                else:
+                    pending.append(node)
+            pbar.update(len(generation) - len(pending))
+
+            create_responses.extend(
+                _create_generation(
+                    graph, target, pending, batch_size, checkpoint, target_references
+                )
+            )
+            pbar.update(len(pending))
 
+    if checkpoint is None or not checkpoint.completed:
+        if deferred:
+            _restore_deferred_references(graph, target, deferred, target_references)
+        if checkpoint is not None:
+            checkpoint.complete()
+
+    linkage = {}
+    if record_linkage:
+        linkage = {linkage_key(node): ref for node, ref in target_references.items()}
     return create_responses, linkage
 
 
+def _create_generation(
+    graph: nx.DiGraph,
+    target: "FhirServer",
+    nodes: List[str],
+    batch_size: int,
+    checkpoint: Optional[TransferCheckpoint],
+    target_references: Dict[str, str],
+) -> List[ResourceCreateResponse]:
+    """
+    Create the resources of a generation in chunks of batch_size, each chunk is uploaded in a single bundle and
+    checkpointed once it is created.
+    """
+    create_responses = []
+    for chunk_start in range(0, len(nodes), batch_size):
+        chunk = nodes[chunk_start : chunk_start + batch_size]
+        resources = [_graph_node_resource(graph, node) for node in chunk]
+        create_response = target.add_all(resources=resources, batch_size=batch_size)
+        references = [reference.reference for reference in create_response.references]
+        if checkpoint is not None:
+            checkpoint.record_references(zip(chunk, references))
+        for node, reference in zip(chunk, references):
+            target_references[node] = reference
+            _update_successors(graph, node, reference)
+        create_responses.extend(create_response.create_responses)
+    return create_responses
+
+
+def _defer_cycle_references(graph: nx.DiGraph) -> Dict[str, Dict[str, Any]]:
+    """
+    Remove the references that are part of a cycle from the graph and from the resources referencing them.
+
+    Returns:
+        A copy of the original value of the top level fields containing the removed references by node
+    """
+    cyclic_references = {}
+    for referenced, node in reference_cycle_edges(graph):
+        cyclic_references.setdefault(node, set()).add(referenced)
+        graph.remove_edge(referenced, node)
+
+    deferred = {}
+    for node, referenced in cyclic_references.items():
+        resource = graph.nodes[node]["resource"]
+        paths = [
+            path
+            for path, element in iter_reference_elements(resource)
+            if element["reference"] in referenced
+        ]
+        deferred[node] = {
+            field: orjson.loads(orjson.dumps(resource[field]))
+            for field in {path[0] for path in paths}
+        }
+        # removing list items shifts the paths of the following items, so the elements are removed back to front
+        for path in sorted(paths, reverse=True):
+            _remove_reference_element(resource, path)
+    return deferred
+
+
+def _remove_reference_element(resource: dict, path: Tuple[Union[str, int], ...]):
+    """
+    Remove a reference element from a resource by removing the innermost list item containing it, or the top level
+    field if it is not part of a list. Lists left empty are removed as well.
+    """
+    list_positions = [i for i, key in enumerate(path) if isinstance(key, int)]
+    if not list_positions:
+        resource.pop(path[0], None)
+        return
+    position = list_positions[-1]
+    parent = resource
+    for key in path[: position - 1]:
+        parent = parent[key]
+    items = parent[path[position - 1]]
+    items.pop(path[position])
+    if not items:
+        parent.pop(path[position - 1])
+
+
+def _restore_deferred_references(
+    graph: nx.DiGraph,
+    target: "FhirServer",
+    deferred: Dict[str, Dict[str, Any]],
+    target_references: Dict[str, str],
+):
+    """
+    Update the resources created without their cyclic references, once all referenced resources exist on the target
+    server.
+    """
+    target.update(_deferred_reference_updates(graph, deferred, target_references))
+
+
+def _deferred_reference_updates(
+    graph: nx.DiGraph,
+    deferred: Dict[str, Dict[str, Any]],
+    target_references: Dict[str, str],
+) -> List[dict]:
+    resources = []
+    for node, fields in deferred.items():
+        resource = graph.nodes[node]["resource"]
+        for field, value in fields.items():
+            for _, element in iter_reference_elements(value):
+                reference = target_references.get(element["reference"])
+                if reference:
+                    element["reference"] = reference
+            resource[field] = value
+        resource["id"] = target_references[node].split("/")[-1]
+        resources.append(resource)
+    return resources
+
+
 def _update_successors(graph: nx.DiGraph, node: str, reference: str):
     """
     Update the successors of a node in a graph with the updated reference from the new server.
@@ -147,100 +453,257 @@ def _update_successors(graph: nx.DiGraph, node: str, reference: str):
         reference: The reference to update the node with.
     """
     for successor in graph.successors(node):
-        field = graph[node][successor]["field"]
-        list_field = graph[node][successor]["list_field"]
-        resource = graph.nodes[successor]["resource"]
-
-        if list_field:
-            # Find the item that references the node
-            reference_list = graph.nodes[successor]["resource"].dict()[field]
-            reference_item = next(
-                (item for item in reference_list if item.get("reference") == str(node)),
-                None,
-            )
-            if reference_item:
-                # update the resource with the new reference
-                index = reference_list.index(reference_item)
-                resource = orjson.loads(resource.json())
-                resource[field][index] = {"reference": reference}
-                graph.nodes[successor]["resource"] = resource
-            else:
-                print("Reference item not found")
-        else:
-            if not isinstance(graph.nodes[successor]["resource"], dict):
-                resource = orjson.loads(resource.json())
-                resource[field] = {"reference": reference}
-                graph.nodes[successor]["resource"] = resource
-            else:
-                graph.nodes[successor]["resource"][field] = reference
+        for element in graph[node][successor]["references"]:
+            element["reference"] = reference
 
 
-def _resource_from_graph_node(graph: nx.DiGraph, node: str) -> FHIRAbstractModel:
-    """
-    Get a resource from a graph node.
+def _get_transfer_graph(
+    source: "FhirServer",
+    resources: List[Union[Resource, FHIRAbstractModel, dict]] = None,
+    query: FhirQuerySync = None,
+    get_missing: bool = True,
+) -> nx.DiGraph:
+    _check_transfer_arguments(resources, query)
+    graph = nx.DiGraph()
+    # if query parameters are given execute the query against the server
+    if query:
+        response = query.all()
+        _add_to_reference_graph(
+            graph, _page_resource_dicts(response.response, response.resource)
+        )
+    else:
+        _add_to_reference_graph(graph, _copy_resources(resources))
+
+    # fetched resources can reference further missing resources
+    missing = _missing_graph_nodes(graph)
+    while missing:
+        if not get_missing:
+            _raise_missing_references(missing)
+        _add_to_reference_graph(
+            graph, _fetched_resources(missing, source.get_many(missing))
+        )
+        missing = _remaining_missing_nodes(graph, missing)
+    return graph
 
-    Args:
-        graph: The graph to get the resource from.
-        node: The node to get the resource from.
 
-    Returns:
-        The resource at the node.
+def _check_transfer_arguments(
+    resources: list, query: Union[FhirQuerySync, FhirQueryAsync]
+):
+    if query and resources:
+        raise ValueError("Cannot specify both query and resources")
+    if not query and not resources:
+        raise ValueError(
+            f"Must specify either query or resources. Query: {query}, Resources: {resources}"
+        )
+
+
+def _raise_missing_references(missing: List[str]):
+    raise ValueError(
+        f"Related resources of the resources to be transferred are missing:\n{missing} \n\n"
+        f"To get these resources, set get_missing=True."
+    )
+
+
+def _remaining_missing_nodes(graph: nx.DiGraph, requested: List[str]) -> List[str]:
+    # references that could not be fetched are not requested again
+    requested = set(requested)
+    return [node for node in _missing_graph_nodes(graph) if node not in requested]
+
+
+def _page_resource_dicts(page: dict, resource_type: str) -> List[dict]:
     """
-    resource = graph.nodes[node]["resource"]
+    The primary and included resources of a page of search results as dictionaries, without OperationOutcomes
+    reported by the server and entries that can not be transferred because they have no id.
+    """
+    resources = []
+    for entry in page.get("entry") or []:
+        resource = entry.get("resource")
+        mode = entry.get("search", {}).get("mode")
+        if not resource or not resource.get("id") or mode == "outcome":
+            continue
+        if mode == "include" or resource.get("resourceType") == resource_type:
+            resources.append(resource)
+    return resources
 
-    if resource:
-        if isinstance(resource, OrderedDict) or isinstance(resource, dict):
-            resource_dict = dict(resource)
-            resource_type = resource_dict.get(
-                "resourceType", resource_dict.get("resource_type")
-            )
-            resource_json = orjson.dumps(resource_dict)
-            try:
-                resource = construct_fhir_element(resource_type, resource_json)
-            except ValidationError as e:
-                print(f"Error creating resource: {e}")
-                print(f"Resource: {resource_dict}")
-                raise e
-            except Exception as e:
-                print(f"Error creating resource: {e}")
-                print(f"Resource: {resource_dict}")
-                raise e
-        elif isinstance(resource, FHIRAbstractModel):
-            pass
-        else:
-            raise ValueError(f"Unknown resource type: {type(resource)}")
-        return resource
-    else:
-        raise ValueError(f"Resource not found for node {node}")
+
+def _copy_resources(
+    resources: List[Union[Resource, FHIRAbstractModel, dict]],
+) -> List[dict]:
+    # the references are rewritten in place, so the given dictionaries are copied
+    return [
+        (
+            orjson.loads(orjson.dumps(resource))
+            if isinstance(resource, dict)
+            else _resource_dict(resource)
+        )
+        for resource in resources
+    ]
 
 
-def _get_transfer_resources(
+async def _get_transfer_graph_async(
     source: "FhirServer",
     resources: List[Union[Resource, FHIRAbstractModel]] = None,
-    query: FhirQuerySync = None,
+    query: FhirQueryAsync = None,
     get_missing: bool = True,
+    max_concurrency: int = 4,
+) -> nx.DiGraph:
+    _check_transfer_arguments(resources, query)
+    graph = nx.DiGraph()
+    if query:
+        # only the graph is kept, not the bundles of the pages
+        resource_type = query.query_parameters.resource
+        async for page in query.iter_bundles():
+            _add_to_reference_graph(graph, _page_resource_dicts(page, resource_type))
+    else:
+        _add_to_reference_graph(graph, _copy_resources(resources))
+
+    # fetched resources can reference further missing resources
+    missing = _missing_graph_nodes(graph)
+    while missing:
+        if not get_missing:
+            _raise_missing_references(missing)
+        fetched = await source.get_many_async(missing, max_concurrency=max_concurrency)
+        _add_to_reference_graph(graph, _fetched_resources(missing, fetched))
+        missing = _remaining_missing_nodes(graph, missing)
+    return graph
+
+
+def _missing_graph_nodes(graph: nx.DiGraph) -> List[str]:
+    return [node for node, resource in graph.nodes(data="resource") if resource is None]
+
+
+def _fetched_resources(
+    references: List[str], resources: List[FHIRAbstractModel]
 ) -> List[FHIRAbstractModel]:
-    if query and resources:
-        raise ValueError("Cannot specify both query and resources")
-    if not query and not resources:
+    # get_many returns an OperationOutcome for each reference that could not be retrieved
+    failed = [
+        f"{reference}: {resource.issue[0].diagnostics}"
+        for reference, resource in zip(references, resources)
+        if isinstance(resource, OperationOutcome)
+        and not reference.startswith("OperationOutcome/")
+    ]
+    if failed:
         raise ValueError(
-            f"Must specify either query or resources. Query: {query}, Resources: {resources}"
+            "Referenced resources could not be retrieved from the source server:\n"
+            + "\n".join(failed)
         )
-    # if query parameters are given execute the query against the server
-    if query:
-        resources = query.all().resource_list
-    # find missing references
-    missing_references = check_missing_references(resources)
-
-    # get missing references
-    if missing_references:
-        if get_missing:
-            missing = source.get_many(missing_references)
-            resources.extend(missing)
-        else:
-            raise ValueError(
-                f"Related resources of the resources to be transferred are missing:\n{missing_references} \n\n"
-                f"To get these resources, set get_missing=True."
+    return resources
+
+
+async def _upload_reference_graph_async(
+    graph: nx.DiGraph,
+    target: "FhirServer",
+    max_concurrency: int,
+    batch_size: int,
+    p_bar: tqdm,
+    checkpoint: TransferCheckpoint = None,
+) -> Tuple[List[ResourceCreateResponse], Dict[str, str]]:
+    """
+    Upload the resources of the graph in chunks as soon as all their predecessors are created, with at most
+    max_concurrency chunks uploaded at the same time. Resources already created according to the checkpoint are not
+    uploaded again.
+
+    Returns:
+        The create responses and the target server reference of each node
+    """
+    scheduler = _UploadScheduler(graph, checkpoint)
+    create_responses = []
+
+    async def upload(nodes: List[str]) -> Tuple[List[str], BundleCreateResponse]:
+        chunk_resources = [_graph_node_resource(graph, node) for node in nodes]
+        response = await target.add_all_async(
+            chunk_resources, batch_size=len(nodes), display=False, max_concurrency=1
+        )
+        return nodes, response
+
+    pending = set()
+    try:
+        while scheduler.ready or pending:
+            while scheduler.ready and len(pending) < max_concurrency:
+                chunk = scheduler.next_chunk(batch_size, p_bar)
+                if chunk:
+                    pending.add(asyncio.create_task(upload(chunk)))
+            if not pending:
+                continue
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
             )
+            for task in done:
+                nodes, response = task.result()
+                create_responses.extend(response.create_responses)
+                scheduler.complete(
+                    nodes, [reference.reference for reference in response.references]
+                )
+                p_bar.update(len(nodes))
+    except BaseException:
+        # stop the remaining uploads if one of them failed
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        raise
+    return create_responses, scheduler.target_references
+
+
+class _UploadScheduler:
+    """
+    Tracks which nodes of a reference graph are ready to be uploaded, i.e. all the nodes they reference have been
+    created on the target server.
+    """
 
-    return resources
+    def __init__(
+        self, graph: nx.DiGraph, checkpoint: Optional[TransferCheckpoint] = None
+    ):
+        self.graph = graph
+        self.checkpoint = checkpoint
+        self.created = checkpoint.target_references if checkpoint is not None else {}
+        self.in_degree = dict(graph.in_degree())
+        self.ready = deque(
+            node for node, degree in self.in_degree.items() if degree == 0
+        )
+        self.target_references = {}
+
+    def complete(self, nodes: List[str], references: List[str]):
+        """
+        Resolve the nodes of an uploaded chunk with the references of the created resources.
+        """
+        if self.checkpoint is not None:
+            self.checkpoint.record_references(zip(nodes, references))
+        for node, reference in zip(nodes, references):
+            self.resolve(node, reference)
+
+    def resolve(self, node: str, reference: str):
+        self.target_references[node] = reference
+        _update_successors(self.graph, node, reference)
+        self.ready.extend(_release_successors(self.graph, node, self.in_degree))
+
+    def next_chunk(self, batch_size: int, p_bar: tqdm) -> List[str]:
+        chunk = []
+        while self.ready and len(chunk) < batch_size:
+            node = self.ready.popleft()
+            # resources created before a restart are resolved without uploading them again
+            if node in self.created:
+                self.resolve(node, self.created[node])
+                p_bar.update(1)
+            else:
+                chunk.append(node)
+        return chunk
+
+
+def _release_successors(
+    graph: nx.DiGraph, node: str, in_degree: Dict[str, int]
+) -> List[str]:
+    released = []
+    for successor in graph.successors(node):
+        in_degree[successor] -= 1
+        if in_degree[successor] == 0:
+            released.append(successor)
+    return released
+
+
+def _graph_node_resource(
+    graph: nx.DiGraph, node: str
+) -> Union[FHIRAbstractModel, dict]:
+    resource = graph.nodes[node]["resource"]
+    if resource is None:
+        raise ValueError(f"Resource not found for node {node}")
+    return resource
@@ -0,0 +1,139 @@
+import hashlib
+import pathlib
+import sqlite3
+from typing import Dict, Iterable, Tuple, Union
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transfer (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS reference_mapping (source TEXT PRIMARY KEY, target TEXT NOT NULL);
+"""
+
+
+def linkage_key(reference: str) -> str:
+    """
+    Key of a source reference in the record linkage. The key is the sha256 hex digest of the reference, so it is the
+    same in every process and linkage files stay valid across restarts, without containing the source ids.
+
+    Args:
+        reference: the relative reference of a resource on the source server e.g. `Patient/123`
+
+    Returns:
+        the linkage key of the reference
+    """
+    return hashlib.sha256(reference.encode()).hexdigest()
+
+
+class TransferCheckpoint:
+    """
+    SQLite backed store of the progress of a transfer. Holds the mapping of source references to the references of the
+    resources created on the target server. Every uploaded chunk is committed, so a failed transfer started again with
+    the same checkpoint skips the resources that were already created.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, pathlib.Path],
+        origin_server: str = None,
+        destination_server: str = None,
+    ):
+        """
+        Args:
+            path: path of the sqlite database, created if it does not exist
+            origin_server: api address of the source server, must match the address stored in an existing checkpoint
+            destination_server: api address of the target server, must match the address stored in an existing
+                checkpoint
+        """
+        self.path = pathlib.Path(path)
+        self._connection = sqlite3.connect(self.path)
+        self._connection.executescript(SCHEMA)
+        self._check_servers(origin_server, destination_server)
+
+    def _check_servers(self, origin_server: str, destination_server: str):
+        stored = dict(self._connection.execute("SELECT key, value FROM transfer"))
+        servers = {
+            "origin_server": origin_server,
+            "destination_server": destination_server,
+        }
+        for key, value in servers.items():
+            if value is None:
+                continue
+            if key in stored and stored[key] != value:
+                raise ValueError(
+                    f"Checkpoint {self.path} belongs to a transfer with {key} {stored[key]}, not {value}"
+                )
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO transfer (key, value) VALUES (?, ?)",
+                [(key, value) for key, value in servers.items() if value is not None],
+            )
+
+    @property
+    def target_references(self) -> Dict[str, str]:
+        """
+        Mapping of the source references to the references of the resources created on the target server.
+        """
+        return dict(
+            self._connection.execute("SELECT source, target FROM reference_mapping")
+        )
+
+    @property
+    def n_references(self) -> int:
+        """
+        Number of resources created on the target server.
+        """
+        return self._connection.execute(
+            "SELECT COUNT(*) FROM reference_mapping"
+        ).fetchone()[0]
+
+    @property
+    def completed(self) -> bool:
+        """
+        Whether the transfer was completed.
+        """
+        row = self._connection.execute(
+            "SELECT value FROM transfer WHERE key = 'completed'"
+        ).fetchone()
+        return row is not None
+
+    def record_references(self, references: Iterable[Tuple[str, str]]):
+        """
+        Store the target server references of created resources in a single transaction.
+
+        Args:
+            references: pairs of source and target reference
+        """
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO reference_mapping (source, target) VALUES (?, ?)",
+                references,
+            )
+
+    def complete(self):
+        """
+        Mark the transfer as completed, after the references of resources in cycles have been restored.
+        """
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO transfer (key, value) VALUES ('completed', '1')"
+            )
+
+    def linkage(self) -> Dict[str, str]:
+        """
+        Record linkage of all resources created in the transfer, keyed by the linkage key of the source reference.
+        """
+        return {
+            linkage_key(source): target
+            for source, target in self.target_references.items()
+        }
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}(path={self.path}, n_references={self.n_references})>"
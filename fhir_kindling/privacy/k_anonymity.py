@@ -1,8 +1,51 @@
-from typing import List
+from typing import Any, Dict, List, Optional
 
+import numpy as np
 import pandas as pd
-from pandas.api.types import is_categorical_dtype, is_numeric_dtype, is_string_dtype
-from pandas.api.types import is_datetime64_any_dtype as is_datetime
+
+
+class KAnonymityReport:
+    """
+    Result of a k-anonymity check: the size of the smallest equivalence class and the equivalence classes, as well as
+    the rows, that violate k-anonymity.
+    """
+
+    def __init__(
+        self,
+        k: int,
+        quasi_identifiers: List[str],
+        n_classes: int,
+        min_class_size: Optional[int],
+        violating_classes: pd.DataFrame,
+        violating_indices: pd.Index,
+    ):
+        """
+        :param k: k value that was checked
+        :param quasi_identifiers: columns that form the equivalence classes
+        :param n_classes: number of equivalence classes in the dataframe
+        :param min_class_size: size of the smallest equivalence class, None for an empty dataframe
+        :param violating_classes: values of the equivalence classes with less than k rows and their size
+        :param violating_indices: index of the rows belonging to the violating equivalence classes
+        """
+        self.k = k
+        self.quasi_identifiers = quasi_identifiers
+        self.n_classes = n_classes
+        self.min_class_size = min_class_size
+        self.violating_classes = violating_classes
+        self.violating_indices = violating_indices
+
+    @property
+    def is_k_anonymous(self) -> bool:
+        return self.min_class_size is None or self.min_class_size >= self.k
+
+    def __bool__(self):
+        return self.is_k_anonymous
+
+    def __repr__(self):
+        return (
+            f"<KAnonymityReport(k={self.k}, min_class_size={self.min_class_size}, n_classes={self.n_classes}, "
+            f"n_violating_classes={len(self.violating_classes)}, n_violating_rows={len(self.violating_indices)})>"
+        )
 
 
 def is_k_anonymized(
@@ -20,97 +63,107 @@ def is_k_anonymized(
     :param excluded_cols: optional list of columns to exclude from the k-anonymity check
     :return: bool value indicating whether the dataframe satisfies k-anonymity
     """
-
-    for index, row in df.iterrows():
-        query = _make_k_anon_query_for_row(
-            row, df, excluded_cols=excluded_cols, id_cols=id_cols
-        )
-        rows = df.query(query)
-        if rows.shape[0] < k:
-            return False
-    return True
+    return k_anonymity_report(
+        df, k=k, id_cols=id_cols, excluded_cols=excluded_cols
+    ).is_k_anonymous
 
 
-def anonymize(df: pd.DataFrame, k: int = 3, id_cols: List[str] = None) -> pd.DataFrame:
+def k_anonymity_report(
+    df: pd.DataFrame,
+    k: int = 3,
+    id_cols: List[str] = None,
+    excluded_cols: List[str] = None,
+) -> KAnonymityReport:
     """
-    Attempts to generalize the given dataframe to make it k-anonymized
+    Groups the dataframe into equivalence classes of rows with the same values in the quasi identifying columns and
+    reports the classes with less than k rows. Missing values are treated as a value of their own and only observed
+    categories of categorical columns form classes.
 
-    :param df: dataframe to check
+    :param df: pandas dataframe to check
     :param k: k value to check for
-    :param id_cols: optional parameter specifying a subset of columns in the dataframe to generalize
-    :return: anonymized dataframe
+    :param id_cols: optional list of columns to check for k-anonymity, defaults to all columns
+    :param excluded_cols: optional list of columns to exclude from the k-anonymity check
+    :return: report containing the minimum class size and the violating equivalence classes and rows
     """
-    anon_df = df.copy()
-    # If id cols are given anonymize those otherwise use all columns
-    for col in id_cols if id_cols else df.columns:
-        if is_datetime(df[col]):
-            print("Datetime column detected")
-            anon_df[col] = generalize_datetime_column(df[col])
-
-        elif is_numeric_dtype(df[col]):
-            print("Numeric column detected")
-            anon_df[col] = generalize_numeric_column(df[col])
-
-        elif is_string_dtype(df[col]) or is_categorical_dtype(df[col]):
-            print("String column detected")
-            # TODO categorical/string variable handling
-            anon_df[col] = df[col]
+    cols = _quasi_identifier_columns(df, id_cols, excluded_cols)
+    if df.empty or not cols:
+        # without quasi identifiers all rows belong to a single equivalence class
+        n_rows = len(df)
+        violating = 0 < n_rows < k
+        return KAnonymityReport(
+            k=k,
+            quasi_identifiers=cols,
+            n_classes=1 if n_rows else 0,
+            min_class_size=n_rows or None,
+            violating_classes=pd.DataFrame(
+                [{"size": n_rows}] if violating else [], columns=cols + ["size"]
+            ),
+            violating_indices=df.index if violating else df.index[:0],
+        )
 
-        else:
-            print("Unknown column type:", df[col].dtype)
-            anon_df[col] = df[col]
+    # one pass over the data assigning each row the id of its equivalence class
+    class_ids = _group_rows(df, cols).ngroup().to_numpy()
+    class_sizes = np.bincount(class_ids)
+    violating_rows = class_sizes[class_ids] < k
+
+    violating_df = df.loc[violating_rows, cols]
+    violating_classes = (
+        _group_rows(violating_df, cols).size().reset_index(name="size")
+        if len(violating_df)
+        else pd.DataFrame(columns=cols + ["size"])
+    )
+    return KAnonymityReport(
+        k=k,
+        quasi_identifiers=cols,
+        n_classes=len(class_sizes),
+        min_class_size=int(class_sizes.min()),
+        violating_classes=violating_classes,
+        violating_indices=violating_df.index,
+    )
+
+
+def _quasi_identifier_columns(
+    df: pd.DataFrame, id_cols: List[str] = None, excluded_cols: List[str] = None
+) -> List[str]:
+    if id_cols:
+        return list(id_cols)
+    excluded = set(excluded_cols or [])
+    return [col for col in df.columns if col not in excluded]
 
-    if is_k_anonymized(anon_df, k=k):
-        return anon_df
 
-    else:
-        print("More generalization required")
+def _group_rows(df: pd.DataFrame, cols: List[str]):
+    # keep missing values as their own group and ignore unobserved categories
+    return df.groupby(cols, dropna=False, observed=True, sort=False)
 
 
-def _make_k_anon_query_for_row(
-    row: pd.Series,
+def anonymize(
     df: pd.DataFrame,
-    excluded_cols: List[str] = None,
+    k: int = 3,
     id_cols: List[str] = None,
-) -> str:
-    """
-    Creates a query string for a given row of a dataframe to check if there are enough rows in the dataframe to satisfy
-    k-anonymity
-    :param row: the row of a dataframe to check
-    :param df: underlying dataframe
-    :param excluded_cols: columns in the dataframe to exclude from the k-anonymity check
-    :param id_cols:
-    :return: query string to run against the dataframe
+    hierarchies: Dict[str, Dict[Any, List[Any]]] = None,
+    date_cols: List[str] = None,
+    suppression_limit: float = 0.0,
+) -> pd.DataFrame:
     """
-    if id_cols:
-        cols = id_cols
-    else:
-        if excluded_cols:
-            cols = [col for col in df.columns if col not in excluded_cols]
-        else:
-            cols = df.columns
-    query_cols = []
-    for col in cols:
-        if isinstance(row[col], int) or isinstance(row[col], float):
-            query_cols.append(f"{col} == {row[col]}")
-        else:
-            query_cols.append(f"{col} == '{row[col]}'")
-    query = " & ".join(query_cols)
-
-    return query
+    Generalizes the given dataframe to make it k-anonymized, see `mondrian_anonymize` for details and information
+    loss metrics.
 
-
-def generalize_numeric_column(num_col: pd.Series):
-    return num_col
-
-
-def generalize_datetime_column(date_col: pd.Series, level: int = 2):
-    col = pd.to_datetime(date_col)
-
-    if level == 2:
-        generalized_col = col.apply(lambda x: x.strftime("m-%Y"))
-        return pd.to_datetime(generalized_col)
-
-    elif level == 3:
-        generalized_col = col.apply(lambda x: x.strftime("%Y"))
-        return pd.to_datetime(generalized_col)
+    :param df: dataframe to anonymize
+    :param k: k value to anonymize for
+    :param id_cols: optional parameter specifying a subset of columns in the dataframe to generalize
+    :param hierarchies: generalization hierarchies for categorical columns, mapping each value of a column to its
+        generalizations from the most specific to the most general
+    :param date_cols: columns containing date strings to parse and anonymize as dates
+    :param suppression_limit: the maximum fraction of rows that can be suppressed
+    :return: anonymized dataframe
+    """
+    from fhir_kindling.privacy.mondrian import mondrian_anonymize
+
+    return mondrian_anonymize(
+        df,
+        k=k,
+        id_cols=id_cols,
+        hierarchies=hierarchies,
+        date_cols=date_cols,
+        suppression_limit=suppression_limit,
+    ).df
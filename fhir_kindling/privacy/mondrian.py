@@ -0,0 +1,414 @@
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_datetime64_any_dtype as is_datetime
+from pandas.api.types import is_numeric_dtype
+
+from fhir_kindling.privacy.k_anonymity import _quasi_identifier_columns
+
+# label of the root of every generalization hierarchy
+ROOT = "*"
+
+Hierarchy = Dict[Any, List[Any]]
+
+
+class AnonymizationResult:
+    """
+    Result of anonymizing a dataframe, containing the anonymized dataframe and the information loss caused by the
+    generalization and suppression of the quasi identifiers.
+    """
+
+    def __init__(
+        self,
+        df: pd.DataFrame,
+        k: int,
+        quasi_identifiers: List[str],
+        n_classes: int,
+        suppressed_indices: pd.Index,
+        ncp: float,
+        discernibility: int,
+        avg_class_size: float,
+    ):
+        """
+        :param df: the anonymized dataframe without the suppressed rows
+        :param k: the k value the dataframe was anonymized for
+        :param quasi_identifiers: the generalized columns
+        :param n_classes: number of equivalence classes in the anonymized dataframe
+        :param suppressed_indices: index of the rows removed from the dataframe
+        :param ncp: normalized certainty penalty between 0 (no generalization) and 1 (all values fully generalized)
+        :param discernibility: discernibility metric, the sum of the squared equivalence class sizes with suppressed
+            rows each penalized with the size of the dataframe
+        :param avg_class_size: average equivalence class size divided by k, 1 is optimal
+        """
+        self.df = df
+        self.k = k
+        self.quasi_identifiers = quasi_identifiers
+        self.n_classes = n_classes
+        self.suppressed_indices = suppressed_indices
+        self.ncp = ncp
+        self.discernibility = discernibility
+        self.avg_class_size = avg_class_size
+
+    def __repr__(self):
+        return (
+            f"<AnonymizationResult(k={self.k}, n={len(self.df)}, n_classes={self.n_classes}, "
+            f"n_suppressed={len(self.suppressed_indices)}, ncp={self.ncp:.3f})>"
+        )
+
+
+class _NumericAttribute:
+    """
+    Numeric quasi identifier generalized into ranges. Partitions are split at the median, missing values are ordered
+    after all other values.
+    """
+
+    def __init__(self, name: str, values: np.ndarray):
+        self.name = name
+        missing = np.isnan(values)
+        # missing values are replaced so that min and max of a partition can be computed without masking them
+        self._low_values = np.where(missing, np.inf, values)
+        self._high_values = np.where(missing, -np.inf, values)
+        finite = values[~missing]
+        self.span = float(finite.max() - finite.min()) if len(finite) else 0.0
+
+    def width(self, idx: np.ndarray) -> float:
+        if not self.span:
+            return 0.0
+        low, high = self._range(idx)
+        if low is None:
+            return 0.0
+        return (high - low) / self.span
+
+    def split(self, idx: np.ndarray) -> List[np.ndarray]:
+        values = self._low_values[idx]
+        middle = len(values) // 2
+        median = np.partition(values, middle)[middle]
+        left = values < median
+        if not left.any():
+            # many values equal to the median, split them from the larger values instead
+            left = values <= median
+        if left.all():
+            return []
+        return [idx[left], idx[~left]]
+
+    def generalize(
+        self, rows: np.ndarray, starts: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Generalize the values of all partitions to their range.
+
+        :param rows: positions of the rows ordered by partition
+        :param starts: offset of each partition in rows
+        :return: the generalized value and the normalized certainty penalty of each partition
+        """
+        low = np.minimum.reduceat(self._low_values[rows], starts)
+        high = np.maximum.reduceat(self._high_values[rows], starts)
+        present = high != -np.inf
+        ncp = np.zeros(len(starts))
+        if self.span:
+            ncp[present] = (high[present] - low[present]) / self.span
+        labels = np.full(len(starts), np.nan, dtype=object)
+        labels[present] = self._labels(low[present], high[present])
+        return labels, ncp
+
+    def _labels(self, low: np.ndarray, high: np.ndarray) -> np.ndarray:
+        labels = np.empty(len(low), dtype=object)
+        labels[:] = [
+            (
+                _format_number(value_low)
+                if value_low == value_high
+                else f"[{_format_number(value_low)}, {_format_number(value_high)}]"
+            )
+            for value_low, value_high in zip(low.tolist(), high.tolist())
+        ]
+        return labels
+
+    def _range(self, idx: np.ndarray) -> Tuple[Optional[float], Optional[float]]:
+        high = self._high_values[idx].max()
+        if high == -np.inf:
+            return None, None
+        return float(self._low_values[idx].min()), float(high)
+
+
+class _DateAttribute(_NumericAttribute):
+    """
+    Date quasi identifier, split like a numeric attribute and generalized by truncating the dates to the finest of
+    day, month or year that is shared by all dates in a partition, otherwise to a range of years.
+    """
+
+    def _labels(self, low: np.ndarray, high: np.ndarray) -> np.ndarray:
+        low = low.astype(np.int64).astype("datetime64[ns]")
+        high = high.astype(np.int64).astype("datetime64[ns]")
+        labels = np.empty(len(low), dtype=object)
+        labels[:] = [
+            f"[{year_low}, {year_high}]"
+            for year_low, year_high in zip(
+                np.datetime_as_string(low.astype("datetime64[Y]")),
+                np.datetime_as_string(high.astype("datetime64[Y]")),
+            )
+        ]
+        # from coarse to fine, so that partitions get the finest unit shared by their dates
+        for unit in ("Y", "M", "D"):
+            truncated = low.astype(f"datetime64[{unit}]")
+            shared = truncated == high.astype(f"datetime64[{unit}]")
+            labels[shared] = np.datetime_as_string(truncated[shared])
+        return labels
+
+
+class _CategoricalAttribute:
+    """
+    Categorical quasi identifier generalized along a hierarchy. Each value is encoded as its path of node ids from the
+    root of the hierarchy, a partition is generalized to the deepest node shared by all its values and split into the
+    children of that node.
+    """
+
+    def __init__(self, name: str, column: pd.Series, hierarchy: Hierarchy = None):
+        self.name = name
+        codes, uniques = pd.factorize(column, use_na_sentinel=False)
+        paths = [_hierarchy_path(value, hierarchy) for value in uniques]
+        depth = max((len(path) for path in paths), default=1)
+
+        node_ids: Dict[tuple, int] = {}
+        self.node_labels: List[Any] = []
+        unique_paths = np.zeros((len(paths), depth), dtype=np.int64)
+        for i, path in enumerate(paths):
+            # pad shallow paths with their leaf so that all leaves are at the same depth
+            path = path + [path[-1]] * (depth - len(path))
+            for level in range(depth):
+                node = tuple(path[: level + 1])
+                if node not in node_ids:
+                    node_ids[node] = len(node_ids)
+                    self.node_labels.append(path[level])
+                unique_paths[i, level] = node_ids[node]
+
+        # number of distinct leaves below each node
+        self.leaf_counts = np.zeros(len(node_ids), dtype=np.int64)
+        for level in range(depth):
+            nodes, counts = np.unique(unique_paths[:, level], return_counts=True)
+            self.leaf_counts[nodes] = counts
+        self.n_leaves = len(uniques)
+        self.paths = unique_paths[codes]
+
+    def width(self, idx: np.ndarray) -> float:
+        return self._ncp(self._common_node(idx))
+
+    def split(self, idx: np.ndarray) -> List[np.ndarray]:
+        paths = self.paths[idx]
+        level = self._common_level(paths)
+        if level == paths.shape[1] - 1:
+            return []
+        children, inverse = np.unique(paths[:, level + 1], return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.cumsum(np.bincount(inverse, minlength=len(children)))[:-1]
+        return np.split(idx[order], bounds)
+
+    def generalize(
+        self, rows: np.ndarray, starts: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Generalize the values of all partitions to their deepest shared node of the hierarchy.
+
+        :param rows: positions of the rows ordered by partition
+        :param starts: offset of each partition in rows
+        :return: the generalized value and the normalized certainty penalty of each partition
+        """
+        paths = self.paths[rows]
+        shared = np.minimum.reduceat(paths, starts) == np.maximum.reduceat(
+            paths, starts
+        )
+        levels = np.where(
+            shared.all(axis=1), paths.shape[1] - 1, np.argmin(shared, axis=1) - 1
+        )
+        nodes = paths[starts, levels]
+        labels = np.empty(len(self.node_labels), dtype=object)
+        labels[:] = self.node_labels
+        return labels[nodes], self._ncp(nodes)
+
+    def _ncp(self, node: Union[int, np.ndarray]) -> Union[float, np.ndarray]:
+        if self.n_leaves <= 1:
+            return node * 0.0
+        return (self.leaf_counts[node] - 1) / (self.n_leaves - 1)
+
+    def _common_node(self, idx: np.ndarray) -> int:
+        paths = self.paths[idx]
+        return paths[0, self._common_level(paths)]
+
+    @staticmethod
+    def _common_level(paths: np.ndarray) -> int:
+        # levels are shared by a partition up to the first level with different nodes
+        shared = paths.min(axis=0) == paths.max(axis=0)
+        if shared.all():
+            return len(shared) - 1
+        return int(np.argmin(shared)) - 1
+
+
+def mondrian_anonymize(
+    df: pd.DataFrame,
+    k: int = 3,
+    id_cols: List[str] = None,
+    excluded_cols: List[str] = None,
+    hierarchies: Dict[str, Hierarchy] = None,
+    date_cols: List[str] = None,
+    suppression_limit: float = 0.0,
+) -> AnonymizationResult:
+    """
+    Anonymize a dataframe with the multidimensional Mondrian algorithm. The rows are recursively partitioned at the
+    median of the quasi identifier with the widest normalized range (or into the children of the shared hierarchy node
+    for categorical columns) as long as every partition keeps at least k rows. The quasi identifiers of each final
+    partition are then generalized to a common value:
+
+    - numeric columns to the range of values e.g. `[30, 45]`
+    - date columns to the shared day, month or year e.g. `2020-05`, otherwise to a range of years
+    - categorical and string columns to the deepest shared node of their hierarchy, `*` if no hierarchy is given
+
+    Groups of less than k rows that prevent a split are suppressed (removed) as long as at most `suppression_limit`
+    of the rows are suppressed.
+
+    :param df: dataframe to anonymize
+    :param k: k value to anonymize for
+    :param id_cols: quasi identifying columns to generalize, defaults to all columns
+    :param excluded_cols: optional list of columns to exclude from the quasi identifiers
+    :param hierarchies: generalization hierarchies for categorical columns, mapping each value of a column to its
+        generalizations from the most specific to the most general, e.g.
+        `{"city": {"Berlin": ["Germany", "Europe"], "Paris": ["France", "Europe"]}}`
+    :param date_cols: columns containing date strings to parse and anonymize as dates
+    :param suppression_limit: the maximum fraction of rows that can be suppressed
+    :return: result containing the anonymized dataframe and information loss metrics
+    """
+    if k < 1:
+        raise ValueError(f"k must be at least 1, got {k}")
+    cols = _quasi_identifier_columns(df, id_cols, excluded_cols)
+    attributes = [
+        _make_attribute(df[col], (hierarchies or {}).get(col), col in (date_cols or []))
+        for col in cols
+    ]
+    n_rows = len(df)
+    max_suppressed = int(suppression_limit * n_rows)
+    if n_rows < k and n_rows > max_suppressed:
+        raise ValueError(f"Dataframe with {n_rows} rows can not be {k}-anonymized")
+
+    if n_rows < k:
+        partitions, suppressed = [], [np.arange(n_rows)]
+    else:
+        partitions, suppressed = _partition(attributes, n_rows, k, max_suppressed)
+    return _make_result(df, k, cols, attributes, partitions, suppressed)
+
+
+def _make_attribute(
+    column: pd.Series, hierarchy: Hierarchy = None, is_date: bool = False
+):
+    if is_date and not is_datetime(column):
+        column = pd.to_datetime(column, errors="coerce", utc=True)
+    if is_datetime(column):
+        if column.dt.tz is not None:
+            column = column.dt.tz_convert(None)
+        values = column.to_numpy(dtype="datetime64[ns]").astype(np.int64).astype(float)
+        values[column.isna().to_numpy()] = np.nan
+        return _DateAttribute(column.name, values)
+    if is_numeric_dtype(column) and not hierarchy and column.dtype != bool:
+        return _NumericAttribute(
+            column.name, column.to_numpy(dtype=float, na_value=np.nan)
+        )
+    return _CategoricalAttribute(column.name, column, hierarchy)
+
+
+def _hierarchy_path(value, hierarchy: Hierarchy = None) -> list:
+    generalizations = (hierarchy or {}).get(value, [])
+    path = [ROOT] + [g for g in reversed(generalizations) if g != ROOT]
+    return path + [value]
+
+
+def _partition(
+    attributes: list, n_rows: int, k: int, max_suppressed: int
+) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    partitions, suppressed = [], []
+    n_suppressed = 0
+    stack = [np.arange(n_rows)]
+    while stack:
+        idx = stack.pop()
+        split = _split_partition(attributes, idx, k, max_suppressed - n_suppressed)
+        if split is None:
+            partitions.append(idx)
+            continue
+        kept, removed = split
+        stack.extend(kept)
+        suppressed.extend(removed)
+        n_suppressed += sum(len(group) for group in removed)
+    return partitions, suppressed
+
+
+def _split_partition(
+    attributes: list, idx: np.ndarray, k: int, suppression_budget: int
+) -> Optional[Tuple[List[np.ndarray], List[np.ndarray]]]:
+    """
+    Split a partition along the widest attribute that allows a split into groups of at least k rows. Returns the
+    groups to keep and the groups to suppress or None if the partition can not be split.
+    """
+    # splits into two groups of at least k rows are impossible, only suppression can make progress
+    if len(idx) < 2 * k and (not suppression_budget or len(idx) == k):
+        return None
+    widths = [attribute.width(idx) for attribute in attributes]
+    for i in np.argsort(widths)[::-1]:
+        if widths[i] <= 0:
+            break
+        groups = attributes[i].split(idx)
+        kept = [group for group in groups if len(group) >= k]
+        removed = [group for group in groups if 0 < len(group) < k]
+        if not kept or sum(len(group) for group in removed) > suppression_budget:
+            continue
+        # a single kept group is only progress if rows were suppressed
+        if len(kept) > 1 or removed:
+            return kept, removed
+    return None
+
+
+def _make_result(
+    df: pd.DataFrame,
+    k: int,
+    cols: List[str],
+    attributes: list,
+    partitions: List[np.ndarray],
+    suppressed: List[np.ndarray],
+) -> AnonymizationResult:
+    n_rows = len(df)
+    sizes = np.array([len(idx) for idx in partitions], dtype=np.int64)
+    keep = np.ones(n_rows, dtype=bool)
+    for idx in suppressed:
+        keep[idx] = False
+    n_suppressed = n_rows - int(keep.sum())
+
+    anonymized = df.iloc[keep].copy()
+    penalty = 0.0
+    if partitions:
+        # generalize all partitions at once on the rows ordered by partition
+        rows = np.concatenate(partitions)
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        for attribute in attributes:
+            labels, ncp = attribute.generalize(rows, starts)
+            generalized = np.empty(n_rows, dtype=object)
+            generalized[rows] = np.repeat(labels, sizes)
+            anonymized[attribute.name] = generalized[keep]
+            penalty += float((sizes * ncp).sum())
+
+    n_classes = len(partitions)
+    ncp = 0.0
+    if n_rows and attributes:
+        # suppressed rows are fully generalized
+        ncp = (penalty + n_suppressed * len(attributes)) / (n_rows * len(attributes))
+    return AnonymizationResult(
+        df=anonymized,
+        k=k,
+        quasi_identifiers=cols,
+        n_classes=n_classes,
+        suppressed_indices=df.index[~keep],
+        ncp=ncp,
+        discernibility=int((sizes**2).sum()) + n_suppressed * n_rows,
+        avg_class_size=(n_rows - n_suppressed) / n_classes / k if n_classes else 0.0,
+    )
+
+
+def _format_number(value: float):
+    if float(value).is_integer():
+        return int(value)
+    return value
@@ -0,0 +1,310 @@
+import functools
+import pathlib
+from typing import Callable, Iterable, List, Optional, Union
+
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
+from fhir.resources import FHIRAbstractModel, get_fhir_model_class
+
+# metadata marking string columns that contain json encoded values
+JSON_METADATA = {b"encoding": b"json"}
+# fhir primitive types not stored as strings, dates are kept as strings since they can be partial e.g. 2020-05
+PRIMITIVE_ARROW_TYPES = {
+    "boolean": pa.bool_(),
+    "integer": pa.int64(),
+    "unsignedInt": pa.int64(),
+    "positiveInt": pa.int64(),
+    "integer64": pa.int64(),
+    "decimal": pa.float64(),
+}
+# element types that are stored as json strings because their content is arbitrary or recursive
+JSON_ELEMENT_TYPES = frozenset(["Extension", "Resource"])
+
+Resources = Union[List[dict], List[FHIRAbstractModel]]
+
+
+@functools.lru_cache(maxsize=None)
+def resource_schema(resource_type: str, max_depth: int = 3) -> pa.Schema:
+    """
+    Infer the arrow schema of a resource type from its fhir.resources model. The schema only depends on the resource
+    type, so every table or file created for a type has the same columns independent of the values of the resources.
+
+    Complex elements are stored as structs and repeated elements as lists. Elements nested deeper than `max_depth`,
+    recursive elements, extensions and contained resources are stored as json strings, marked with
+    `{"encoding": "json"}` in the field metadata.
+
+    Args:
+        resource_type: the resource type e.g. Patient
+        max_depth: the maximum depth of nested structs
+
+    Returns:
+        The arrow schema for the resource type
+    """
+    model = get_fhir_model_class(resource_type)
+    fields = [pa.field("resourceType", pa.string())]
+    fields.extend(_model_fields(model, max_depth, (resource_type,)))
+    return pa.schema(fields, metadata={b"fhir_resource_type": resource_type.encode()})
+
+
+def _model_fields(model, depth: int, path: tuple) -> List[pa.Field]:
+    fields = []
+    for field in model.__fields__.values():
+        # primitive extensions (_birthDate) and comments are not included
+        if field.alias.startswith("_") or field.name in (
+            "resource_type",
+            "fhir_comments",
+        ):
+            continue
+        arrow_field = _arrow_field(field, depth, path)
+        if field.shape != 1:
+            arrow_field = pa.field(
+                arrow_field.name,
+                pa.list_(arrow_field.type),
+                metadata=arrow_field.metadata,
+            )
+        fields.append(arrow_field)
+    return fields
+
+
+def _arrow_field(field, depth: int, path: tuple) -> pa.Field:
+    field_type = field.type_
+    if field_type is bool:
+        return pa.field(field.alias, pa.bool_())
+
+    element_type = getattr(field_type, "__resource_type__", None)
+    if element_type is None:
+        visit_name = getattr(field_type, "__visit_name__", None)
+        return pa.field(field.alias, PRIMITIVE_ARROW_TYPES.get(visit_name, pa.string()))
+
+    if element_type in JSON_ELEMENT_TYPES or element_type in path or depth <= 0:
+        return pa.field(field.alias, pa.string(), metadata=JSON_METADATA)
+    element_model = get_fhir_model_class(element_type)
+    children = _model_fields(element_model, depth - 1, path + (element_type,))
+    return pa.field(field.alias, pa.struct(children))
+
+
+def _make_converter(
+    arrow_type: pa.DataType, metadata: dict = None
+) -> Optional[Callable]:
+    """
+    Create a function that encodes the values stored as json strings in a nested value of the given type. Returns
+    None if the type does not contain json encoded values so that values can be passed to arrow unchanged.
+    """
+    if pa.types.is_list(arrow_type):
+        # the metadata of repeated elements applies to each value of the list
+        value_converter = _make_converter(arrow_type.value_type, metadata)
+        if value_converter is None:
+            return None
+        return lambda values: [value_converter(value) for value in values]
+    if metadata == JSON_METADATA:
+        return _dump_json
+    if pa.types.is_struct(arrow_type):
+        return _struct_converter(list(arrow_type))
+    return None
+
+
+def _struct_converter(fields: List[pa.Field]) -> Optional[Callable]:
+    converters = {}
+    for field in fields:
+        converter = _make_converter(field.type, field.metadata)
+        if converter is not None:
+            converters[field.name] = converter
+    if not converters:
+        return None
+
+    def convert(value: dict) -> dict:
+        # resources are sparse, so only the fields present in the value are visited
+        names = converters.keys() & value.keys()
+        if not names:
+            return value
+        converted = dict(value)
+        for name in names:
+            field_value = value[name]
+            if field_value is not None:
+                converted[name] = converters[name](field_value)
+        return converted
+
+    return convert
+
+
+def _dump_json(value) -> str:
+    return orjson.dumps(value).decode()
+
+
+@functools.lru_cache(maxsize=None)
+def _schema_converter(resource_type: str, max_depth: int) -> Optional[Callable]:
+    return _struct_converter(list(resource_schema(resource_type, max_depth)))
+
+
+def _resource_dicts(resources: Resources) -> List[dict]:
+    if resources and isinstance(resources[0], FHIRAbstractModel):
+        # serialize to json to get json compatible values for dates and decimals
+        return [orjson.loads(resource.json()) for resource in resources]
+    return resources
+
+
+def _infer_resource_type(resources: Resources) -> str:
+    resource = resources[0]
+    if isinstance(resource, FHIRAbstractModel):
+        return resource.resource_type
+    return resource["resourceType"]
+
+
+def resources_to_record_batch(
+    resources: Resources, resource_type: str, max_depth: int = 3
+) -> pa.RecordBatch:
+    """
+    Convert resources into an arrow record batch with the schema of their resource type.
+
+    Args:
+        resources: list of resources as dictionaries or fhir resource models
+        resource_type: the type of the resources
+        max_depth: the maximum depth of nested structs, see resource_schema
+
+    Returns:
+        Record batch with a row for each resource
+    """
+    rows = _resource_dicts(resources)
+    converter = _schema_converter(resource_type, max_depth)
+    if converter is not None:
+        rows = [converter(row) for row in rows]
+    return pa.RecordBatch.from_pylist(
+        rows, schema=resource_schema(resource_type, max_depth)
+    )
+
+
+def resources_to_arrow(
+    resources: Resources,
+    resource_type: str = None,
+    max_depth: int = 3,
+) -> pa.Table:
+    """
+    Convert a list of resources of the same type into an arrow table with the schema inferred from the resource
+    model.
+
+    Args:
+        resources: list of resources as dictionaries or fhir resource models
+        resource_type: the type of the resources, inferred from the first resource if not given
+        max_depth: the maximum depth of nested structs, see resource_schema
+
+    Returns:
+        Arrow table with a row for each resource
+    """
+    if not resource_type:
+        if not resources:
+            raise ValueError(
+                "Resource type must be given for an empty list of resources"
+            )
+        resource_type = _infer_resource_type(resources)
+    schema = resource_schema(resource_type, max_depth)
+    return pa.Table.from_batches(
+        [resources_to_record_batch(resources, resource_type, max_depth)],
+        schema=schema,
+    )
+
+
+class ParquetResourceWriter:
+    """
+    Writes resources of a single type to a parquet file, one record batch at a time. Pages of resources can be
+    written as they are received so only a single page has to be kept in memory.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, pathlib.Path],
+        resource_type: str = None,
+        max_depth: int = 3,
+        compression: str = "snappy",
+    ):
+        """
+        Args:
+            path: path of the parquet file
+            resource_type: the type of the resources, inferred from the first written resource if not given
+            max_depth: the maximum depth of nested structs, see resource_schema
+            compression: compression codec used for the file
+        """
+        self.path = pathlib.Path(path)
+        self.resource_type = resource_type
+        self.max_depth = max_depth
+        self.compression = compression
+        self.n_rows = 0
+        self._writer: Optional[pq.ParquetWriter] = None
+
+    @property
+    def schema(self) -> Optional[pa.Schema]:
+        if not self.resource_type:
+            return None
+        return resource_schema(self.resource_type, self.max_depth)
+
+    def write(self, resources: Resources):
+        """
+        Write a list of resources, e.g. a page of query results, as a record batch.
+
+        Args:
+            resources: list of resources as dictionaries or fhir resource models
+        """
+        if not resources:
+            return
+        if not self.resource_type:
+            self.resource_type = _infer_resource_type(resources)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(
+                self.path, self.schema, compression=self.compression
+            )
+        self._writer.write_batch(
+            resources_to_record_batch(resources, self.resource_type, self.max_depth)
+        )
+        self.n_rows += len(resources)
+
+    def close(self):
+        """
+        Finish the parquet file. If no resources were written, an empty file is created if the resource type is known.
+        """
+        if self._writer is None and self.resource_type:
+            self._writer = pq.ParquetWriter(
+                self.path, self.schema, compression=self.compression
+            )
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__}(path={self.path}, resource_type={self.resource_type}, "
+            f"n_rows={self.n_rows})>"
+        )
+
+
+def pages_to_parquet(
+    pages: Iterable[Resources],
+    path: Union[str, pathlib.Path],
+    resource_type: str = None,
+    max_depth: int = 3,
+    compression: str = "snappy",
+) -> int:
+    """
+    Write pages of resources, e.g. from `query.iter_pages()`, to a parquet file as they are received.
+
+    Args:
+        pages: iterable of lists of resources of the same type
+        path: path of the parquet file
+        resource_type: the type of the resources, inferred from the first resource if not given
+        max_depth: the maximum depth of nested structs, see resource_schema
+        compression: compression codec used for the file
+
+    Returns:
+        The number of written resources
+    """
+    with ParquetResourceWriter(
+        path, resource_type=resource_type, max_depth=max_depth, compression=compression
+    ) as writer:
+        for page in pages:
+            writer.write(page)
+    return writer.n_rows
@@ -1,6 +1,11 @@
+import asyncio
+import datetime
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from unittest import mock
 
+import httpx
 import pytest
 from httpx import Auth
 
@@ -89,3 +94,139 @@ def test_env_var_conflicts():
 def test_env_var_basic():
     basic_auth = generate_auth(load_env=True)
     assert isinstance(basic_auth, Auth)
+
+
+def oidc_handlers():
+    grants = []
+    revoked = set()
+
+    def provider(request: httpx.Request):
+        data = dict(httpx.QueryParams(request.content.decode()))
+        grants.append(data["grant_type"])
+        token = {
+            "access_token": f"token-{len(grants)}",
+            "expires_in": 3600,
+            "token_type": "Bearer",
+        }
+        if data["grant_type"] == "client_credentials":
+            token["refresh_token"] = "refresh"
+        return httpx.Response(200, json=token, request=request)
+
+    def server(request: httpx.Request):
+        token = request.headers["Authorization"].split(" ")[1]
+        if token in revoked:
+            return httpx.Response(401)
+        return httpx.Response(200, json={"token": token})
+
+    return provider, server, grants, revoked
+
+
+def test_oidc_auth_cached_refresh():
+    provider, server_handler, grants, revoked = oidc_handlers()
+    server = FhirServer(
+        api_address="https://test.fhir/fhir",
+        client_id="client",
+        client_secret="secret",
+        oidc_provider_url="https://auth.test/token",
+    )
+    auth = server.auth
+    assert server.auth is auth
+    client = httpx.Client(transport=httpx.MockTransport(server_handler), auth=auth)
+    provider_post = mock.patch(
+        "fhir_kindling.fhir_server.auth.httpx.post",
+        lambda url, **kwargs: provider(httpx.Request("POST", url, **kwargs)),
+    )
+    with provider_post:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            responses = list(
+                executor.map(
+                    lambda _: client.get("https://test.fhir/fhir/Patient"), range(16)
+                )
+            )
+        assert {r.json()["token"] for r in responses} == {"token-1"}
+        assert grants == ["client_credentials"]
+
+        # a rejected token is refreshed with the refresh token and the request sent again
+        revoked.add("token-1")
+        assert client.get("https://test.fhir/fhir/Patient").json()["token"] == "token-2"
+        assert grants == ["client_credentials", "refresh_token"]
+
+        # tokens are refreshed before they expire
+        auth.expires_at = datetime.datetime.now() + datetime.timedelta(seconds=10)
+        assert client.get("https://test.fhir/fhir/Patient").json()["token"] == "token-3"
+    assert auth.n_refreshes == 3
+
+
+@pytest.mark.asyncio
+async def test_oidc_auth_async():
+    provider, server_handler, grants, revoked = oidc_handlers()
+    auth = OIDCAuth("client", "secret", "https://auth.test/token")
+    async_client = httpx.AsyncClient
+    provider_client = mock.patch(
+        "fhir_kindling.fhir_server.auth.httpx.AsyncClient",
+        lambda: async_client(transport=httpx.MockTransport(provider)),
+    )
+    async with httpx.AsyncClient(
+        transport=httpx.MockTransport(server_handler), auth=auth
+    ) as client:
+        with provider_client:
+            responses = await asyncio.gather(
+                *[client.get("https://test.fhir/fhir/Patient") for _ in range(8)]
+            )
+            assert {r.json()["token"] for r in responses} == {"token-1"}
+            revoked.add("token-1")
+            response = await client.get("https://test.fhir/fhir/Patient")
+    assert response.json()["token"] == "token-2"
+    assert grants == ["client_credentials", "refresh_token"]
+
+
+def test_oidc_auth_single_refresh():
+    provider, _, grants, _ = oidc_handlers()
+    auth = OIDCAuth("client", "secret", "https://auth.test/token")
+    auth.access_token = "token-0"
+    auth.refresh_token = "refresh"
+    auth.expires_at = datetime.datetime.now() + datetime.timedelta(hours=1)
+
+    def slow_provider(request: httpx.Request):
+        time.sleep(0.05)
+        return provider(request)
+
+    async def slow_provider_async(request: httpx.Request):
+        await asyncio.sleep(0.05)
+        return provider(request)
+
+    async_client = httpx.AsyncClient
+    provider_post = mock.patch(
+        "fhir_kindling.fhir_server.auth.httpx.post",
+        lambda url, **kwargs: slow_provider(httpx.Request("POST", url, **kwargs)),
+    )
+    provider_client = mock.patch(
+        "fhir_kindling.fhir_server.auth.httpx.AsyncClient",
+        lambda: async_client(transport=httpx.MockTransport(slow_provider_async)),
+    )
+
+    def get_tokens_async():
+        async def get_tokens():
+            return await asyncio.gather(
+                *[auth.get_token_async(rejected_token="token-0") for _ in range(4)]
+            )
+
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(get_tokens())
+        finally:
+            loop.close()
+
+    # threads and tasks of another event loop rejecting the same token share a single refresh
+    with provider_post, provider_client:
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            async_tokens = executor.submit(get_tokens_async)
+            tokens = list(
+                executor.map(
+                    lambda _: auth.get_token(rejected_token="token-0"), range(4)
+                )
+            )
+            tokens.extend(async_tokens.result())
+    assert set(tokens) == {"token-1"}
+    assert grants == ["refresh_token"]
+    assert auth.n_refreshes == 1
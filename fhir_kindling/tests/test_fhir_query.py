@@ -1,13 +1,21 @@
 import json
 import os
+from urllib.parse import parse_qs, urlparse
 
+import httpx
 import pytest
 import xmltodict
 from dotenv import find_dotenv, load_dotenv
 from fhir.resources.patient import Patient
 from pydantic import ValidationError
 
-from fhir_kindling import FhirServer
+from fhir_kindling import FhirQueryAsync, FhirQuerySync, FhirServer
+from fhir_kindling.fhir_query.partitioning import (
+    partition_bounds,
+    partition_field_value,
+    partition_missing_parameter,
+    partition_parameters,
+)
 from fhir_kindling.fhir_query.query_parameters import (
     FhirQueryParameters,
     FieldParameter,
@@ -16,6 +24,7 @@ from fhir_kindling.fhir_query.query_parameters import (
     QueryParameter,
     ReverseChainParameter,
 )
+from fhir_kindling.fhir_query.query_response import QueryResponse
 
 
 @pytest.fixture
@@ -39,6 +48,38 @@ def server(api_url):
     return server
 
 
+def paginated_patient_handler(n_patients: int):
+    """
+    Create a request handler for a httpx.MockTransport that serves n patients in pages of size _count
+    """
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        params = parse_qs(urlparse(str(request.url)).query)
+        count = int(params.get("_count", ["50"])[0])
+        offset = int(params.get("_offset", ["0"])[0])
+        entries = [
+            {"resource": {"resourceType": "Patient", "id": str(i)}}
+            for i in range(offset, min(offset + count, n_patients))
+        ]
+        links = [{"relation": "self", "url": str(request.url)}]
+        if offset + count < n_patients:
+            links.append(
+                {
+                    "relation": "next",
+                    "url": f"http://fhir.test/fhir/Patient?_count={count}&_offset={offset + count}",
+                }
+            )
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "link": links,
+            "entry": entries,
+        }
+        return httpx.Response(200, json=bundle)
+
+    return handler
+
+
 @pytest.fixture
 def paginated_xml():
     return """<?xml version="1.0" encoding="UTF-8"?>
@@ -1752,3 +1793,283 @@ async def test_query_count_async(server):
     count = await server.query_async("Patient").count()
     print(count)
     assert count > 0
+
+
+def test_query_iter_pages():
+    client = httpx.Client(transport=httpx.MockTransport(paginated_patient_handler(25)))
+    query = FhirQuerySync("http://fhir.test/fhir", "Patient", client=client)
+
+    pages = list(query.iter_pages(count=10))
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert isinstance(pages[0][0], dict)
+
+    resources = list(query.iter_resources(count=10, parse=True))
+    assert len(resources) == 25
+    assert isinstance(resources[0], Patient)
+    assert [r.id for r in resources] == [str(i) for i in range(25)]
+
+    # the limit stops the pagination once enough resources have been streamed
+    limited = list(query.iter_resources(count=10, limit=12))
+    assert len(limited) == 12
+
+    bundles = list(query.iter_bundles(count=10))
+    assert [len(bundle["entry"]) for bundle in bundles] == [10, 10, 5]
+    assert all(bundle["resourceType"] == "Bundle" for bundle in bundles)
+
+    xml_query = FhirQuerySync(
+        "http://fhir.test/fhir", "Patient", client=client, output_format="xml"
+    )
+    with pytest.raises(NotImplementedError):
+        next(xml_query.iter_pages())
+
+
+@pytest.mark.asyncio
+async def test_query_iter_pages_async():
+    client = httpx.AsyncClient(
+        transport=httpx.MockTransport(paginated_patient_handler(25))
+    )
+    query = FhirQueryAsync("http://fhir.test/fhir", "Patient", client=client)
+
+    pages = [page async for page in query.iter_pages(count=10)]
+    assert [len(page) for page in pages] == [10, 10, 5]
+
+    bundles = [bundle async for bundle in query.iter_bundles(count=10, prefetch=2)]
+    assert [len(bundle["entry"]) for bundle in bundles] == [10, 10, 5]
+
+    resources = [r async for r in query.iter_resources(count=7, limit=20, parse=True)]
+    assert len(resources) == 20
+    assert isinstance(resources[0], Patient)
+
+
+@pytest.mark.asyncio
+async def test_query_async_prefetch():
+    client = httpx.AsyncClient(
+        transport=httpx.MockTransport(paginated_patient_handler(95))
+    )
+    query = FhirQueryAsync("http://fhir.test/fhir", "Patient", client=client)
+
+    page_sizes = []
+    response = await query.all(
+        count=10, prefetch=2, page_callback=lambda x: page_sizes.append(len(x))
+    )
+    assert len(response.resources) == 95
+    assert page_sizes == [10] * 9 + [5]
+    assert [r.id for r in response.resources] == [str(i) for i in range(95)]
+
+    response = await query.limit(25, count=10, prefetch=3)
+    assert len(response.resources) == 25
+
+    resources = [r async for r in query.iter_resources(count=10, prefetch=2)]
+    assert len(resources) == 95
+
+
+def test_partition_bounds():
+    assert partition_bounds(0, 100, 4) == [25, 50, 75]
+    assert partition_bounds(0, 2, 4) == [1, 2]
+    assert partition_bounds(5, 5, 4) == []
+    # date only values are split on day granularity
+    assert partition_bounds("2020-01-01", "2020-01-05", 4) == [
+        "2020-01-02",
+        "2020-01-03",
+        "2020-01-04",
+    ]
+    assert partition_bounds("2020-01-01", "2020-01-01", 4) == []
+    bounds = partition_bounds(
+        "2023-01-01T00:00:00.000+00:00", "2023-01-01T04:00:00Z", 4
+    )
+    assert bounds == [
+        "2023-01-01T01:00:00.000Z",
+        "2023-01-01T02:00:00.000Z",
+        "2023-01-01T03:00:00.000Z",
+    ]
+    with pytest.raises(ValueError):
+        partition_bounds(0, "2020-01-01", 2)
+    # year and year-month precision start at the first day of the period
+    assert partition_bounds("2020", "2021", 4) == [
+        "2020-04-01",
+        "2020-07-02",
+        "2020-10-01",
+    ]
+    assert partition_bounds("2020-05", "2020-06", 2) == ["2020-05-16"]
+    assert partition_bounds("2020", "2020-01-03", 4) == ["2020-01-02"]
+
+    params = partition_parameters("_lastUpdated", [10, 20])
+    assert [[p.to_url_param() for p in partition] for partition in params] == [
+        ["_lastUpdated=lt10"],
+        ["_lastUpdated=ge10", "_lastUpdated=lt20"],
+        ["_lastUpdated=ge20"],
+    ]
+
+    assert partition_field_value({"meta": {"lastUpdated": "2020"}}, "_lastUpdated")
+    assert partition_field_value({"birthDate": "2020-01-01"}, "birthdate")
+    with pytest.raises(ValueError):
+        partition_field_value({"resourceType": "Patient"}, "birthdate")
+
+    assert partition_missing_parameter("_lastUpdated", missing=True) is None
+    missing = partition_missing_parameter("birthdate", missing=True)
+    assert missing.to_url_param() == "birthdate:missing=true"
+
+
+def partitioned_patient_handler(n_patients: int):
+    """
+    Create a request handler for a httpx.MockTransport that supports sorting and range queries on _lastUpdated
+    """
+    patients = [
+        {
+            "resourceType": "Patient",
+            "id": str(i),
+            "meta": {"lastUpdated": f"2023-01-01T00:{i // 60:02d}:{i % 60:02d}.000Z"},
+        }
+        for i in range(n_patients)
+    ]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        params = parse_qs(urlparse(str(request.url)).query)
+        matches = patients
+        for value in params.get("_lastUpdated", []):
+            operator, value = value[:2], value[2:]
+            if operator == "ge":
+                matches = [p for p in matches if p["meta"]["lastUpdated"] >= value]
+            else:
+                matches = [p for p in matches if p["meta"]["lastUpdated"] < value]
+        if params.get("_summary") == ["count"]:
+            return httpx.Response(
+                200, json={"resourceType": "Bundle", "total": len(matches)}
+            )
+        if params.get("_sort") == ["-_lastUpdated"]:
+            matches = list(reversed(matches))
+        count = int(params.get("_count", ["50"])[0])
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "entry": [{"resource": p} for p in matches[:count]],
+        }
+        return httpx.Response(200, json=bundle)
+
+    return handler
+
+
+def birthdate_patient_handler(n_patients: int):
+    """
+    Create a request handler for a httpx.MockTransport that supports range queries, sorting and the missing modifier
+    on the birthdate. Every third patient has no birthdate and patients without birthdate are sorted first.
+    """
+    patients = []
+    for i in range(n_patients):
+        patient = {"resourceType": "Patient", "id": str(i)}
+        if i % 3:
+            patient["birthDate"] = f"{1950 + i}-06-15"
+        patients.append(patient)
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        params = parse_qs(urlparse(str(request.url)).query)
+        matches = patients
+        for value in params.get("birthdate:missing", []):
+            missing = value == "true"
+            matches = [p for p in matches if ("birthDate" not in p) == missing]
+        for value in params.get("birthdate", []):
+            operator, value = value[:2], value[2:]
+            matches = [p for p in matches if "birthDate" in p]
+            if operator == "ge":
+                matches = [p for p in matches if p["birthDate"] >= value]
+            else:
+                matches = [p for p in matches if p["birthDate"] < value]
+        if params.get("_summary") == ["count"]:
+            return httpx.Response(
+                200, json={"resourceType": "Bundle", "total": len(matches)}
+            )
+        if params.get("_sort"):
+            matches = sorted(matches, key=lambda p: p.get("birthDate", ""))
+            if params["_sort"] == ["-birthdate"]:
+                matches = list(reversed(matches))
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "entry": [{"resource": p} for p in matches],
+        }
+        return httpx.Response(200, json=bundle)
+
+    return handler
+
+
+def test_query_partitioned_missing_values():
+    client = httpx.Client(transport=httpx.MockTransport(birthdate_patient_handler(30)))
+    query = FhirQuerySync("http://fhir.test/fhir", "Patient", client=client)
+    partitions = query._make_partitions("birthdate", 3)
+    assert len(partitions) == 4
+    assert "birthdate:missing=true" in partitions[-1].query_url
+    assert sum(p.count() for p in partitions) == 30
+
+    response = query.partitioned(field="birthdate", partitions=3)
+    assert {r.id for r in response.resources} == {str(i) for i in range(30)}
+    assert len(response.resources) == 30
+
+
+def test_query_partitioned():
+    client = httpx.Client(
+        transport=httpx.MockTransport(partitioned_patient_handler(100))
+    )
+    query = FhirQuerySync("http://fhir.test/fhir", "Patient", client=client)
+    partitions = query._make_partitions("_lastUpdated", 4)
+    assert len(partitions) == 4
+    assert [p.count() for p in partitions] == [25, 25, 25, 25]
+
+    response = query.partitioned(partitions=4)
+    assert len(response.resources) == 100
+    assert {r.id for r in response.resources} == {str(i) for i in range(100)}
+
+
+@pytest.mark.asyncio
+async def test_query_partitioned_async():
+    client = httpx.AsyncClient(
+        transport=httpx.MockTransport(partitioned_patient_handler(90))
+    )
+    query = FhirQueryAsync("http://fhir.test/fhir", "Patient", client=client)
+    response = await query.partitioned(partitions=3)
+    assert len(response.resources) == 90
+
+    ids = set()
+    async for page in query.iter_partitioned(partitions=5):
+        ids.update(resource["id"] for resource in page)
+    assert ids == {str(i) for i in range(90)}
+
+
+def test_query_response_lazy_resources():
+    entries = [
+        {
+            "resource": {"resourceType": "Patient", "id": str(i), "gender": "female"},
+            "search": {"mode": "match"},
+        }
+        for i in range(100)
+    ]
+    entries.append(
+        {
+            "resource": {"resourceType": "Organization", "id": "org"},
+            "search": {"mode": "include"},
+        }
+    )
+    # invalid resources only fail when they are accessed
+    entries[50]["resource"]["birthDate"] = "not a date"
+    bundle = {"resourceType": "Bundle", "type": "searchset", "entry": entries}
+    response = QueryResponse(bundle, FhirQueryParameters(resource="Patient"))
+
+    lazy = response.lazy_resources
+    assert len(lazy) == 100
+    assert isinstance(lazy[0], Patient)
+    assert lazy[-1].id == "99"
+    assert [p.id for p in lazy[10:13]] == ["10", "11", "12"]
+    assert lazy[0] is lazy[0]
+    assert response.resource_dicts[1]["id"] == "1"
+    with pytest.raises(IndexError):
+        lazy[100]
+
+    with pytest.raises(ValidationError):
+        lazy[50]
+    # the unvalidated models can still be accessed
+    assert lazy.construct(50).id == "50"
+    constructed = list(response.iter_resources(validate=False))
+    assert len(constructed) == 100
+    assert constructed[50].get_resource_type() == "Patient"
+
+    iterator = response.iter_resources()
+    assert next(iterator).id == "0"
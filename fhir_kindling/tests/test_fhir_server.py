@@ -1,11 +1,18 @@
+import asyncio
+import json
 import os
+import time
 from unittest import mock
 
+import httpx
+import orjson
 import pytest
 from dotenv import find_dotenv, load_dotenv
 from fhir.resources import FHIRAbstractModel
 from fhir.resources.address import Address
 from fhir.resources.bundle import Bundle, BundleEntry, BundleEntryRequest
+from fhir.resources.observation import Observation
+from fhir.resources.operationoutcome import OperationOutcome
 from fhir.resources.organization import Organization
 from fhir.resources.patient import Patient
 from fhir.resources.reference import Reference
@@ -13,8 +20,22 @@ from httpx import BasicAuth, HTTPStatusError
 
 from fhir_kindling import FhirQuerySync, FhirServer
 from fhir_kindling.fhir_query import FhirQueryParameters
+from fhir_kindling.fhir_server.batching import BatchSizer
+from fhir_kindling.fhir_server.cache import ResourceCache
+from fhir_kindling.fhir_server.rate_limit import RateLimiter, RateLimitTransport
+from fhir_kindling.fhir_server.transactions import (
+    TransactionMethod,
+    TransactionType,
+    make_transaction_bundle,
+    make_transaction_bundle_bytes,
+)
+from fhir_kindling.fhir_server.transfer_checkpoint import (
+    TransferCheckpoint,
+    linkage_key,
+)
 from fhir_kindling.generators import PatientGenerator
 from fhir_kindling.serde.json import json_dict
+from fhir_kindling.util.resilient_transport import CircuitBreaker, CircuitOpenError
 
 
 @pytest.fixture
@@ -50,6 +71,27 @@ def fhir_server(api_url):
     return server
 
 
+@pytest.fixture
+def mock_server():
+    """
+    Factory for servers sending their requests to a mock transport calling the given handler.
+    """
+    servers = []
+
+    def make_server(
+        handler, api_address: str = "https://test.fhir/fhir", **kwargs
+    ) -> FhirServer:
+        server = FhirServer(
+            api_address=api_address, transport=httpx.MockTransport(handler), **kwargs
+        )
+        servers.append(server)
+        return server
+
+    yield make_server
+    for server in servers:
+        server.close()
+
+
 @pytest.fixture
 def org_bundle(api_url):
     bundle = Bundle.construct()
@@ -712,3 +754,1179 @@ async def test_delete_async(fhir_server: FhirServer):
         await fhir_server.delete_async(references=["asd"], query=["asd"])
 
     # todo test delete with query and patients with specific attributes
+
+
+def test_server_connection_pool():
+    with FhirServer(
+        api_address="https://fhir.test/fhir",
+        max_connections=10,
+        max_keepalive_connections=5,
+    ) as server:
+        client = server._sync_client()
+        assert server._sync_client() is client
+        assert server.query("Patient").client is client
+        assert server.raw_query("/Patient?").client is client
+
+    # leaving the context closes the pool, a new one is created on the next request
+    assert client.is_closed
+    assert server._client is None
+    assert server._sync_client() is not client
+    server.close()
+
+
+@pytest.mark.asyncio
+async def test_server_connection_pool_async():
+    async with FhirServer(api_address="https://fhir.test/fhir") as server:
+        client = server._async_client()
+        assert server._async_client() is client
+        assert server.query_async("Patient").client is client
+        assert server.raw_query_async("/Patient?").client is client
+
+    assert client.is_closed
+    assert server._async_client_instance is None
+
+
+def test_server_connection_pool_event_loops():
+    server = FhirServer(api_address="https://fhir.test/fhir")
+
+    async def get_client():
+        client = server._async_client()
+        # a client of a previous loop is closed in a task of the new loop
+        await asyncio.sleep(0)
+        return client
+
+    clients = []
+    for _ in range(2):
+        loop = asyncio.new_event_loop()
+        clients.append(loop.run_until_complete(get_client()))
+        loop.close()
+    assert clients[1] is not clients[0]
+    assert clients[0].is_closed
+    # closing from sync code closes the client of the finished loop
+    server.close()
+    assert clients[1].is_closed
+
+
+def bulk_export_handler(n_patients: int = 5, n_polls: int = 2, retry_after: str = "0"):
+    polls = {"count": 0}
+    files = {
+        "Patient_a": [
+            {"resourceType": "Patient", "id": f"p{i}"} for i in range(n_patients)
+        ],
+        "Patient_b": [{"resourceType": "Patient", "id": "p-last"}],
+        "Organization": [{"resourceType": "Organization", "id": "o1"}],
+    }
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        if path.endswith("/$export"):
+            assert request.headers["Prefer"] == "respond-async"
+            assert request.url.params["_type"] == "Patient,Organization"
+            assert request.url.params.get_list("_typeFilter") == ["Patient?active=true"]
+            return httpx.Response(
+                202, headers={"Content-Location": "https://fhir.test/status/1"}
+            )
+        if path == "/status/1":
+            polls["count"] += 1
+            if polls["count"] <= n_polls:
+                return httpx.Response(
+                    202,
+                    headers={"Retry-After": retry_after, "X-Progress": "in progress"},
+                )
+            return httpx.Response(
+                200,
+                json={
+                    "transactionTime": "2023-01-01T00:00:00Z",
+                    "request": str(request.url),
+                    "requiresAccessToken": True,
+                    "output": [
+                        {
+                            "type": name.split("_")[0],
+                            "url": f"https://fhir.test/files/{name}",
+                        }
+                        for name in files
+                    ],
+                    "error": [],
+                },
+            )
+        if path.startswith("/files/"):
+            resources = files[path.split("/")[-1]]
+            content = "\n".join(json.dumps(r) for r in resources) + "\n"
+            return httpx.Response(200, content=content.encode())
+        return httpx.Response(404)
+
+    return handler, polls
+
+
+def test_bulk_export(tmp_path, mock_server):
+    handler, polls = bulk_export_handler()
+    server = mock_server(handler, api_address="https://fhir.test/fhir")
+
+    export = server.bulk_export(
+        resource_types=["Patient", "Organization"],
+        type_filter=["Patient?active=true"],
+    )
+    assert polls["count"] == 3
+    assert export.resource_types == ["Organization", "Patient"]
+    assert len(export.output) == 3
+    assert not export.files
+
+    # stream the resources directly from the server
+    resources = list(server.iter_bulk_export(export))
+    assert len(resources) == 7
+    assert resources[0]["id"] == "p0"
+
+    # download the files and read them from disk
+    handler, polls = bulk_export_handler()
+    server = mock_server(handler, api_address="https://fhir.test/fhir")
+    export = server.bulk_export(
+        resource_types=["Patient", "Organization"],
+        type_filter=["Patient?active=true"],
+        output_dir=tmp_path / "export",
+    )
+    assert sorted(f.name for f in export.files) == [
+        "Organization_1.ndjson",
+        "Patient_1.ndjson",
+        "Patient_2.ndjson",
+    ]
+    parsed = list(server.iter_bulk_export(export, parse=True))
+    assert len(parsed) == 7
+    assert isinstance(parsed[0], Patient)
+
+    handler, polls = bulk_export_handler(n_polls=100, retry_after="5")
+    server = mock_server(handler, api_address="https://fhir.test/fhir")
+    with pytest.raises(TimeoutError):
+        server.bulk_export(
+            resource_types=["Patient", "Organization"],
+            type_filter=["Patient?active=true"],
+            timeout=1,
+        )
+
+
+@pytest.mark.asyncio
+async def test_bulk_export_async(tmp_path, mock_server):
+    handler, polls = bulk_export_handler(n_patients=100)
+    server = mock_server(handler, api_address="https://fhir.test/fhir")
+
+    export = await server.bulk_export_async(
+        resource_types=["Patient", "Organization"],
+        type_filter=["Patient?active=true"],
+    )
+    resources = [r async for r in server.iter_bulk_export_async(export)]
+    assert len(resources) == 102
+    assert {r["resourceType"] for r in resources} == {"Patient", "Organization"}
+
+    export = await server.bulk_export_async(
+        resource_types=["Patient", "Organization"],
+        type_filter=["Patient?active=true"],
+        output_dir=tmp_path,
+    )
+    assert len(export.files) == 3
+    resources = [
+        r async for r in server.iter_bulk_export_async(export, max_concurrency=1)
+    ]
+    assert len(resources) == 102
+    await server.aclose()
+
+
+def ndjson_upload_handler(supports_import: bool = False):
+    uploads = {"bundles": [], "import": None}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        if path == "/fhir/metadata":
+            operations = [{"name": "import", "definition": "import"}]
+            return httpx.Response(
+                200,
+                json={
+                    "resourceType": "CapabilityStatement",
+                    "rest": [
+                        {
+                            "mode": "server",
+                            "operation": operations if supports_import else [],
+                        }
+                    ],
+                },
+            )
+        if path == "/fhir" and request.method == "POST":
+            bundle = json.loads(request.content)
+            uploads["bundles"].append(bundle)
+            entries = []
+            for i, entry in enumerate(bundle["entry"]):
+                resource = entry["resource"]
+                if "id" in resource:
+                    # resources keep their ids, so references between them stay valid
+                    assert entry["request"] == {
+                        "method": "PUT",
+                        "url": f"{resource['resourceType']}/{resource['id']}",
+                    }
+                else:
+                    assert entry["request"]["method"] == "POST"
+                if resource.get("active") is False:
+                    entries.append(
+                        {
+                            "response": {
+                                "status": "400 Bad Request",
+                                "outcome": {"resourceType": "OperationOutcome"},
+                            }
+                        }
+                    )
+                else:
+                    rtype = resource["resourceType"]
+                    n = sum(len(b["entry"]) for b in uploads["bundles"]) + i
+                    resource_id = resource.get("id", n)
+                    entries.append(
+                        {
+                            "response": {
+                                "status": "201 Created",
+                                "location": f"{rtype}/{resource_id}/_history/1",
+                            }
+                        }
+                    )
+            return httpx.Response(
+                200,
+                json={
+                    "resourceType": "Bundle",
+                    "type": "batch-response",
+                    "entry": entries,
+                },
+            )
+        if path == "/fhir/$import":
+            uploads["import"] = json.loads(request.content)
+            return httpx.Response(
+                202, headers={"Content-Location": "https://fhir.test/status/import"}
+            )
+        if path == "/status/import":
+            return httpx.Response(
+                200,
+                json={
+                    "transactionTime": "2023-01-01T00:00:00Z",
+                    "output": [{"type": "Patient", "count": 10}],
+                },
+            )
+        if path.startswith("/files/"):
+            content = "\n".join(
+                json.dumps({"resourceType": "Patient", "id": str(i)}) for i in range(3)
+            )
+            return httpx.Response(200, content=content.encode())
+        return httpx.Response(404)
+
+    return handler, uploads
+
+
+def test_add_ndjson(tmp_path, mock_server):
+    ndjson_file = tmp_path / "Patient_1.ndjson"
+    with open(ndjson_file, "w") as f:
+        for i in range(25):
+            f.write(json.dumps({"resourceType": "Patient", "id": f"p{i}"}) + "\n")
+        f.write("\n")
+
+    handler, uploads = ndjson_upload_handler()
+    server = mock_server(handler, api_address="https://fhir.test/fhir")
+
+    response = server.add_ndjson(
+        ndjson_file, batch_size=10, display=False, keep_references=True
+    )
+    assert len(uploads["bundles"]) == 3
+    assert uploads["bundles"][0]["type"] == "batch"
+    assert response.n_uploaded == 25
+    assert len(response.references) == 25
+    assert response.references[0] == "Patient/p0"
+
+    # entries that fail are reported without failing the upload
+    resources = [{"resourceType": "Patient", "active": i != 3} for i in range(5)]
+    response = server.add_ndjson(iter(resources), batch_size=2, display=False)
+    assert response.n_uploaded == 4
+    assert response.n_errors == 1
+    assert response.errors == [{"resourceType": "OperationOutcome"}]
+    # only the counts are kept unless the references are requested
+    assert response.references is None
+
+    # urls fall back to streaming the files if the server does not support $import
+    urls = ["https://files.test/files/Patient_1.ndjson"]
+    response = server.add_ndjson(urls, display=False)
+    assert response.n_uploaded == 3
+    assert uploads["import"] is None
+
+    with pytest.raises(ValueError):
+        server.add_ndjson(ndjson_file, use_import=True)
+
+
+def test_add_ndjson_import(mock_server):
+    handler, uploads = ndjson_upload_handler(supports_import=True)
+    server = mock_server(handler, api_address="https://fhir.test/fhir")
+
+    urls = [
+        "https://files.test/files/Patient_1.ndjson",
+        "https://files.test/files/Patient_2.ndjson",
+    ]
+    response = server.add_ndjson(urls)
+    assert response.import_manifest is not None
+    assert response.n_uploaded == 10
+    assert not uploads["bundles"]
+    inputs = [p for p in uploads["import"]["parameter"] if p["name"] == "input"]
+    assert len(inputs) == 2
+    assert inputs[0]["part"][0] == {"name": "type", "valueString": "Patient"}
+
+
+@pytest.mark.asyncio
+async def test_add_all_async_concurrent(mock_server):
+    state = {
+        "in_flight": 0,
+        "max_in_flight": 0,
+        "requests": 0,
+        "failed": False,
+        "fail_status": 503,
+    }
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        state["requests"] += 1
+        state["in_flight"] += 1
+        state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+        bundle = json.loads(request.content)
+        # the first request of the second batch fails
+        fail = bundle["entry"][0]["resource"]["name"][0]["family"] == "10"
+        await asyncio.sleep(0.05 if not fail else 0.01)
+        state["in_flight"] -= 1
+        if fail and not state["failed"]:
+            state["failed"] = True
+            return httpx.Response(state["fail_status"], headers={"Retry-After": "0"})
+        entries = [
+            {
+                "response": {
+                    "status": "201 Created",
+                    "location": f"Patient/{e['resource']['name'][0]['family']}/_history/1",
+                }
+            }
+            for e in bundle["entry"]
+        ]
+        return httpx.Response(200, json={"resourceType": "Bundle", "entry": entries})
+
+    server = mock_server(handler, api_address="https://fhir.test/fhir")
+    resources = [
+        {"resourceType": "Patient", "name": [{"family": str(i)}]} for i in range(60)
+    ]
+    response = await server.add_all_async(
+        resources, batch_size=10, max_concurrency=3, display=False
+    )
+
+    assert [r.resource_id for r in response.create_responses] == [
+        str(i) for i in range(60)
+    ]
+    assert state["max_in_flight"] == 3
+    assert state["requests"] == 7
+
+    # without retries the failed batch aborts the upload
+    state["failed"] = False
+    with pytest.raises(HTTPStatusError):
+        await server.add_all_async(
+            resources, batch_size=10, batch_retries=0, display=False
+        )
+
+    # the server may have processed a bundle answered by a gateway error, it is not sent again
+    state["failed"] = False
+    state["fail_status"] = 502
+    state["requests"] = 0
+    with pytest.raises(HTTPStatusError):
+        await server.add_all_async(
+            resources, batch_size=10, max_concurrency=1, display=False
+        )
+    assert state["requests"] == 2
+    await server.aclose()
+
+
+def test_batch_sizer():
+    sizer = BatchSizer(batch_size=100)
+    sizer.record_success(100, latency=100)
+    assert sizer.size == 100
+    assert not sizer.should_split(504, 100)
+    assert sizer.should_split(413, 100)
+    assert not sizer.should_split(413, 1)
+
+    sizer = BatchSizer(batch_size=100, adaptive=True, target_latency=1)
+    sizer.record_success(100, latency=0.1)
+    assert sizer.size == 110
+    # the last batch of an upload does not increase the size
+    sizer.record_success(20, latency=0.1)
+    assert sizer.size == 110
+    sizer.record_success(110, latency=2)
+    assert sizer.size == 55
+    assert sizer.should_split(504, 55)
+
+    # the payload size of a 413 limits the size of the following bundles
+    sizer.record_failure(413, 50, payload_bytes=50 * 1000)
+    assert sizer.max_payload_bytes == 50 * 1000 - 1
+    for _ in range(20):
+        sizer.record_success(sizer.size, latency=0.1)
+    assert sizer.size == 44
+    assert sizer.sizes[:3] == [100, 20, 110]
+
+
+def batch_upload_handler(
+    max_entries: int, latency: float = 0.0, timeout_entries: int = None
+):
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        bundle = json.loads(request.content)
+        requests.append(len(bundle["entry"]))
+        if timeout_entries is not None and len(bundle["entry"]) > timeout_entries:
+            raise httpx.ReadTimeout("Timed out reading the response", request=request)
+        if len(bundle["entry"]) > max_entries:
+            return httpx.Response(413, text="Request Entity Too Large")
+        entries = [
+            {
+                "response": {
+                    "status": "201 Created",
+                    "location": f"Patient/{e['resource']['name'][0]['family']}/_history/1",
+                }
+            }
+            for e in bundle["entry"]
+        ]
+        return httpx.Response(200, json={"resourceType": "Bundle", "entry": entries})
+
+    return handler, requests
+
+
+def test_add_all_split_bundles(mock_server):
+    handler, requests = batch_upload_handler(max_entries=30)
+    server = mock_server(handler, api_address="https://fhir.test/fhir")
+    resources = [
+        {"resourceType": "Patient", "name": [{"family": str(i)}]} for i in range(100)
+    ]
+
+    response = server.add_all(resources, batch_size=50, display=False)
+    assert [r.resource_id for r in response.create_responses] == [
+        str(i) for i in range(100)
+    ]
+    assert requests[0] == 50
+    assert max(response.batch_sizes) <= 30
+    assert sum(response.batch_sizes) == 100
+    assert response.batch_size == 25
+
+    # adaptive batching grows the batch size up to the server limit
+    handler, requests = batch_upload_handler(max_entries=60)
+    server = mock_server(handler, api_address="https://fhir.test/fhir")
+    resources = [
+        {"resourceType": "Patient", "name": [{"family": str(i)}]} for i in range(500)
+    ]
+    response = server.add_all(
+        resources, batch_size=20, adaptive_batching=True, display=False
+    )
+    assert len(response.create_responses) == 500
+    assert response.create_responses[-1].resource_id == "499"
+    assert 20 < max(response.batch_sizes) <= 60
+
+    # with adaptive batching bundles the client timed out on are split as well
+    handler, requests = batch_upload_handler(max_entries=100, timeout_entries=30)
+    server = mock_server(handler, api_address="https://fhir.test/fhir")
+    response = server.add_all(
+        resources, batch_size=50, adaptive_batching=True, display=False
+    )
+    assert len(response.create_responses) == 500
+    assert max(response.batch_sizes) <= 30
+
+    with pytest.raises(httpx.ReadTimeout):
+        server.add_all(resources, batch_size=50, display=False)
+
+
+@pytest.mark.asyncio
+async def test_add_all_async_split_bundles(mock_server):
+    handler, requests = batch_upload_handler(max_entries=30)
+    server = mock_server(handler, api_address="https://fhir.test/fhir")
+    resources = [
+        {"resourceType": "Patient", "name": [{"family": str(i)}]} for i in range(200)
+    ]
+    response = await server.add_all_async(
+        resources, batch_size=50, adaptive_batching=True, display=False
+    )
+    assert [r.resource_id for r in response.create_responses] == [
+        str(i) for i in range(200)
+    ]
+    assert max(response.batch_sizes) <= 30
+
+    handler, requests = batch_upload_handler(max_entries=100, timeout_entries=30)
+    await server.aclose()
+    server = mock_server(handler, api_address="https://fhir.test/fhir")
+    response = await server.add_all_async(
+        resources, batch_size=50, adaptive_batching=True, display=False
+    )
+    assert len(response.create_responses) == 200
+    assert max(response.batch_sizes) <= 30
+    await server.aclose()
+
+
+def test_make_transaction_bundle_bytes():
+    patients = PatientGenerator(n=10).generate()
+    patient_dicts = [json_dict(p) for p in patients]
+    expected = json_dict(
+        make_transaction_bundle(method=TransactionMethod.POST, resources=patient_dicts)
+    )
+
+    from_models = orjson.loads(
+        make_transaction_bundle_bytes(method=TransactionMethod.POST, resources=patients)
+    )
+    from_dicts = orjson.loads(
+        make_transaction_bundle_bytes(
+            method=TransactionMethod.POST, resources=patient_dicts, validate=True
+        )
+    )
+    assert from_models == expected
+    assert from_dicts == expected
+    # the given resources are not modified
+    assert patients[0].id and patient_dicts[0]["id"]
+
+    put_bundle = orjson.loads(
+        make_transaction_bundle_bytes(
+            TransactionType.BATCH, method="PUT", resources=patient_dicts
+        )
+    )
+    assert put_bundle["type"] == "batch"
+    assert put_bundle["entry"][0]["request"]["url"] == f"Patient/{patients[0].id}"
+    delete_bundle = orjson.loads(
+        make_transaction_bundle_bytes(method="DELETE", references=["Patient/1"])
+    )
+    assert delete_bundle["entry"] == [
+        {"request": {"method": "DELETE", "url": "Patient/1"}}
+    ]
+
+    with pytest.raises(ValueError):
+        make_transaction_bundle_bytes(
+            method="POST",
+            resources=[{"resourceType": "Patient", "birthDate": "not a date"}],
+            validate=True,
+        )
+    with pytest.raises(ValueError):
+        make_transaction_bundle_bytes(
+            method="PUT", resources=[{"resourceType": "Patient"}]
+        )
+
+
+def transfer_target_handler():
+    stored = {}
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        bundle = json.loads(request.content)
+        requests.append(bundle)
+        entries = []
+        for entry in bundle["entry"]:
+            resource = entry["resource"]
+            if entry["request"]["method"] == "POST":
+                resource["id"] = f"t{len(stored)}"
+            reference = f"{resource['resourceType']}/{resource['id']}"
+            stored[reference] = resource
+            entries.append(
+                {
+                    "response": {
+                        "status": "201 Created",
+                        "location": f"{reference}/_history/1",
+                    }
+                }
+            )
+        return httpx.Response(200, json={"resourceType": "Bundle", "entry": entries})
+
+    return handler, stored, requests
+
+
+def test_transfer_reference_cycles(mock_server):
+    source = FhirServer(api_address="https://source.test/fhir")
+    handler, stored, requests = transfer_target_handler()
+    target = mock_server(handler, api_address="https://target.test/fhir")
+
+    def make_resources():
+        observation = {
+            "resourceType": "Observation",
+            "status": "final",
+            "code": {"text": "test"},
+            "subject": {"reference": "Patient/p1"},
+        }
+        return [
+            Organization(id="o1", name="org"),
+            Patient(id="p1", managingOrganization={"reference": "Organization/o1"}),
+            Observation(
+                **observation, id="obs1", hasMember=[{"reference": "Observation/obs2"}]
+            ),
+            Observation(
+                **observation, id="obs2", hasMember=[{"reference": "Observation/obs1"}]
+            ),
+        ]
+
+    with pytest.raises(ValueError, match="reference cycle"):
+        source.transfer(target, resources=make_resources())
+    assert not requests
+
+    response = source.transfer(target, resources=make_resources(), break_cycles=True)
+    assert response.n_transferred == 4
+    assert len(response.linkage) == 4
+    # organization, patient and the observations are created in three generations, then the cycle is restored
+    assert [len(bundle["entry"]) for bundle in requests] == [1, 1, 2, 2]
+    assert requests[-1]["entry"][0]["request"]["method"] == "PUT"
+
+    patient = next(r for r in stored.values() if r["resourceType"] == "Patient")
+    observations = [r for r in stored.values() if r["resourceType"] == "Observation"]
+    assert patient["managingOrganization"]["reference"].startswith("Organization/t")
+    assert len(observations) == 2
+    for observation in observations:
+        assert observation["subject"]["reference"] == f"Patient/{patient['id']}"
+        (member,) = observation["hasMember"]
+        assert member["reference"] in stored
+        assert member["reference"] != f"Observation/{observation['id']}"
+
+
+@pytest.mark.asyncio
+async def test_transfer_async(mock_server):
+    handler, stored, requests = transfer_target_handler()
+    target = mock_server(handler, api_address="https://target.test/fhir")
+
+    # the patients and their organization are only available on the source server
+    source_resources = {
+        "Organization/o1": {"resourceType": "Organization", "id": "o1"},
+        "Patient/p1": {
+            "resourceType": "Patient",
+            "id": "p1",
+            "managingOrganization": {"reference": "Organization/o1"},
+        },
+        "Patient/p2": {"resourceType": "Patient", "id": "p2"},
+    }
+
+    def source_handler(request: httpx.Request) -> httpx.Response:
+        if request.method == "GET":
+            # search page with an included resource and entries that can not be transferred
+            entries = [
+                {
+                    "resource": source_resources["Patient/p1"],
+                    "search": {"mode": "match"},
+                },
+                {
+                    "resource": source_resources["Organization/o1"],
+                    "search": {"mode": "include"},
+                },
+                {
+                    "resource": {"resourceType": "OperationOutcome", "id": "warning"},
+                    "search": {"mode": "outcome"},
+                },
+                {"resource": {"resourceType": "Patient"}, "search": {"mode": "match"}},
+            ]
+            return httpx.Response(
+                200, json={"resourceType": "Bundle", "entry": entries}
+            )
+        bundle = json.loads(request.content)
+        entries = [
+            {"resource": source_resources[entry["request"]["url"]]}
+            for entry in bundle["entry"]
+        ]
+        return httpx.Response(200, json={"resourceType": "Bundle", "entry": entries})
+
+    source = mock_server(source_handler, api_address="https://source.test/fhir")
+    observations = [
+        Observation(
+            id=f"obs{i}",
+            status="final",
+            code={"text": "test"},
+            subject={"reference": f"Patient/p{i % 2 + 1}"},
+        )
+        for i in range(6)
+    ]
+
+    with pytest.raises(ValueError, match="missing"):
+        await source.transfer_async(target, resources=observations, get_missing=False)
+
+    response = await source.transfer_async(
+        target, resources=observations, max_concurrency=2, batch_size=2
+    )
+    assert response.n_transferred == 9
+    assert len(response.linkage) == 9
+    assert response.duration is not None
+    assert response.throughput > 0
+    assert all(len(bundle["entry"]) <= 2 for bundle in requests)
+    # every reference points to a resource created on the target server
+    for resource in stored.values():
+        for key in ("subject", "managingOrganization"):
+            if key in resource:
+                assert resource[key]["reference"] in stored
+
+    # only the matched and included resources of the query pages are transferred
+    n_requests = len(requests)
+    response = await source.transfer_async(target, query=source.query_async("Patient"))
+    assert response.n_transferred == 2
+    transferred = [
+        entry["resource"]["resourceType"]
+        for bundle in requests[n_requests:]
+        for entry in bundle["entry"]
+    ]
+    assert sorted(transferred) == ["Organization", "Patient"]
+    await source.aclose()
+    await target.aclose()
+
+
+def test_transfer_checkpoint(tmp_path, mock_server):
+    source = FhirServer(api_address="https://source.test/fhir")
+    handler, stored, requests = transfer_target_handler()
+    fail = {"after": 1}
+
+    def failing_handler(request: httpx.Request) -> httpx.Response:
+        # fail after the first bundle was created, like a crashing server
+        if fail["after"] is not None and len(requests) >= fail["after"]:
+            return httpx.Response(500, json={"resourceType": "OperationOutcome"})
+        return handler(request)
+
+    target = mock_server(failing_handler, api_address="https://target.test/fhir")
+
+    def make_resources():
+        return [
+            Organization(id="o1", name="org"),
+            Patient(id="p1", managingOrganization={"reference": "Organization/o1"}),
+            Patient(id="p2", managingOrganization={"reference": "Organization/o1"}),
+        ]
+
+    checkpoint = tmp_path / "transfer.sqlite"
+    with pytest.raises(httpx.HTTPStatusError):
+        source.transfer(target, resources=make_resources(), checkpoint=checkpoint)
+    assert len(stored) == 1
+
+    fail["after"] = None
+    response = source.transfer(
+        target, resources=make_resources(), checkpoint=checkpoint
+    )
+    # the organization created before the failure is not created again
+    assert len(stored) == 3
+    assert response.n_transferred == 2
+    assert response.linkage[linkage_key("Organization/o1")] == "Organization/t0"
+    assert len(response.linkage) == 3
+    for resource in stored.values():
+        if resource["resourceType"] == "Patient":
+            assert resource["managingOrganization"]["reference"] == "Organization/t0"
+
+    with TransferCheckpoint(checkpoint) as transfer_checkpoint:
+        assert transfer_checkpoint.completed
+        assert transfer_checkpoint.linkage() == response.linkage
+
+    # a completed transfer does not create any resources
+    response = source.transfer(
+        target, resources=make_resources(), checkpoint=checkpoint
+    )
+    assert response.n_transferred == 0
+    assert len(stored) == 3
+
+    # resuming an asynchronous transfer skips the created resources as well
+    async_checkpoint = tmp_path / "transfer_async.sqlite"
+    fail["after"] = len(requests) + 1
+    loop = asyncio.new_event_loop()
+    with pytest.raises(httpx.HTTPStatusError):
+        loop.run_until_complete(
+            source.transfer_async(
+                target,
+                resources=make_resources(),
+                checkpoint=async_checkpoint,
+                max_concurrency=1,
+                display=False,
+            )
+        )
+    assert len(stored) == 4
+    fail["after"] = None
+    response = loop.run_until_complete(
+        source.transfer_async(
+            target,
+            resources=make_resources(),
+            checkpoint=async_checkpoint,
+            display=False,
+        )
+    )
+    loop.close()
+    assert len(stored) == 6
+    assert response.n_transferred == 2
+    assert len(response.linkage) == 3
+
+    with pytest.raises(ValueError, match="belongs to a transfer"):
+        FhirServer(api_address="https://other.test/fhir").transfer(
+            FhirServer(api_address="https://other-target.test/fhir"),
+            resources=make_resources(),
+            checkpoint=checkpoint,
+        )
+
+
+def get_many_handler():
+    requests = []
+    attempts = {}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.method == "GET":
+            reference = request.url.path.split("/fhir/")[-1]
+            requests.append(reference)
+            resource_type, resource_id = reference.split("/")
+            return httpx.Response(
+                200, json={"resourceType": resource_type, "id": resource_id}
+            )
+        bundle = json.loads(request.content)
+        requests.append(len(bundle["entry"]))
+        entries = []
+        for entry in bundle["entry"]:
+            reference = entry["request"]["url"]
+            resource_type, resource_id = reference.split("/")
+            attempts[reference] = attempts.get(reference, 0) + 1
+            if resource_id == "missing":
+                outcome = {
+                    "resourceType": "OperationOutcome",
+                    "issue": [
+                        {
+                            "severity": "error",
+                            "code": "not-found",
+                            "diagnostics": "gone",
+                        }
+                    ],
+                }
+                entries.append(
+                    {"response": {"status": "404 Not Found", "outcome": outcome}}
+                )
+            elif resource_id == "busy":
+                entries.append({"response": {"status": "503"}})
+            else:
+                resource = {"resourceType": resource_type, "id": resource_id}
+                entries.append({"resource": resource, "response": {"status": "200 OK"}})
+        return httpx.Response(
+            200,
+            json={"resourceType": "Bundle", "type": "batch-response", "entry": entries},
+        )
+
+    return handler, requests
+
+
+def test_get_many_chunked(mock_server):
+    references = [f"Patient/p{i}" for i in range(5)] + [
+        "Patient/missing",
+        "Organization/busy",
+    ]
+    handler, requests = get_many_handler()
+    server = mock_server(handler)
+
+    resources = server.get_many(references, chunk_size=3, max_concurrency=2)
+    assert sorted(r for r in requests if isinstance(r, int)) == [1, 3, 3]
+    # the entry failing with a temporary error is requested again individually
+    assert "Organization/busy" in requests
+    assert [r.relative_path() for r in resources[:5]] == references[:5]
+    assert isinstance(resources[5], OperationOutcome)
+    assert resources[5].issue[0].diagnostics == "gone"
+    assert resources[6].relative_path() == "Organization/busy"
+
+
+@pytest.mark.asyncio
+async def test_get_many_chunked_async(mock_server):
+    references = ["Patient/missing"] + [f"Patient/p{i}" for i in range(4)]
+    handler, requests = get_many_handler()
+    server = mock_server(handler)
+
+    resources = await server.get_many_async(references, chunk_size=2)
+    assert sorted(requests) == [1, 2, 2]
+    assert isinstance(resources[0], OperationOutcome)
+    assert [r.relative_path() for r in resources[1:]] == references[1:]
+    await server.aclose()
+
+
+@pytest.mark.asyncio
+async def test_get_many_async_bounded_retries(mock_server):
+    state = {"in_flight": 0, "max_in_flight": 0}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.method == "POST":
+            return httpx.Response(413)
+        state["in_flight"] += 1
+        state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+        await asyncio.sleep(0.01)
+        state["in_flight"] -= 1
+        resource_type, resource_id = request.url.path.split("/fhir/")[-1].split("/")
+        return httpx.Response(
+            200, json={"resourceType": resource_type, "id": resource_id}
+        )
+
+    server = mock_server(handler)
+    references = [f"Patient/p{i}" for i in range(20)]
+    # the rejected batches are requested individually without exceeding the concurrency limit
+    resources = await server.get_many_async(
+        references, chunk_size=10, max_concurrency=3
+    )
+    assert [r.relative_path() for r in resources] == references
+    assert state["max_in_flight"] == 3
+    await server.aclose()
+
+
+def cache_handler():
+    requests = []
+    version = {"Patient/p1": "1"}
+
+    def handler(request: httpx.Request):
+        requests.append((request.method, request.headers.get("If-None-Match")))
+        if request.method == "POST":
+            version["Patient/p1"] = "2"
+            entry = {"response": {"status": "200 OK"}}
+            return httpx.Response(
+                200, json={"resourceType": "Bundle", "entry": [entry]}
+            )
+        etag = f'W/"{version["Patient/p1"]}"'
+        if request.headers.get("If-None-Match") == etag:
+            return httpx.Response(304)
+        resource = {
+            "resourceType": "Patient",
+            "id": "p1",
+            "meta": {"versionId": version["Patient/p1"]},
+        }
+        return httpx.Response(200, json=resource, headers={"ETag": etag})
+
+    return handler, requests
+
+
+def test_resource_cache(tmp_path, mock_server):
+    cache = ResourceCache(max_size=1, ttl=60, path=tmp_path / "cache.sqlite")
+    handler, requests = cache_handler()
+    server = mock_server(handler, cache=cache)
+
+    assert server.get("Patient/p1").meta.versionId == "1"
+    assert server.get(Reference(reference="Patient/p1")).id == "p1"
+    assert requests == [("GET", None)]
+
+    # stale resources are revalidated with their etag
+    cache._entries["Patient/p1"].stored_at -= 120
+    assert server.get("Patient/p1").id == "p1"
+    assert requests[-1] == ("GET", 'W/"1"')
+
+    # updates through the server invalidate the cached resource
+    server.update([Patient(id="p1")])
+    assert cache.size == 0
+    assert server.get("Patient/p1").meta.versionId == "2"
+    assert requests[-1] == ("GET", None)
+    assert cache.metrics.as_dict() == {
+        "hits": 1,
+        "disk_hits": 0,
+        "revalidations": 1,
+        "misses": 2,
+        "evictions": 0,
+        "invalidations": 1,
+        "hit_rate": 0.5,
+    }
+
+    # the disk tier is shared with new caches
+    disk_cache = ResourceCache(path=tmp_path / "cache.sqlite")
+    assert disk_cache.lookup("Patient/p1")[0]["meta"]["versionId"] == "2"
+    assert disk_cache.metrics.disk_hits == 1
+    disk_cache.close()
+    cache.close()
+    server.close()
+
+
+def test_resource_cache_evicted_revalidation(mock_server):
+    cache = ResourceCache(ttl=0)
+    handler, requests = cache_handler()
+
+    def evicting_handler(request: httpx.Request):
+        # the cached resource is evicted while the conditional request is sent
+        if request.headers.get("If-None-Match"):
+            cache.clear()
+        return handler(request)
+
+    server = mock_server(evicting_handler, cache=cache)
+    assert server.get("Patient/p1").id == "p1"
+    # the 304 response can not be served from the cache and the resource is requested again
+    assert server.get("Patient/p1").meta.versionId == "1"
+    assert requests == [("GET", None), ("GET", 'W/"1"'), ("GET", None)]
+    assert cache.metrics.misses == 2
+    assert cache.metrics.revalidations == 0
+    assert cache.size == 1
+
+    response = httpx.Response(304)
+    cache.clear()
+    assert cache.process_response("Patient/p1", response) is None
+
+
+@pytest.mark.asyncio
+async def test_resource_cache_async(mock_server):
+    handler, requests = cache_handler()
+    server = mock_server(handler, cache=True)
+
+    resources = await asyncio.gather(
+        *[server.get_async("Patient/p1") for _ in range(3)]
+    )
+    assert all(resource.id == "p1" for resource in resources)
+    assert await server.get_async("Patient/p1") is not resources[0]
+    assert server.cache.metrics.hits >= 1
+    await server.delete_async(references=["Patient/p1"])
+    assert server.cache.size == 0
+    await server.aclose()
+
+
+def test_rate_limiter(mock_server):
+    limiter = RateLimiter(rate=20, burst=1, weights={"transaction": 4})
+
+    def handler(request: httpx.Request):
+        if request.url.path.endswith("quota"):
+            headers = {"RateLimit-Remaining": "10", "RateLimit-Reset": "5"}
+            return httpx.Response(200, json={}, headers=headers)
+        return httpx.Response(200, json={})
+
+    server = mock_server(handler, rate_limiter=limiter)
+    start = time.monotonic()
+    for _ in range(5):
+        server._sync_client().get("https://test.fhir/fhir/Patient/1")
+    assert time.monotonic() - start >= 0.18
+
+    transport = RateLimitTransport(server.transport, limiter, server.api_address)
+    operations = [
+        transport.operation(httpx.Request("POST", "https://test.fhir/fhir")),
+        transport.operation(
+            httpx.Request("GET", "https://test.fhir/fhir/Patient?name=a")
+        ),
+        transport.operation(httpx.Request("GET", "https://test.fhir/fhir/Patient/1")),
+        transport.operation(httpx.Request("PUT", "https://test.fhir/fhir/Patient/1")),
+    ]
+    assert operations == ["transaction", "search", "read", "write"]
+
+    # the rate follows the quota announced by the server
+    server._sync_client().get("https://test.fhir/fhir/quota")
+    assert limiter.rate == pytest.approx(0.9 * 10 / 5)
+
+    limiter.update(httpx.Response(429, headers={"Retry-After": "2"}))
+    assert limiter.throttled == 1
+    assert limiter._reserve(1) > 2
+    server.close()
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_in_flight(mock_server):
+    limiter = RateLimiter(max_in_flight=2)
+    in_flight = []
+
+    async def handler(request: httpx.Request):
+        in_flight.append(limiter.in_flight)
+        await asyncio.sleep(0.02)
+        if request.url.params.get("_stream"):
+
+            async def body():
+                yield b'{"resourceType": "Patient", "id": "p1"}'
+
+            return httpx.Response(200, content=body())
+        return httpx.Response(200, json={"resourceType": "Patient", "id": "p1"})
+
+    server = mock_server(handler, rate_limiter=limiter)
+
+    resources = await asyncio.gather(
+        *[server.get_async("Patient/p1") for _ in range(6)]
+    )
+    assert len(resources) == 6
+    assert max(in_flight) == 2
+    assert limiter.in_flight == 0
+
+    # a streamed response keeps its slot until it is closed
+    async with server._async_client().stream(
+        "GET", "https://test.fhir/fhir/Patient/p1", params={"_stream": "true"}
+    ) as response:
+        assert limiter.in_flight == 1
+        # reading the whole body closes the stream
+        await response.aread()
+        assert limiter.in_flight == 0
+    assert limiter.in_flight == 0
+    await server.aclose()
+
+
+def test_server_circuit_breaker(mock_server):
+    requests = []
+
+    def handler(request: httpx.Request):
+        requests.append(request.url.path)
+        return httpx.Response(503)
+
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=60)
+    server = mock_server(handler, circuit_breaker=breaker, hedging=True)
+    for _ in range(2):
+        with pytest.raises(HTTPStatusError):
+            server.get("Patient/p1")
+    # the open circuit is shared by the sync and async clients of the server
+    with pytest.raises(CircuitOpenError):
+        server.get("Patient/p1")
+    loop = asyncio.new_event_loop()
+    with pytest.raises(CircuitOpenError):
+        loop.run_until_complete(server.get_async("Patient/p1"))
+    loop.close()
+    assert len(requests) == 2
+    assert breaker.rejected == 2
+
+
+def summary_handler():
+    requests = []
+    counts = {"Patient": 3, "Observation": 7, "Condition": 0}
+    capabilities = {
+        "resourceType": "CapabilityStatement",
+        "status": "active",
+        "date": "2023-01-01",
+        "kind": "instance",
+        "fhirVersion": "4.0.1",
+        "format": ["json"],
+        "rest": [
+            {
+                "mode": "server",
+                "resource": [
+                    {
+                        "type": "Patient",
+                        "interaction": [{"code": "read"}, {"code": "search-type"}],
+                    },
+                    {"type": "Observation"},
+                    {"type": "Condition"},
+                    {"type": "AuditEvent", "interaction": [{"code": "read"}]},
+                ],
+            }
+        ],
+    }
+
+    def handler(request: httpx.Request):
+        resource = request.url.path.split("/")[-1]
+        requests.append(resource)
+        if request.method == "POST":
+            return httpx.Response(200, json={"resourceType": "Bundle", "entry": []})
+        if resource == "metadata":
+            return httpx.Response(200, json=capabilities)
+        assert request.url.params["_summary"] == "count"
+        return httpx.Response(
+            200, json={"resourceType": "Bundle", "total": counts[resource]}
+        )
+
+    return handler, requests
+
+
+def test_server_summary_concurrent(mock_server):
+    handler, requests = summary_handler()
+    server = mock_server(handler)
+
+    summary = server.summary(display=False, max_concurrency=2)
+    # resource types that can not be searched are skipped
+    assert [(r.resource, r.count) for r in summary.resources] == [
+        ("Patient", 3),
+        ("Observation", 7),
+        ("Condition", 0),
+    ]
+    assert [r.resource for r in summary.available_resources] == [
+        "Patient",
+        "Observation",
+    ]
+    assert "AuditEvent" not in requests
+
+    # the summary is cached until it is older than max_age
+    n_requests = len(requests)
+    assert server.summary(display=False) is summary
+    assert len(requests) == n_requests
+    assert server.summary(display=False, max_age=0) is not summary
+    assert len(requests) == n_requests + 3
+
+    # writes through the server discard the cached summary
+    summary = server.summary(display=False)
+    server.delete(references=["Patient/p1"])
+    assert server.summary(display=False) is not summary
+    server.close()
+
+
+@pytest.mark.asyncio
+async def test_server_summary_concurrent_async(mock_server):
+    handler, requests = summary_handler()
+    server = mock_server(handler)
+
+    summary = await server.summary_async(display=False)
+    assert [r.count for r in summary.resources] == [3, 7, 0]
+    assert await server.summary_async(display=False) is summary
+    await server.aclose()
@@ -1,6 +1,13 @@
+import numpy as np
 import pandas as pd
+import pytest
 
-from fhir_kindling.privacy.k_anonymity import is_k_anonymized
+from fhir_kindling.privacy.k_anonymity import (
+    anonymize,
+    is_k_anonymized,
+    k_anonymity_report,
+)
+from fhir_kindling.privacy.mondrian import mondrian_anonymize
 
 
 def test_k_anonymity(fhir_server):
@@ -28,6 +35,116 @@ def test_k_anonymity(fhir_server):
     assert is_k_anonymized(non_anon_df, k=3, id_cols=["name"])
 
 
+def test_k_anonymity_report():
+    df = pd.DataFrame(
+        {
+            "gender": pd.Categorical(
+                ["male", "male", "male", "female", "female", None, None, None],
+                categories=["male", "female", "other"],
+            ),
+            "age": [30, 30, 30, 40, np.nan, np.nan, np.nan, np.nan],
+            # quotes broke the query based check
+            "city": [
+                "O'Hare",
+                "O'Hare",
+                "O'Hare",
+                'Say "hi"',
+                'Say "hi"',
+                "a",
+                "a",
+                "a",
+            ],
+        },
+        index=list("abcdefgh"),
+    )
+
+    report = k_anonymity_report(df, k=3)
+    assert not report.is_k_anonymous
+    assert report.min_class_size == 1
+    assert report.n_classes == 4
+    # missing values form their own equivalence class
+    assert list(report.violating_indices) == ["d", "e"]
+    assert len(report.violating_classes) == 2
+    assert report.violating_classes["size"].tolist() == [1, 1]
+
+    report = k_anonymity_report(df, k=2, excluded_cols=["age"])
+    assert report.is_k_anonymous
+    assert report.min_class_size == 2
+    assert report.violating_indices.empty
+    assert not k_anonymity_report(df, k=3, id_cols=["gender", "city"])
+    assert k_anonymity_report(df.iloc[:0], k=3).is_k_anonymous
+
+
+def test_anonymize():
+    rng = np.random.default_rng(42)
+    n = 500
+    df = pd.DataFrame(
+        {
+            "age": rng.integers(0, 90, n).astype(float),
+            "birthDate": pd.Series(
+                pd.date_range("1950-01-01", periods=n, freq="17D")
+            ).dt.strftime("%Y-%m-%d"),
+            "city": rng.choice(["Berlin", "Munich", "Paris", "Lyon"], n),
+            "gender": pd.Categorical(rng.choice(["male", "female", None], n)),
+            "value": rng.normal(size=n),
+        }
+    )
+    df.loc[::25, "age"] = np.nan
+    hierarchies = {
+        "city": {
+            "Berlin": ["Germany", "Europe"],
+            "Munich": ["Germany", "Europe"],
+            "Paris": ["France", "Europe"],
+            "Lyon": ["France", "Europe"],
+        }
+    }
+    quasi_identifiers = ["age", "birthDate", "city", "gender"]
+    assert not is_k_anonymized(df, k=5, id_cols=quasi_identifiers)
+
+    result = mondrian_anonymize(
+        df,
+        k=5,
+        id_cols=quasi_identifiers,
+        hierarchies=hierarchies,
+        date_cols=["birthDate"],
+    )
+    assert is_k_anonymized(result.df, k=5, id_cols=quasi_identifiers)
+    assert len(result.df) == n
+    assert result.suppressed_indices.empty
+    # non quasi identifying columns are unchanged
+    assert result.df["value"].equals(df["value"])
+    assert set(result.df["city"]) <= {
+        "Berlin",
+        "Munich",
+        "Paris",
+        "Lyon",
+        "Germany",
+        "France",
+        "Europe",
+    }
+    assert (
+        result.df["birthDate"]
+        .str.match(r"^(\d{4}(-\d{2}){0,2}|\[\d{4}, \d{4}\])$")
+        .all()
+    )
+    assert 0 < result.ncp < 1
+    assert result.avg_class_size >= 1
+    assert result.discernibility >= 5 * n
+
+    # suppression removes rows instead of generalizing them
+    suppressed = mondrian_anonymize(
+        df, k=5, id_cols=quasi_identifiers, suppression_limit=0.05
+    )
+    assert 0 < len(suppressed.suppressed_indices) <= 25
+    assert len(suppressed.df) == n - len(suppressed.suppressed_indices)
+    assert is_k_anonymized(suppressed.df, k=5, id_cols=quasi_identifiers)
+
+    anonymized = anonymize(df[["age", "gender"]], k=10)
+    assert is_k_anonymized(anonymized, k=10)
+    with pytest.raises(ValueError):
+        anonymize(df.iloc[:3], k=5)
+
+
 # def test_anonymize(fhir_server):
 #     patients = fhir_server.query("Patient").limit(1000).resources
 #
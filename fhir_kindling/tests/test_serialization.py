@@ -1,3 +1,4 @@
+import json
 import os
 
 import pandas as pd
@@ -78,3 +79,72 @@ def test_resources_to_csv(server):
 
     if os.path.exists("conditions.csv"):
         os.remove("conditions.csv")
+
+
+def test_resource_schema():
+    pytest.importorskip("pyarrow")
+    from fhir_kindling.serde.arrow import resource_schema
+
+    schema = resource_schema("Patient")
+    assert schema.names[0] == "resourceType"
+    assert schema.field("active").type == "bool"
+    assert schema.field("multipleBirthInteger").type == "int64"
+    # dates can be partial and are stored as strings
+    assert schema.field("birthDate").type == "string"
+    assert schema.field("name").type.value_type.field("family").type == "string"
+    # extensions are stored as json strings
+    assert schema.field("extension").metadata == {b"encoding": b"json"}
+    assert "_birthDate" not in schema.names
+    assert resource_schema("Patient") is schema
+
+
+def test_resources_to_arrow(tmp_path):
+    pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+    from fhir.resources.patient import Patient
+
+    from fhir_kindling.fhir_query.query_parameters import FhirQueryParameters
+    from fhir_kindling.fhir_query.query_response import QueryResponse
+    from fhir_kindling.serde.arrow import pages_to_parquet, resources_to_arrow
+
+    patients = [
+        {
+            "resourceType": "Patient",
+            "id": str(i),
+            "birthDate": "1990-01-0" + str(i % 9 + 1),
+            "name": [{"family": f"Family {i}", "given": ["A", "B"]}],
+            "extension": [{"url": "http://example.org", "valueString": str(i)}],
+        }
+        for i in range(25)
+    ]
+    # rows without values in some fields have the same columns
+    patients.append({"resourceType": "Patient", "id": "empty"})
+
+    table = resources_to_arrow(patients)
+    assert table.num_rows == 26
+    row = table.slice(0, 1).to_pylist()[0]
+    assert row["name"][0]["family"] == "Family 0"
+    assert row["name"][0]["given"] == ["A", "B"]
+    assert json.loads(row["extension"][0])["valueString"] == "0"
+    assert table.slice(25, 1).to_pylist()[0]["name"] is None
+
+    # resource models give the same result
+    model_table = resources_to_arrow([Patient(**p) for p in patients[:2]])
+    assert model_table.schema == table.schema
+    assert model_table.column("birthDate").to_pylist() == ["1990-01-01", "1990-01-02"]
+
+    path = tmp_path / "patients.parquet"
+    n = pages_to_parquet((patients[i : i + 10] for i in range(0, 26, 10)), path)
+    assert n == 26
+    assert pq.ParquetFile(path).metadata.num_row_groups == 3
+    assert pq.read_table(path).equals(table)
+
+    bundle = {
+        "resourceType": "Bundle",
+        "type": "searchset",
+        "entry": [{"resource": p} for p in patients],
+    }
+    response = QueryResponse(bundle, FhirQueryParameters(resource="Patient"))
+    assert response.to_arrow().equals(table)
+    response.to_parquet(tmp_path / "response.parquet", batch_size=20)
+    assert pq.read_table(tmp_path / "response.parquet").num_rows == 26
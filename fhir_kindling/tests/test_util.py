@@ -1,6 +1,9 @@
+import asyncio
 import os
+import time
 import uuid
 
+import httpx
 import pytest
 from dotenv import find_dotenv, load_dotenv
 from fhir.resources.condition import Condition
@@ -11,17 +14,30 @@ from fhir.resources.patient import Patient
 
 from fhir_kindling import FhirServer
 from fhir_kindling.benchmark.bench import ServerBenchmark
-from fhir_kindling.fhir_server.transfer import reference_graph
+from fhir_kindling.fhir_server.transfer import (
+    _update_successors,
+    reference_graph,
+    topological_generations,
+)
 from fhir_kindling.generators import PatientGenerator
 from fhir_kindling.util.references import (
     _resource_ids_from_query_response,
     check_missing_references,
     extract_references,
+    reference_index,
+    reference_plan,
+)
+from fhir_kindling.util.resilient_transport import (
+    CircuitBreaker,
+    CircuitOpenError,
+    HedgingPolicy,
+    ResilientTransport,
 )
 from fhir_kindling.util.resources import (
     check_resource_contains_field,
     get_resource_fields,
 )
+from fhir_kindling.util.retry_transport import RetryBudget, RetryTransport
 
 
 @pytest.fixture
@@ -62,6 +78,72 @@ def test_extract_references():
     assert ("specimen", "Specimen", "123", False) in references
     assert ("device", "Device", "123", False) in references
 
+    # nested elements, contained resources and resource dictionaries
+    encounter = {
+        "resourceType": "Encounter",
+        "id": "e1",
+        "class": {"code": "AMB"},
+        "diagnosis": [{"condition": {"reference": "Condition/c1"}}],
+        "contained": [
+            {
+                "resourceType": "Location",
+                "id": "l1",
+                "managingOrganization": {"reference": "Organization/o1"},
+            }
+        ],
+        "location": [{"location": {"reference": "#l1"}}],
+    }
+    references = extract_references(encounter)
+    assert sorted(references) == [
+        ("contained.managingOrganization", "Organization", "o1", True),
+        ("diagnosis.condition", "Condition", "c1", True),
+    ]
+    model = Encounter(status="planned", **encounter)
+    assert sorted(extract_references(model)) == sorted(references)
+
+
+def test_reference_plan():
+    plan = reference_plan("Encounter")
+    assert plan["subject"] == "Reference"
+    assert plan["diagnosis"] == "EncounterDiagnosis"
+    assert plan["contained"] == "Resource"
+    assert "status" not in plan
+    assert reference_plan("EncounterDiagnosis")["condition"] == "Reference"
+    assert reference_plan("Foo") is None
+
+
+def test_reference_index():
+    encounter = {
+        "resourceType": "Encounter",
+        "id": "e1",
+        "subject": {"reference": "Patient/p1"},
+        "diagnosis": [
+            {"condition": {"reference": "Condition/c1"}},
+            {"condition": {"reference": "Condition/c2"}, "use": {"text": "billing"}},
+        ],
+        "participant": [{"individual": {"reference": "Practitioner/pr1"}}],
+        "contained": [
+            {
+                "resourceType": "Location",
+                "id": "l1",
+                "managingOrganization": {"reference": "Organization/o1"},
+            }
+        ],
+        "location": [{"location": {"reference": "#l1"}}],
+        "basedOn": [{"reference": "http://example.com/fhir/ServiceRequest/s1"}],
+    }
+    index = reference_index(encounter)
+    assert set(index) == {
+        "Patient/p1",
+        "Condition/c1",
+        "Condition/c2",
+        "Practitioner/pr1",
+        "Organization/o1",
+    }
+    # the index contains the elements of the resource, so references are rewritten in place
+    index["Condition/c2"][0]["reference"] = "Condition/new"
+    assert encounter["diagnosis"][1]["condition"]["reference"] == "Condition/new"
+
 
 def test_extract_resource_ids(server):
     conditions = (
@@ -135,6 +217,21 @@ def test_reference_graph():
     assert len(list(graph.predecessors(organization.relative_path()))) == 0
     assert len(list(graph.predecessors(conditions[0].relative_path()))) == 2
 
+    # references are rewritten in the resource dictionaries held by the graph
+    _update_successors(graph, patients[0].relative_path(), "Patient/new")
+    condition = graph.nodes[conditions[0].relative_path()]["resource"]
+    assert condition["subject"]["reference"] == "Patient/new"
+    assert conditions[0].subject.reference == patients[0].relative_path()
+
+    generations = topological_generations(graph)
+    assert set(generations[0]) == {
+        organization.relative_path(),
+        practitioner.relative_path(),
+        encounter.relative_path(),
+    }
+    assert set(generations[1]) == {patient.relative_path() for patient in patients}
+    assert set(generations[2]) == {c.relative_path() for c in conditions}
+
 
 def test_resource_contains_field(server):
     check_resource_contains_field("Patient", "birthDate")
@@ -159,3 +256,131 @@ def test_retry_transport():
 
     with pytest.raises(Exception):
         transfer_server.query("Patient").all()
+
+
+def throttling_handler(retry_after: str = None):
+    attempts = []
+
+    def handler(request: httpx.Request):
+        attempts.append(request.url.path)
+        if len(attempts) % 3:
+            headers = {"Retry-After": retry_after} if retry_after else {}
+            return httpx.Response(429, headers=headers)
+        return httpx.Response(200, json={})
+
+    return handler, attempts
+
+
+@pytest.mark.asyncio
+async def test_retry_transport_async():
+    handler, attempts = throttling_handler()
+    transport = RetryTransport(httpx.MockTransport(handler), backoff_factor=0.1)
+    ticks = []
+
+    async def ticker():
+        while True:
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.01)
+
+    ticker_task = asyncio.create_task(ticker())
+    async with httpx.AsyncClient(transport=transport) as client:
+        response = await client.get("https://test.fhir/fhir/Patient")
+    ticker_task.cancel()
+    assert response.status_code == 200
+    assert len(attempts) == 3
+    # the event loop keeps running while the request is backing off
+    assert len(ticks) > 5
+    assert transport.metrics.retries == 2
+    assert transport.metrics.retries_by_status == {429: 2}
+    assert transport.metrics.backoff_time > 0.2
+
+    # a Retry-After beyond the deadline returns the response instead of waiting
+    handler, attempts = throttling_handler(retry_after="30")
+    transport = RetryTransport(httpx.MockTransport(handler), retry_deadline=1)
+    async with httpx.AsyncClient(transport=transport) as client:
+        response = await asyncio.wait_for(client.get("https://test.fhir/fhir"), 2)
+    assert response.status_code == 429
+    assert transport.metrics.deadline_exceeded == 1
+
+
+def test_retry_budget():
+    handler, attempts = throttling_handler(retry_after="0")
+    budget = RetryBudget(max_tokens=1, token_ratio=0.1)
+    transport = RetryTransport(httpx.MockTransport(handler), retry_budget=budget)
+    with httpx.Client(transport=transport) as client:
+        assert client.get("https://test.fhir/fhir").status_code == 429
+    # the budget allows a single retry
+    assert len(attempts) == 2
+    assert transport.metrics.as_dict()["budget_exhausted"] == 1
+
+
+def test_circuit_breaker():
+    status = {"code": 503}
+    attempts = []
+
+    def handler(request: httpx.Request):
+        attempts.append(request.url.path)
+        return httpx.Response(status["code"], json={})
+
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=0.1)
+    transport = ResilientTransport(
+        httpx.MockTransport(handler), circuit_breaker=breaker
+    )
+    with httpx.Client(transport=transport) as client:
+        for _ in range(2):
+            assert client.get("https://test.fhir/fhir/Patient").status_code == 503
+        # the open circuit fails fast without sending the request
+        with pytest.raises(CircuitOpenError):
+            client.get("https://test.fhir/fhir/Patient")
+        assert len(attempts) == 2
+        assert breaker.state == CircuitBreaker.OPEN
+
+        # after the recovery timeout a successful probe closes the circuit
+        time.sleep(0.15)
+        status["code"] = 200
+        assert client.get("https://test.fhir/fhir/Patient").status_code == 200
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.opened == 1 and breaker.rejected == 1
+
+
+def test_hedged_reads():
+    attempts = []
+
+    def handler(request: httpx.Request):
+        attempts.append(request.method)
+        if len(attempts) == 1:
+            time.sleep(0.5)
+        return httpx.Response(200, json={"attempt": len(attempts)})
+
+    hedging = HedgingPolicy(delay=0.05)
+    transport = ResilientTransport(httpx.MockTransport(handler), hedging=hedging)
+    with httpx.Client(transport=transport) as client:
+        start = time.monotonic()
+        response = client.get("https://test.fhir/fhir/Patient/1")
+        assert time.monotonic() - start < 0.4
+        assert response.json() == {"attempt": 2}
+        # writes are not hedged
+        client.post("https://test.fhir/fhir/Patient", json={})
+    assert attempts == ["GET", "GET", "POST"]
+    assert hedging.hedged == 1 and hedging.hedge_wins == 1
+
+
+@pytest.mark.asyncio
+async def test_hedged_reads_async():
+    attempts = []
+
+    async def handler(request: httpx.Request):
+        attempts.append(request.method)
+        if len(attempts) == 1:
+            await asyncio.sleep(5)
+        return httpx.Response(200, json={"attempt": len(attempts)})
+
+    hedging = HedgingPolicy(percentile=0.5, min_samples=1)
+    hedging.record_latency(0.05)
+    transport = ResilientTransport(httpx.MockTransport(handler), hedging=hedging)
+    async with httpx.AsyncClient(transport=transport) as client:
+        response = await asyncio.wait_for(
+            client.get("https://test.fhir/fhir/Patient/1"), 1
+        )
+    assert response.json() == {"attempt": 2}
+    assert hedging.hedge_wins == 1
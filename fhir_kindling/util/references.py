@@ -1,64 +1,223 @@
-from typing import List, Tuple, Union
+import functools
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 
-from fhir.resources import FHIRAbstractModel
-from fhir.resources.fhirtypes import ReferenceType
+from fhir.resources import FHIRAbstractModel, get_fhir_model_class
 from fhir.resources.resource import Resource
 
 from fhir_kindling.fhir_query.query_response import QueryResponse
-from fhir_kindling.util.resources import get_resource_fields
 
+# element types of resources nested in other resources, e.g. contained resources or Bundle.entry.resource
+RESOURCE_ELEMENT_TYPE = "Resource"
+REFERENCE_ELEMENT_TYPE = "Reference"
 
-def extract_references(resource: Resource) -> List[Tuple[str, str, str, bool]]:
+ReferencePath = Tuple[Union[str, int], ...]
+
+
+def extract_references(
+    resource: Union[Resource, FHIRAbstractModel, dict],
+) -> List[Tuple[str, str, str, bool]]:
     """
-    Extracts the references from a resource and returns them as a list of dicts.
-    Args:
-        resource: fhir resource object to extract references from.
+    Extracts the references from a resource, including references in nested elements and contained resources.
+    Contained (`#id`), absolute and versioned references are not included.
 
-    Returns: list of tuples containing the reference information (reference_field, resource_type, resource_id)
+    Args:
+        resource: fhir resource object or resource dictionary to extract references from.
 
+    Returns: list of tuples containing the reference information (reference_field, resource_type, resource_id,
+        list_field), where the field is the dotted path of the element e.g. `diagnosis.condition` and list_field
+        whether the element is part of a list
     """
-    fields = get_resource_fields(resource)
-    resource_dict = resource.dict(exclude_none=True)
     references = []
-    for field in fields:
-        if field.type_ == ReferenceType:
-            field_value = resource_dict.get(field.name, None)
-            if field_value:
-                # if the field is a list of references, add each of them to the references
-                if isinstance(field_value, list) or isinstance(field_value, tuple):
-                    for value in field_value:
-                        resource, resource_id = value.get("reference").split("/")
-                        references.append((field.name, resource, resource_id, True))
-                # add the reference
-                else:
-                    resource, resource_id = field_value.get("reference").split("/")
-                    references.append((field.name, resource, resource_id, False))
+    for path, element in iter_reference_elements(_resource_dict(resource)):
+        reference = relative_reference(element["reference"])
+        if reference:
+            resource_type, resource_id = reference.split("/")
+            field = ".".join(key for key in path if isinstance(key, str))
+            is_list = any(isinstance(key, int) for key in path)
+            references.append((field, resource_type, resource_id, is_list))
     return references
 
 
+@functools.lru_cache(maxsize=None)
+def reference_plan(element_type: str) -> Optional[Dict[str, str]]:
+    """
+    The fields of a resource or element type that can contain references, computed once per type from the
+    fhir.resources model. Maps the json name of each field to its element type, fields of primitive types or of
+    complex types that can not contain a reference are left out.
+
+    Args:
+        element_type: resource or element type e.g. `Encounter` or `EncounterDiagnosis`
+
+    Returns:
+        Dictionary mapping the field names to their element type, None for unknown types
+    """
+    fields = _complex_fields(element_type)
+    if fields is None:
+        return None
+    return {
+        alias: field_type
+        for alias, field_type in fields
+        if _can_contain_references(field_type)
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def _complex_fields(element_type: str) -> Optional[Tuple[Tuple[str, str], ...]]:
+    try:
+        model = get_fhir_model_class(element_type)
+    except KeyError:
+        return None
+    fields = []
+    for field in model.__fields__.values():
+        field_type = getattr(field.type_, "__resource_type__", None)
+        if field_type is not None:
+            fields.append((field.alias, field_type))
+    return tuple(fields)
+
+
+@functools.lru_cache(maxsize=None)
+def _can_contain_references(element_type: str) -> bool:
+    # search the element types reachable from the type, element types can be recursive e.g. Extension.extension
+    visited = set()
+    stack = [element_type]
+    while stack:
+        current = stack.pop()
+        if current in (REFERENCE_ELEMENT_TYPE, RESOURCE_ELEMENT_TYPE):
+            return True
+        if current in visited:
+            continue
+        visited.add(current)
+        stack.extend(field_type for _, field_type in _complex_fields(current) or ())
+    return False
+
+
+def iter_reference_elements(
+    value: Union[dict, list], element_type: str = None
+) -> Iterator[Tuple[ReferencePath, dict]]:
+    """
+    Iterate over the reference elements in a resource dictionary in a single pass, including references in nested
+    elements and contained resources. Only the fields of the reference plan of each element type are visited. For
+    values of unknown type all nested dictionaries with a `reference` are returned.
+
+    Args:
+        value: resource dictionary or an element of a resource dictionary
+        element_type: type of the value, defaults to the resource type of a resource dictionary
+
+    Returns:
+        Iterator over tuples of the path of the element (keys and list indices) and the element itself
+    """
+    if isinstance(value, list):
+        stack = [((i,), item, element_type) for i, item in enumerate(value)]
+    else:
+        stack = [((), value, element_type or value.get("resourceType"))]
+    while stack:
+        path, value, element_type = stack.pop()
+        if element_type == RESOURCE_ELEMENT_TYPE:
+            element_type = value.get("resourceType")
+        plan = reference_plan(element_type) if element_type else None
+        if plan is None:
+            yield from _iter_all_reference_elements(path, value)
+            continue
+        if element_type == REFERENCE_ELEMENT_TYPE and isinstance(
+            value.get("reference"), str
+        ):
+            yield path, value
+        # resources are sparse, so the keys of the value are matched against the plan
+        for key, item in value.items():
+            item_type = plan.get(key)
+            if item_type is None:
+                continue
+            if isinstance(item, dict):
+                stack.append((path + (key,), item, item_type))
+            elif isinstance(item, list):
+                stack.extend(
+                    (path + (key, i), element, item_type)
+                    for i, element in enumerate(item)
+                    if isinstance(element, dict)
+                )
+
+
+def _iter_all_reference_elements(
+    path: ReferencePath, value: Union[dict, list]
+) -> Iterator[Tuple[ReferencePath, dict]]:
+    stack = [(path, value)]
+    while stack:
+        path, value = stack.pop()
+        if isinstance(value, dict):
+            if isinstance(value.get("reference"), str):
+                yield path, value
+            items = value.items()
+        elif isinstance(value, list):
+            items = enumerate(value)
+        else:
+            continue
+        stack.extend(
+            (path + (key,), item)
+            for key, item in reversed(list(items))
+            if isinstance(item, (dict, list))
+        )
+
+
+def _resource_dict(resource: Union[Resource, FHIRAbstractModel, dict]) -> dict:
+    if isinstance(resource, dict):
+        return resource
+    return resource.dict(exclude_none=True)
+
+
+def relative_reference(reference: str) -> Optional[str]:
+    """
+    Get the relative reference `{ResourceType}/{id}` of a reference string, None for contained (`#id`), absolute or
+    versioned references.
+    """
+    parts = reference.split("/")
+    if len(parts) == 2 and all(parts) and not reference.startswith("#"):
+        return reference
+    return None
+
+
+def reference_index(resource: Dict[str, Any]) -> Dict[str, List[dict]]:
+    """
+    Index the reference elements of a resource dictionary by the resource they reference. The index contains the
+    elements of the dictionary themselves, so a reference is rewritten by setting `element["reference"]`.
+
+    Args:
+        resource: resource dictionary
+
+    Returns:
+        Dictionary mapping each referenced relative reference to the elements referencing it
+    """
+    index = {}
+    for _, element in iter_reference_elements(resource):
+        reference = relative_reference(element["reference"])
+        if reference:
+            index.setdefault(reference, []).append(element)
+    return index
+
+
 def check_missing_references(
-    resources: List[Union[Resource, FHIRAbstractModel]]
+    resources: List[Union[Resource, FHIRAbstractModel, dict]],
 ) -> List[str]:
     """
     Checks the references in a list of resources to ensure that the referenced resources exist in the list.
     Args:
-        resources: list of fhir resources
+        resources: list of fhir resources or resource dictionaries
 
     Returns:
-
+        list of the references to resources that are not in the list
     """
     references = {}
     resource_ids = {}
     for resource in resources:
+        resource = _resource_dict(resource)
         # extract references
         _update_reference_set(references, resource)
         # extract ids
-        resource_id_set = resource_ids.get(resource.resource_type)
+        resource_id_set = resource_ids.get(resource["resourceType"])
         if resource_id_set is None:
-            resource_id_set = {resource.id}
+            resource_id_set = {resource.get("id")}
         else:
-            resource_id_set.add(resource.id)
-        resource_ids[resource.resource_type] = resource_id_set
+            resource_id_set.add(resource.get("id"))
+        resource_ids[resource["resourceType"]] = resource_id_set
     missing = _get_missing_references(references, resource_ids)
     return missing
 
@@ -81,9 +240,7 @@ def _get_missing_references(references: dict, resource_ids: dict) -> List[str]:
     return missing_references
 
 
-def _update_reference_set(
-    references: dict, resource: Union[Resource, FHIRAbstractModel]
-):
+def _update_reference_set(references: dict, resource: dict):
     resource_references = extract_references(resource)
     for reference in resource_references:
         reference_set = references.get(reference[1])
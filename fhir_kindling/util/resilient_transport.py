@@ -0,0 +1,349 @@
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from time import monotonic
+from typing import Deque, List, Optional, Union
+
+import httpx
+
+HEDGED_METHODS = frozenset(["GET", "HEAD"])
+
+
+class CircuitOpenError(httpx.TransportError):
+    """
+    Raised instead of sending a request while the circuit breaker of the server is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Fails requests fast after repeated server errors (5xx) or transport errors such as timeouts. After
+    `failure_threshold` consecutive failures the circuit opens and requests raise a `CircuitOpenError` without being
+    sent. Once `recovery_timeout` seconds have passed the circuit is half-open and lets `half_open_requests` probe
+    requests through, it closes again if they succeed and opens again if one of them fails.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        recovery_timeout: float = 30,
+        half_open_requests: int = 1,
+    ):
+        """
+        Args:
+            failure_threshold: number of consecutive failures that open the circuit
+            recovery_timeout: time in seconds after which an open circuit lets probe requests through
+            half_open_requests: number of probe requests sent while the circuit is half-open
+        """
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_requests = half_open_requests
+        self.state = self.CLOSED
+        self.failures = 0
+        # how often the circuit opened and how many requests were failed fast
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self.state == self.OPEN:
+                if monotonic() - self._opened_at < self.recovery_timeout:
+                    self.rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self._probes = 0
+            if self.state == self.HALF_OPEN:
+                if self._probes >= self.half_open_requests:
+                    self.rejected += 1
+                    return False
+                self._probes += 1
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.opened += 1
+                self.state = self.OPEN
+                self._opened_at = monotonic()
+
+    def record_abort(self):
+        """
+        Free the probe slot of a request that was cancelled before it completed.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__}(state={self.state}, failures={self.failures}, "
+            f"opened={self.opened}, rejected={self.rejected})>"
+        )
+
+
+class HedgingPolicy:
+    """
+    Decides when a duplicate of a slow read request is sent. Unless a fixed `delay` is given, the duplicate is sent
+    once the request takes longer than the `percentile` of the latencies of the last `window` reads, hedging starts
+    after `min_samples` reads were measured.
+    """
+
+    def __init__(
+        self,
+        delay: Optional[float] = None,
+        percentile: float = 0.95,
+        window: int = 100,
+        min_samples: int = 20,
+    ):
+        """
+        Args:
+            delay: fixed time in seconds after which the duplicate request is sent
+            percentile: percentile of the measured latencies used as delay
+            window: number of recent latencies the percentile is computed from
+            min_samples: number of measured latencies required before requests are hedged
+        """
+        self.delay = delay
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.latencies: Deque[float] = deque(maxlen=window)
+        # number of duplicate requests sent and how many of them answered first
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._lock = threading.Lock()
+
+    def hedge_delay(self) -> Optional[float]:
+        """
+        Time to wait for a response before sending the duplicate request, None if the request is not hedged.
+        """
+        if self.delay is not None:
+            return self.delay
+        with self._lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[int(self.percentile * (len(latencies) - 1))]
+
+    def record_latency(self, latency: float):
+        with self._lock:
+            self.latencies.append(latency)
+
+    def record_hedge(self, won: bool = False):
+        with self._lock:
+            if won:
+                self.hedge_wins += 1
+            else:
+                self.hedged += 1
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__}(delay={self.hedge_delay()}, hedged={self.hedged}, "
+            f"hedge_wins={self.hedge_wins})>"
+        )
+
+
+class ResilientTransport(httpx.AsyncBaseTransport, httpx.BaseTransport):
+    def __init__(
+        self,
+        wrapped_transport: Union[httpx.BaseTransport, httpx.AsyncBaseTransport],
+        circuit_breaker: CircuitBreaker = None,
+        hedging: HedgingPolicy = None,
+        max_workers: int = 32,
+    ) -> None:
+        """
+        A transport that fails fast while the server is failing and hedges slow reads. Requests are rejected with a
+        `CircuitOpenError` while the circuit breaker is open. GET and HEAD requests that take longer than the hedge
+        delay are sent a second time and the first response is returned, the other request is cancelled or its
+        response closed.
+
+        Args:
+            wrapped_transport: The transport to wrap.
+            circuit_breaker: Optional circuit breaker, shared by the transports of a server.
+            hedging: Optional policy for hedged reads, shared by the transports of a server.
+            max_workers: Maximum number of threads sending hedged synchronous requests.
+        """
+        self.wrapped_transport = wrapped_transport
+        self.circuit_breaker = circuit_breaker
+        self.hedging = hedging
+        self.max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        self._check_circuit(request)
+        try:
+            delay = self._hedge_delay(request)
+            if delay is None:
+                response = self._send(request)
+            else:
+                response = self._send_hedged(request, delay)
+        except httpx.TransportError:
+            self._record_outcome()
+            raise
+        except BaseException:
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.record_abort()
+            raise
+        self._record_outcome(response)
+        return response
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self._check_circuit(request)
+        try:
+            delay = self._hedge_delay(request)
+            if delay is None:
+                response = await self._send_async(request)
+            else:
+                response = await self._send_hedged_async(request, delay)
+        except httpx.TransportError:
+            self._record_outcome()
+            raise
+        except BaseException:
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.record_abort()
+            raise
+        self._record_outcome(response)
+        return response
+
+    def _send(self, request: httpx.Request) -> httpx.Response:
+        started = monotonic()
+        response = self.wrapped_transport.handle_request(request)
+        self._record_latency(request, response, started)
+        return response
+
+    async def _send_async(self, request: httpx.Request) -> httpx.Response:
+        started = monotonic()
+        response = await self.wrapped_transport.handle_async_request(request)
+        self._record_latency(request, response, started)
+        return response
+
+    def _send_hedged(self, request: httpx.Request, delay: float) -> httpx.Response:
+        executor = self._get_executor()
+        futures = [executor.submit(self._send, request)]
+        done, _ = wait(futures, timeout=delay)
+        if not done:
+            self.hedging.record_hedge()
+            futures.append(executor.submit(self._send, request))
+        pending = set(futures)
+        errors = []
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    errors.append(future.exception())
+                    continue
+                if future is not futures[0]:
+                    self.hedging.record_hedge(won=True)
+                for other in futures:
+                    # the slower request can not be cancelled once it is sent, its response is discarded
+                    if other is not future:
+                        other.add_done_callback(_close_response)
+                return future.result()
+        raise errors[0]
+
+    async def _send_hedged_async(
+        self, request: httpx.Request, delay: float
+    ) -> httpx.Response:
+        tasks = [asyncio.create_task(self._send_async(request))]
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            self.hedging.record_hedge()
+            tasks.append(asyncio.create_task(self._send_async(request)))
+        pending = set(tasks)
+        errors = []
+        winner = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is not None:
+                        errors.append(task.exception())
+                        continue
+                    if task is not tasks[0]:
+                        self.hedging.record_hedge(won=True)
+                    winner = task
+                    return task.result()
+        finally:
+            await _discard_tasks([task for task in tasks if task is not winner])
+        raise errors[0]
+
+    def _check_circuit(self, request: httpx.Request):
+        if (
+            self.circuit_breaker is not None
+            and not self.circuit_breaker.allow_request()
+        ):
+            raise CircuitOpenError(
+                f"Circuit breaker is open, not sending {request.method} {request.url}",
+                request=request,
+            )
+
+    def _record_outcome(self, response: httpx.Response = None):
+        if self.circuit_breaker is None:
+            return
+        if response is None or response.status_code >= 500:
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+
+    def _hedge_delay(self, request: httpx.Request) -> Optional[float]:
+        if self.hedging is None or request.method not in HEDGED_METHODS:
+            return None
+        return self.hedging.hedge_delay()
+
+    def _record_latency(
+        self, request: httpx.Request, response: httpx.Response, started: float
+    ):
+        if (
+            self.hedging is not None
+            and request.method in HEDGED_METHODS
+            and response.is_success
+        ):
+            self.hedging.record_latency(monotonic() - started)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="hedged-request"
+                )
+            return self._executor
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self.wrapped_transport.close()
+
+    async def aclose(self) -> None:
+        await self.wrapped_transport.aclose()
+
+
+def _close_response(future: Future):
+    if future.exception() is None:
+        future.result().close()
+
+
+async def _discard_tasks(tasks: List[asyncio.Task]):
+    for task in tasks:
+        task.cancel()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    # close the responses of requests that completed but were not used
+    for result in results:
+        if isinstance(result, httpx.Response):
+            await result.aclose()
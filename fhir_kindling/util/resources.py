@@ -7,7 +7,7 @@ from pydantic.fields import ModelField
 
 
 def get_resource_fields(
-    resource: Union[Resource, ResourceType, str, Type[FHIRAbstractModel]]
+    resource: Union[Resource, ResourceType, str, Type[FHIRAbstractModel]],
 ) -> List[ModelField]:
     """
     Get the fields of a resource.
@@ -69,3 +69,19 @@ def check_resource_contains_field(
     field_names = [field.name for field in fields]
     if field_name not in field_names:
         raise ValueError(f"Resource {resource} does not contain field {field_name}")
+
+
+def construct_resource(resource: dict) -> FHIRAbstractModel:
+    """
+    Create a FHIR resource model from a dictionary without validating it. Nested elements are not converted and
+    remain dictionaries.
+    Args:
+        resource: the resource as dictionary
+
+    Returns:
+        The unvalidated resource model
+    """
+    model = get_fhir_model_class(resource["resourceType"])
+    return model.construct(
+        **{key: value for key, value in resource.items() if key != "resourceType"}
+    )
@@ -1,16 +1,147 @@
+import asyncio
 import random
+import threading
 from datetime import datetime
-from time import sleep
-from typing import Iterable, Mapping, Union
+from time import monotonic, sleep
+from typing import Dict, Iterable, Mapping, Optional, Union
 
 import httpx
 
 from fhir_kindling.util.date_utils import convert_to_local_datetime, parse_datetime
 
 
+def calculate_sleep(
+    attempts_made: int,
+    headers: Union[httpx.Headers, Mapping[str, str]],
+    backoff_factor: float = 0.1,
+    jitter_ratio: float = 0.1,
+    max_backoff_wait: float = 60,
+    respect_retry_after_header: bool = True,
+) -> float:
+    """
+    Calculate the time to wait before the next attempt, based on the Retry-After header if present and
+    otherwise using exponential backoff with jitter.
+
+    Args:
+        attempts_made: number of attempts made so far
+        headers: headers of the last response
+        backoff_factor: the amount of time to wait between retries, multiplied by the number of attempts made
+        jitter_ratio: the amount of jitter to add to the backoff time
+        max_backoff_wait: the maximum amount of time to wait
+        respect_retry_after_header: whether to respect the Retry-After header
+
+    Returns:
+        the time to wait in seconds
+    """
+    retry_after_header = (headers.get("Retry-After") or "").strip()
+    if respect_retry_after_header and retry_after_header:
+        if retry_after_header.isdigit():
+            return float(retry_after_header)
+
+        try:
+            # convert to local time
+            parsed_date = convert_to_local_datetime(parse_datetime(retry_after_header))
+            diff = (parsed_date - datetime.now().astimezone()).total_seconds()
+            if diff > 0:
+                return min(diff, max_backoff_wait)
+        except ValueError:
+            pass
+
+    backoff = backoff_factor * (2 ** (attempts_made - 1))
+    jitter = (backoff * jitter_ratio) * random.choice([1, -1])
+    total_backoff = backoff + jitter
+    return min(total_backoff, max_backoff_wait)
+
+
+class RetryMetrics:
+    """
+    Counters of the retries made by a RetryTransport, shared by all clients of a server.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        # total time in seconds spent waiting between attempts
+        self.backoff_time = 0.0
+        # responses returned without retrying, because the deadline or the retry budget would have been exceeded
+        self.deadline_exceeded = 0
+        self.budget_exhausted = 0
+        self.retries_by_status: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def record_retry(self, status_code: int, sleep_for: float):
+        with self._lock:
+            self.retries += 1
+            self.backoff_time += sleep_for
+            self.retries_by_status[status_code] = (
+                self.retries_by_status.get(status_code, 0) + 1
+            )
+
+    def record_skipped_retry(self, reason: str):
+        """
+        Count a response that was returned without retrying it.
+
+        Args:
+            reason: the counter to increment, `deadline_exceeded` or `budget_exhausted`
+        """
+        with self._lock:
+            setattr(self, reason, getattr(self, reason) + 1)
+
+    def as_dict(self) -> Dict[str, Union[int, float, dict]]:
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "backoff_time": self.backoff_time,
+            "deadline_exceeded": self.deadline_exceeded,
+            "budget_exhausted": self.budget_exhausted,
+            "retries_by_status": dict(self.retries_by_status),
+        }
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__}(requests={self.requests}, retries={self.retries}, "
+            f"backoff_time={self.backoff_time:.2f})>"
+        )
+
+
+class RetryBudget:
+    """
+    Token bucket limiting the retries of a client relative to its requests. Every request adds `token_ratio` tokens
+    up to `max_tokens` and every retry takes one token, once the bucket is empty failed requests are no longer retried.
+    This keeps a throttling or failing server from being flooded with retries.
+    """
+
+    def __init__(self, max_tokens: float = 10, token_ratio: float = 0.2):
+        """
+        Args:
+            max_tokens: maximum number of retries that can be made in a burst
+            token_ratio: number of retries earned by each request
+        """
+        self.max_tokens = max_tokens
+        self.token_ratio = token_ratio
+        self.tokens = float(max_tokens)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.token_ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
 class RetryTransport(httpx.AsyncBaseTransport, httpx.BaseTransport):
     RETRYABLE_METHODS = frozenset(["HEAD", "GET", "PUT", "DELETE", "OPTIONS", "TRACE"])
-    RETRYABLE_STATUS_CODES = frozenset([413, 429, 503, 504])
+    # 413 is not retried, resending the same payload can not succeed, bundle uploads are split instead
+    RETRYABLE_STATUS_CODES = frozenset([429, 503, 504])
 
     MAX_BACKOFF_WAIT = 60
 
@@ -24,9 +155,14 @@ class RetryTransport(httpx.AsyncBaseTransport, httpx.BaseTransport):
         respect_retry_after_header: bool = True,
         retryable_methods: Iterable[str] = None,
         retry_status_codes: Iterable[int] = None,
+        retry_deadline: Optional[float] = None,
+        retry_budget: Optional[RetryBudget] = None,
+        metrics: Optional[RetryMetrics] = None,
     ) -> None:
         """
-        A transport that retries requests that fail with retryable status codes.
+        A transport that retries requests that fail with retryable status codes. The asynchronous transport waits
+        with `asyncio.sleep`, so other requests on the event loop continue while a request is backing off and the
+        wait is cancelled together with the request.
 
         Args:
             wrapped_transport: The transport to wrap.
@@ -41,6 +177,10 @@ class RetryTransport(httpx.AsyncBaseTransport, httpx.BaseTransport):
                 when retrying requests.
             retryable_methods: The HTTP methods that should be retried.
             retry_status_codes: The HTTP status codes that should be retried.
+            retry_deadline: Maximum time in seconds from the first attempt of a request until the last retry, the
+                last response is returned if the next retry would start after the deadline.
+            retry_budget: Optional budget of retries shared by all requests of the transport.
+            metrics: Optional counters of the retries, e.g. shared by the transports of a server.
         """
         self.wrapped_transport = wrapped_transport
         if jitter_ratio < 0 or jitter_ratio > 0.5:
@@ -63,77 +203,95 @@ class RetryTransport(httpx.AsyncBaseTransport, httpx.BaseTransport):
         )
         self.jitter_ratio = jitter_ratio
         self.max_backoff_wait = max_backoff_wait
+        self.retry_deadline = retry_deadline
+        self.retry_budget = retry_budget
+        self.metrics = metrics if metrics is not None else RetryMetrics()
 
     def _calculate_sleep(
         self, attempts_made: int, headers: Union[httpx.Headers, Mapping[str, str]]
     ) -> float:
-        retry_after_header = (headers.get("Retry-After") or "").strip()
-        if self.respect_retry_after_header and retry_after_header:
-            if retry_after_header.isdigit():
-                return float(retry_after_header)
-
-            try:
-                # convert to local time
-                parsed_date = convert_to_local_datetime(parse_datetime(retry_after_header)) 
-                diff = (parsed_date - datetime.now().astimezone()).total_seconds()
-                if diff > 0:
-                    return min(diff, self.max_backoff_wait)
-            except ValueError:
-                pass
-
-        backoff = self.backoff_factor * (2 ** (attempts_made - 1))
-        jitter = (backoff * self.jitter_ratio) * random.choice([1, -1])
-        total_backoff = backoff + jitter
-        return min(total_backoff, self.max_backoff_wait)
+        return calculate_sleep(
+            attempts_made,
+            headers,
+            backoff_factor=self.backoff_factor,
+            jitter_ratio=self.jitter_ratio,
+            max_backoff_wait=self.max_backoff_wait,
+            respect_retry_after_header=self.respect_retry_after_header,
+        )
+
+    def _retry_sleep(
+        self, response: httpx.Response, attempts_made: int, started: float
+    ) -> Optional[float]:
+        """
+        Decide whether a response is retried.
+
+        Returns:
+            The time to wait before the next attempt or None if the response should be returned
+        """
+        if (
+            attempts_made >= self.max_attempts
+            or response.status_code not in self.retry_status_codes
+        ):
+            return None
+        sleep_for = self._calculate_sleep(attempts_made, response.headers)
+        if (
+            self.retry_deadline is not None
+            and monotonic() - started + sleep_for > self.retry_deadline
+        ):
+            self.metrics.record_skipped_retry("deadline_exceeded")
+            return None
+        if self.retry_budget is not None and not self.retry_budget.withdraw():
+            self.metrics.record_skipped_retry("budget_exhausted")
+            return None
+        self.metrics.record_retry(response.status_code, sleep_for)
+        return sleep_for
+
+    def _start_request(self, request: httpx.Request) -> bool:
+        self.metrics.record_request()
+        if self.retry_budget is not None:
+            self.retry_budget.deposit()
+        return request.method in self.retryable_methods
 
     def handle_request(self, request: httpx.Request) -> httpx.Response:
+        started = monotonic()
+        retryable = self._start_request(request)
         response = self.wrapped_transport.handle_request(request)
-
-        if request.method not in self.retryable_methods:
+        if not retryable:
             return response
 
-        remaining_attempts = self.max_attempts - 1
         attempts_made = 1
-
         while True:
-            if (
-                remaining_attempts < 1
-                or response.status_code not in self.retry_status_codes
-            ):
+            sleep_for = self._retry_sleep(response, attempts_made, started)
+            if sleep_for is None:
                 return response
 
             response.close()
-
-            sleep_for = self._calculate_sleep(attempts_made, response.headers)
             sleep(sleep_for)
 
             response = self.wrapped_transport.handle_request(request)
-
             attempts_made += 1
-            remaining_attempts -= 1
 
     async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started = monotonic()
+        retryable = self._start_request(request)
         response = await self.wrapped_transport.handle_async_request(request)
-
-        if request.method not in self.retryable_methods:
+        if not retryable:
             return response
 
-        remaining_attempts = self.max_attempts - 1
         attempts_made = 1
-
         while True:
-            if (
-                remaining_attempts < 1
-                or response.status_code not in self.retry_status_codes
-            ):
+            sleep_for = self._retry_sleep(response, attempts_made, started)
+            if sleep_for is None:
                 return response
 
-            response.close()
-
-            sleep_for = self._calculate_sleep(attempts_made, response.headers)
-            sleep(sleep_for)
+            await response.aclose()
+            await asyncio.sleep(sleep_for)
 
             response = await self.wrapped_transport.handle_async_request(request)
-
             attempts_made += 1
-            remaining_attempts -= 1
+
+    def close(self) -> None:
+        self.wrapped_transport.close()
+
+    async def aclose(self) -> None:
+        await self.wrapped_transport.aclose()